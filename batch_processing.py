@@ -74,6 +74,16 @@ def write_config_file(config,
     return config_file
 
 
+def get_job_lines(process_name, script_files, run_numbers, job_file):
+    lines = []
+    for i, script_i in zip(run_numbers, script_files):
+        job_name = '{}_{}'.format(process_name, i)
+        lines.append('JOB {} {}'.format(job_name, job_file))
+        lines.append('VARS {} script_file="{}" run="{}"'.format(
+            job_name, script_i, i))
+    return lines
+
+
 def write_option_file(config,
                       script_files,
                       run_numbers,
@@ -81,12 +91,7 @@ def write_option_file(config,
                       scratch_folder):
     process_name = '{dataset_number}_{step_name}'.format(**config)
 
-    lines = []
-    for i, script_i in zip(run_numbers, script_files):
-        job_name = '{}_{}'.format(process_name, i)
-        lines.append('JOB {} {}'.format(job_name, job_file))
-        lines.append('VARS {} script_file="{}" run="{}"'.format(
-            job_name, script_i, i))
+    lines = get_job_lines(process_name, script_files, run_numbers, job_file)
 
     option_file = os.path.join(scratch_folder, 'dagman.options')
     with open(option_file, 'w') as open_file:
@@ -115,6 +120,105 @@ def create_dagman_files(config,
     os.chmod(run_script, st.st_mode | stat.S_IEXEC)
 
 
+def write_chain_option_file(step_jobs,
+                            job_files,
+                            scratch_folder):
+    """Write a DAG for several steps.
+
+    Each job of a step is a child of the jobs of its previous step that
+    process the same runs, if the previous step is part of the DAG.
+    Steps that are part of a fused job are represented by the fused job.
+
+    Parameters
+    ----------
+    step_jobs : list of tuple
+        The config, script files, run numbers and the runs processed by
+        each job of each step.
+    job_files : list of str
+        The submit file of each step.
+    scratch_folder : str
+        Folder the DAG is written to.
+
+    Returns
+    -------
+    str
+        Path to the DAG file.
+    """
+    process_names = {}
+    run_to_job = {}
+    for config, _, run_numbers, job_runs in step_jobs:
+        process_name = '{dataset_number}_{step}_{step_name}'.format(**config)
+        job_of_run = {}
+        for i, runs in zip(run_numbers, job_runs):
+            for run in runs:
+                job_of_run[run] = i
+        steps = [config['step']]
+        if 'fused_steps' in config:
+            steps.extend([s['step'] for s in config['fused_steps']])
+        for step in steps:
+            process_names[step] = process_name
+            run_to_job[step] = job_of_run
+
+    lines = []
+    for (config, script_files, run_numbers, _), job_file in zip(step_jobs,
+                                                                 job_files):
+        lines.extend(get_job_lines(process_names[config['step']],
+                                   script_files,
+                                   run_numbers,
+                                   job_file))
+
+    for config, _, run_numbers, job_runs in step_jobs:
+        previous_step = config['previous_step']
+        if previous_step not in run_to_job:
+            continue
+        for i, runs in zip(run_numbers, job_runs):
+            # the previous step of a run may be already done
+            parents = set([run_to_job[previous_step][run] for run in runs
+                           if run in run_to_job[previous_step]])
+            for parent in sorted(parents):
+                lines.append('PARENT {}_{} CHILD {}_{}'.format(
+                    process_names[previous_step], parent,
+                    process_names[config['step']], i))
+
+    option_file = os.path.join(scratch_folder, 'dagman.options')
+    with open(option_file, 'w') as open_file:
+        for line in lines:
+            open_file.write(line + '\n')
+    return option_file
+
+
+def create_dagman_chain_files(step_jobs,
+                              step_scratch_folders,
+                              scratch_folder):
+    """Create a DAG that pipelines several steps run by run.
+
+    Parameters
+    ----------
+    step_jobs : list of tuple
+        The config, script files, run numbers and the runs processed by
+        each job of each step.
+    step_scratch_folders : list of str
+        The scratch folder of each step. The submit files and logs of a
+        step are placed there.
+    scratch_folder : str
+        Folder for the DAG files.
+    """
+    config_file = write_config_file(step_jobs[0][0], scratch_folder)
+    onejob_files = [write_onejob_file(config, step_scratch_folder)
+                    for (config, _, _, _), step_scratch_folder
+                    in zip(step_jobs, step_scratch_folders)]
+    options_file = write_chain_option_file(step_jobs,
+                                           onejob_files,
+                                           scratch_folder)
+    cmd = 'condor_submit_dag -config {} -notification Complete {}'.format(
+        config_file, options_file)
+    run_script = os.path.join(scratch_folder, 'start_dagman.sh')
+    with open(run_script, 'w') as open_file:
+        open_file.write(cmd)
+    st = os.stat(run_script)
+    os.chmod(run_script, st.st_mode | stat.S_IEXEC)
+
+
 def adjust_resouces(config, script_files, scratch_folder):
     resources_cfg = config['resources']
     if resources_cfg['gpu_steps'] is not None:
@@ -138,11 +242,120 @@ def adjust_resouces(config, script_files, scratch_folder):
     return config
 
 
+def get_step_resource(config, kind, default=None):
+    """Get a resource requested for the current step.
+
+    Parameters
+    ----------
+    config : dict
+        The config of the step.
+    kind : str
+        The kind of resource: 'gpus', 'memory', 'cpus' or 'walltime'.
+    default : optional
+        Returned if nothing is requested for the step.
+    """
+    values = config['resources'].get(kind, None)
+    if values is not None and values.get(config['step'], None) is not None:
+        return values[config['step']]
+    return default
+
+
+def write_pbs_job_list(script_files,
+                       scratch_folder):
+    """Write the job scripts of a job array, one per line.
+
+    The job script of an array task is found in line (index + 1).
+    """
+    job_list = os.path.join(scratch_folder, 'job_list.txt')
+    with open(job_list, 'w') as open_file:
+        for script_file in script_files:
+            open_file.write(script_file + '\n')
+    return job_list
+
+
+def write_pbs_array_file(config,
+                         job_list,
+                         scratch_folder):
+    """Write the submit script of a PBS/Torque job array.
+
+    Each array task runs the job script in line (PBS_ARRAYID + JOB_OFFSET
+    + 1) of the job list.
+    """
+    process_name = '{dataset_number}_{step_name}'.format(**config)
+    log_dir = os.path.join(scratch_folder, 'logs')
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    nodes = 'nodes=1:ppn={}'.format(get_step_resource(config, 'cpus', 1))
+    gpus = get_step_resource(config, 'gpus', 0)
+    if gpus > 0:
+        nodes += ':gpus={}'.format(gpus)
+    memory = get_step_resource(config, 'memory', '1gb')
+    walltime = get_step_resource(config, 'walltime', 1)
+
+    lines = []
+    lines.append('#!/bin/bash')
+    lines.append('#PBS -N {}'.format(process_name))
+    lines.append('#PBS -l {}'.format(nodes))
+    lines.append('#PBS -l mem={}'.format(memory))
+    lines.append('#PBS -l walltime={}:00:00'.format(walltime))
+    lines.append('#PBS -o {}'.format(log_dir))
+    lines.append('#PBS -e {}'.format(log_dir))
+    if 'pbs_queue' in config.keys():
+        lines.append('#PBS -q {}'.format(config['pbs_queue']))
+    lines.append('JOB_INDEX=$((PBS_ARRAYID + ${JOB_OFFSET:-0}))')
+    lines.append('SCRIPT_FILE=$(sed -n "$((JOB_INDEX + 1))p" {})'.format(
+        job_list))
+    lines.append("echo 'Array task '$PBS_ARRAYID' runs '$SCRIPT_FILE")
+    lines.append('$SCRIPT_FILE')
+    lines.append('exit $?')
+
+    array_file = os.path.join(scratch_folder, 'job_array.sh')
+    with open(array_file, 'w') as open_file:
+        for line in lines:
+            open_file.write(line + '\n')
+    st = os.stat(array_file)
+    os.chmod(array_file, st.st_mode | stat.S_IEXEC)
+    return array_file
+
+
 def create_pbs_files(config,
                      script_files,
                      run_numbers,
                      scratch_folder):
-    pass
+    """Create job arrays that process all runs of a step.
+
+    Instead of one submission per run, the runs are submitted as job
+    arrays of at most 'pbs_max_array_size' tasks. 'pbs_max_jobs' limits
+    the number of tasks of an array running at the same time.
+    """
+    if len(script_files) == 0:
+        click.echo('No jobs to submit!')
+        return
+    job_list = write_pbs_job_list(script_files, scratch_folder)
+    array_file = write_pbs_array_file(config, job_list, scratch_folder)
+
+    if 'pbs_max_array_size' in config.keys():
+        max_array_size = config['pbs_max_array_size']
+    else:
+        max_array_size = 10000
+    if 'pbs_max_jobs' in config.keys():
+        slot_limit = '%{}'.format(config['pbs_max_jobs'])
+    else:
+        slot_limit = ''
+
+    lines = []
+    for offset in range(0, len(script_files), max_array_size):
+        n_tasks = min(max_array_size, len(script_files) - offset)
+        lines.append('qsub -t 0-{}{} -v JOB_OFFSET={} {}'.format(
+            n_tasks - 1, slot_limit, offset, array_file))
+
+    run_script = os.path.join(scratch_folder, 'start_pbs.sh')
+    with open(run_script, 'w') as open_file:
+        for line in lines:
+            open_file.write(line + '\n')
+    st = os.stat(run_script)
+    os.chmod(run_script, st.st_mode | stat.S_IEXEC)
 
 
 @click.command()
@@ -53,9 +53,9 @@ else
     ICETRAY_RC=$?
     echo 'IceTray finished with Exit Code: ' $ICETRAY_RC
     if [ $ICETRAY_RC -eq 0 ] || [ $KEEP_CRASHED_FILES -eq 1 ]; then
-        cp *.i3.bz2 {output_folder}
+        cp *{file_extension} {output_folder}
     fi
-    rm *.i3.bz2
+    rm *{file_extension}
 fi
 exit $ICETRAY_RC
 
@@ -1,57 +1,517 @@
 import os
+import re
 import subprocess
 import glob
 import signal
+import select
+import fcntl
 import sys
 import copy
+import time
+import multiprocessing
+from collections import namedtuple, OrderedDict
 
 import click
+import yaml
+
+
+# conversion of memory units to MB
+MEMORY_UNITS = {'k': 1. / 1024, '': 1., 'm': 1., 'g': 1024., 't': 1024.**2}
+
+JobResources = namedtuple('JobResources', ['cpus', 'memory', 'gpus'])
+
+
+def parse_memory(memory):
+    """Convert a memory requirement to MB.
+
+    Parameters
+    ----------
+    memory : str or int or float
+        The memory requirement, e.g. '6gb' or '500MB'. Plain numbers are
+        interpreted as MB, as done by HTCondor.
+
+    Returns
+    -------
+    float
+        The memory in MB.
+
+    Raises
+    ------
+    ValueError
+        If the memory requirement can not be parsed.
+    """
+    if isinstance(memory, (int, float)):
+        return float(memory)
+    match = re.match(r'^\s*([0-9.]+)\s*([kmgt]?)b?\s*$', str(memory).lower())
+    if match is None:
+        raise ValueError('Can not parse memory requirement {!r}'.format(
+            memory))
+    value, unit = match.groups()
+    return float(value) * MEMORY_UNITS[unit]
+
+
+def get_physical_memory():
+    """Get the physical memory of this machine in MB.
+
+    Returns
+    -------
+    float or None
+        The physical memory or None if it can not be determined.
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / \
+            1024.**2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_step_resources(config):
+    """Get the resources requested for the step of a config.
+
+    Missing values default to 1 cpu, 1gb of memory and no gpus as for the
+    batch systems.
+
+    Parameters
+    ----------
+    config : dict
+        The config of the step as written by simulation_scripts.py.
+
+    Returns
+    -------
+    JobResources
+        The requested resources.
+    """
+    resources_cfg = config.get('resources', None) or {}
+    step = config.get('step', None)
+
+    def lookup(kind, default):
+        values = resources_cfg.get(kind, None)
+        if values is not None and values.get(step, None) is not None:
+            return values[step]
+        return default
+
+    return JobResources(cpus=int(lookup('cpus', 1)),
+                        memory=parse_memory(lookup('memory', '1gb')),
+                        gpus=int(lookup('gpus', 0)))
+
+
+class ResourcePool(object):
+
+    """Book keeping of the cpus, memory and gpus available to local jobs.
+
+    Parameters
+    ----------
+    cpus : int
+        Number of cpu cores.
+    memory : float, optional
+        Memory in MB. If None, memory is not limited.
+    gpus : list of str, optional
+        Ids of the gpus. Jobs get their gpus via CUDA_VISIBLE_DEVICES.
+        If no gpus are given, gpu requests are ignored and the environment
+        of the jobs is not changed.
+    """
+
+    def __init__(self, cpus, memory=None, gpus=None):
+        self.cpus = cpus
+        self.memory = memory
+        self.gpus = list(gpus) if gpus is not None else []
+        self.free_cpus = cpus
+        self.free_memory = memory
+        self.free_gpus = list(self.gpus)
+
+    def __str__(self):
+        if self.memory is None:
+            memory = 'unlimited'
+        else:
+            memory = '{:.0f}MB'.format(self.memory)
+        return '{} cpus, {} memory, gpus: [{}]'.format(
+            self.cpus, memory, ','.join(self.gpus))
+
+    def clip(self, resources):
+        """Limit requested resources to the total resources of the pool.
+
+        A job requesting more than the pool has is run alone instead of
+        never being started.
+
+        Parameters
+        ----------
+        resources : JobResources
+            The requested resources.
+
+        Returns
+        -------
+        JobResources
+            The resources that will be reserved for the job.
+        """
+        memory = resources.memory
+        if self.memory is not None:
+            memory = min(memory, self.memory)
+        return JobResources(cpus=min(resources.cpus, self.cpus),
+                            memory=memory,
+                            gpus=min(resources.gpus, len(self.gpus)))
+
+    def fits(self, resources):
+        if resources.cpus > self.free_cpus:
+            return False
+        if self.free_memory is not None and \
+                resources.memory > self.free_memory:
+            return False
+        return resources.gpus <= len(self.free_gpus)
+
+    def acquire(self, resources):
+        """Reserve resources for a job.
+
+        Parameters
+        ----------
+        resources : JobResources
+            The resources to reserve.
+
+        Returns
+        -------
+        list of str
+            The ids of the reserved gpus.
+        """
+        self.free_cpus -= resources.cpus
+        if self.free_memory is not None:
+            self.free_memory -= resources.memory
+        gpu_ids = self.free_gpus[:resources.gpus]
+        del self.free_gpus[:resources.gpus]
+        return gpu_ids
+
+    def release(self, resources, gpu_ids):
+        self.free_cpus += resources.cpus
+        if self.free_memory is not None:
+            self.free_memory += resources.memory
+        self.free_gpus.extend(gpu_ids)
+
+
+def get_exit_code(status):
+    """Get the exit code from a wait status.
+
+    Parameters
+    ----------
+    status : int
+        The status as returned by os.wait.
+
+    Returns
+    -------
+    int
+        The exit code of the process or the negative signal number, if the
+        process was killed by a signal.
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class JobJournal(object):
+
+    """Append-only journal of the job states.
+
+    Every state change of a job is appended as a line:
+
+        queued;<job>
+        start;<job>;<start time>
+        exit;<job>;<exit code>;<wall time in s>;<peak rss in MB>
+
+    Every entry is flushed immediately, so it survives if the processing
+    itself is killed. Syncing to disk is done in batches: if the machine
+    crashes, at most the entries since the last sync are lost.
+
+    Parameters
+    ----------
+    path : str
+        Path to the journal file.
+    sync_interval : float, optional
+        Minimum time in seconds between two syncs.
+    sync_entries : int, optional
+        Number of entries after which the journal is synced regardless of
+        the sync interval.
+    """
+
+    n_fields = {'queued': 2, 'start': 3, 'exit': 5}
+
+    def __init__(self, path, sync_interval=5., sync_entries=100):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.sync_entries = sync_entries
+        self._file = None
+        self._n_unsynced = 0
+        self._last_sync = time.time()
+
+    def _write(self, *fields):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(';'.join([str(f) for f in fields]) + '\n')
+        self._file.flush()
+        self._n_unsynced += 1
+        if self._n_unsynced >= self.sync_entries:
+            self.sync(force=True)
+
+    def record_queued(self, job):
+        self._write('queued', job)
+
+    def record_start(self, job, start_time):
+        self._write('start', job, '{:.3f}'.format(start_time))
+
+    def record_exit(self, job, exit_code, wall_time=None, max_rss=None):
+        if wall_time is not None:
+            wall_time = '{:.3f}'.format(wall_time)
+        if max_rss is not None:
+            max_rss = '{:.1f}'.format(max_rss)
+        self._write('exit', job, exit_code, wall_time, max_rss)
+
+    def sync(self, force=False):
+        """Write the journal to disk.
+
+        Parameters
+        ----------
+        force : bool, optional
+            If True, sync even if the sync interval has not passed yet.
+        """
+        if self._n_unsynced == 0:
+            return
+        if not force and time.time() - self._last_sync < self.sync_interval:
+            return
+        os.fsync(self._file.fileno())
+        self._n_unsynced = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        self.sync(force=True)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @classmethod
+    def is_journal(cls, path):
+        """Check if a file is a journal or an old style resume file.
+        """
+        with open(path) as f:
+            first_line = f.readline()
+        return first_line.split(';')[0] in cls.n_fields
+
+    @classmethod
+    def read(cls, path):
+        """Rebuild the job states from a journal.
+
+        The last entry of a job determines its state. An incomplete last
+        line, e.g. from a crash during writing, is ignored.
+
+        Parameters
+        ----------
+        path : str
+            Path to the journal file.
+
+        Returns
+        -------
+        OrderedDict
+            The exit code of each job as a string. Jobs that did not
+            finish have an empty exit code.
+        """
+        exit_codes = OrderedDict()
+        with open(path) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                fields = line[:-1].split(';')
+                if cls.n_fields.get(fields[0], None) != len(fields):
+                    continue
+                if fields[0] == 'exit':
+                    exit_codes[fields[1]] = fields[2]
+                else:
+                    exit_codes[fields[1]] = ''
+        return exit_codes
 
 
 class JobLogBook(object):
-    def __init__(self, n_jobs=1, log_dir=None):
+    def __init__(self, n_jobs=1, log_dir=None, resource_pool=None):
         self.log_dir = log_dir
+        if log_dir is not None:
+            self.journal = JobJournal(os.path.join(log_dir, 'journal.txt'))
+        else:
+            self.journal = None
         self.logbook = {}
         self.n_jobs = n_jobs
+        self.resource_pool = resource_pool
         self.running_pid = []
         self.n_finished = 0
         self.log = []
         self._original_sigint = None
+        self._configs = {}
+        self._sigchld_pipe = None
 
     def process(self, binaries):
         self.__binaries = copy.copy(binaries)
         click.echo('Processing {} with max. {} parralel jobs!'.format(
             len(binaries), self.n_jobs))
+        if self.resource_pool is not None:
+            click.echo('Available resources: {}'.format(self.resource_pool))
+
+        pending = []
+        for job in binaries:
+            if os.path.isfile(job) and os.access(job, os.X_OK):
+                pending.append((job, self.__get_resources__(job)))
+                if self.journal is not None:
+                    self.journal.record_queued(job)
+            else:
+                click.echo('{} is not executable! (Skipped)'.format(job))
+                self.n_finished += 1
+                self.log.append([job, 'not_executable'])
+                self.__binaries.remove(job)
+                if self.journal is not None:
+                    self.journal.record_exit(job, 'not_executable')
 
+        self.__register_sigchld__()
         with click.progressbar(length=len(binaries)) as bar:
             bar.update(self.n_finished)
-            for i, job in enumerate(binaries):
-                if os.path.isfile(job) and os.access(job, os.X_OK):
-                    self.__start_subprocess__(job)
-                else:
-                    click.echo('{} is not executable! (Skipped)'.format(job))
-                    self.n_finished += 1
-                    self.log.append([job, 'not_executable'])
-                    del self.__binaries[i]
-                if len(self.running_pid) >= self.n_jobs:
-                    self.__wait__(bar)
+            while len(pending) > 0:
+                pending = self.__start_pending__(pending)
+                if len(pending) > 0:
+                    self.__wait_for_children__(bar)
             click.echo('\nAll Jobs started. Wait for last jobs to finish!')
             while len(self.running_pid) > 0:
-                self.__wait__(bar)
-            bar.update(self.n_finished)
+                self.__wait_for_children__(bar)
         click.echo('Finished!')
         if self.log_dir is not None:
+            self.journal.close()
             self.__store__()
 
+    def __get_resources__(self, job):
+        """Get the resources a job script requests.
+
+        The resources are read from the config that is passed to the step
+        inside the job script.
+
+        Parameters
+        ----------
+        job : str
+            Path to the job script.
+
+        Returns
+        -------
+        JobResources or None
+            The resources to reserve. None if no resource pool is used.
+        """
+        if self.resource_pool is None:
+            return None
+        config = {}
+        with open(job) as f:
+            content = f.read()
+        for config_file in re.findall(r'(\S+\.ya?ml)\b', content):
+            if config_file not in self._configs:
+                if not os.path.isfile(config_file):
+                    continue
+                with open(config_file) as stream:
+                    if int(yaml.__version__[0]) < 5:
+                        # backwards compatibility for yaml versions before
+                        # version 5
+                        self._configs[config_file] = yaml.load(stream)
+                    else:
+                        self._configs[config_file] = yaml.full_load(stream)
+            config = self._configs[config_file]
+            break
+        resources = get_step_resources(config)
+        if resources.gpus > 0 and len(self.resource_pool.gpus) == 0:
+            click.echo('{} requests {} gpus, but no gpus are '
+                       'available!'.format(job, resources.gpus))
+        return self.resource_pool.clip(resources)
+
+    def __start_pending__(self, pending):
+        """Start all pending jobs for which there are enough resources.
+
+        Jobs are started in order. Later jobs may be started before an
+        earlier one, if the earlier one has to wait for resources.
+
+        Parameters
+        ----------
+        pending : list of tuple
+            The pending jobs and their resources.
+
+        Returns
+        -------
+        list of tuple
+            The jobs that are still pending.
+        """
+        still_pending = []
+        for job, resources in pending:
+            if len(self.running_pid) < self.n_jobs and (
+                    resources is None or self.resource_pool.fits(resources)):
+                self.__start_subprocess__(job, resources)
+            else:
+                still_pending.append((job, resources))
+        return still_pending
+
+    def __register_sigchld__(self):
+        """Wake up __wait_for_children__ whenever a child terminates.
+
+        The signal handler writes to a pipe, so that no termination is
+        missed between reaping the children and waiting for the next one.
+        """
+        if self._sigchld_pipe is not None:
+            return
+        self._sigchld_pipe = os.pipe()
+        for fd in self._sigchld_pipe:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        def wake_up(signum, frame):
+            try:
+                os.write(self._sigchld_pipe[1], b'x')
+            except OSError:
+                pass
+
+        signal.signal(signal.SIGCHLD, wake_up)
+
+    def __wait_for_children__(self, progressbar=None, timeout=1.):
+        read_fd = self._sigchld_pipe[0]
+        try:
+            select.select([read_fd], [], [], timeout)
+        except (select.error, OSError):
+            # interrupted by a signal
+            pass
+        try:
+            while os.read(read_fd, 1024):
+                pass
+        except OSError:
+            pass
+        self.__reap__(progressbar)
+        if self.journal is not None:
+            self.journal.sync()
+
+    def __reap__(self, progressbar=None):
+        """Collect all finished jobs without blocking.
+        """
+        while len(self.running_pid) > 0:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except OSError:
+                break
+            if pid == 0:
+                break
+            if pid in self.logbook:
+                self.__finish_job__(pid, status, rusage, progressbar)
+
     def __wait__(self, progressbar=None):
         try:
-            pid, exit_code = os.wait()
+            pid, status, rusage = os.wait4(-1, 0)
         except OSError:
-            pid, exit_code = os.wait()
+            pid, status, rusage = os.wait4(-1, 0)
+        self.__finish_job__(pid, status, rusage, progressbar)
+
+    def __finish_job__(self, pid, status, rusage=None, progressbar=None):
         job_file = self.logbook[pid][1]
+        exit_code = get_exit_code(status)
         click.echo('\n{} finished with exit code {}'.format(
             job_file, exit_code))
         self.log.append([job_file, exit_code])
+        if self.journal is not None:
+            wall_time = time.time() - self.logbook[pid][5]
+            max_rss = None
+            if rusage is not None:
+                # ru_maxrss is given in kB on linux
+                max_rss = rusage.ru_maxrss / 1024.
+            self.journal.record_exit(job_file, exit_code, wall_time, max_rss)
         self.n_finished += 1
         self.__clear_job__(pid)
         if progressbar is not None:
@@ -63,6 +523,8 @@ class JobLogBook(object):
         def exit_with_pid_term(signum, frame):
             for pid in self.running_pid:
                 os.kill(pid, signal.SIGINT)
+            if self.journal is not None:
+                self.journal.close()
             sys.exit(1)
 
         signal.signal(signal.SIGINT, exit_with_pid_term)
@@ -74,6 +536,8 @@ class JobLogBook(object):
                 self.__wait__()
             except OSError:
                 break
+        if self.journal is not None:
+            self.journal.close()
         if save:
             self.__store__()
 
@@ -88,15 +552,25 @@ class JobLogBook(object):
             for job in unfinished_jobs:
                 f.write("{};\n".format(job))
 
-    def resume(self, resume_file):
-        with open(resume_file) as f:
-            content = f.readlines()
-        content = [c.strip() for c in content]
-        retry = click.confirm('Retry failed jobs?')
+    def resume(self, resume_file, retry=False):
+        """Process all jobs that did not finish in a previous processing.
+
+        Parameters
+        ----------
+        resume_file : str
+            The journal or resume.txt of the previous processing.
+        retry : bool, optional
+            If True, failed jobs are processed again.
+        """
+        if JobJournal.is_journal(resume_file):
+            content = JobJournal.read(resume_file).items()
+        else:
+            with open(resume_file) as f:
+                content = [c.strip().split(';') for c in f.readlines()]
         binaries = []
         for c in content:
             try:
-                job, exit_code = c.split(';')
+                job, exit_code = c
             except ValueError:
                 raise ValueError('{} can be resumed!'.format(resume_file))
             if retry:
@@ -110,26 +584,42 @@ class JobLogBook(object):
         else:
             click.echo('Nothing to do!')
 
-    def __start_subprocess__(self, job):
+    def __start_subprocess__(self, job, resources=None):
         job_name = os.path.basename(os.path.splitext(job)[0])
         if self.log_dir is not None:
             log_path = os.path.join(self.log_dir, '{}.log'.format(job_name))
             log_file = open(log_path, 'w')
         else:
             log_file = open(os.devnull, 'w')
+        env = None
+        gpu_ids = []
+        if resources is not None:
+            gpu_ids = self.resource_pool.acquire(resources)
+            if len(self.resource_pool.gpus) > 0:
+                env = dict(os.environ)
+                env['CUDA_VISIBLE_DEVICES'] = ','.join(gpu_ids)
+        start_time = time.time()
         sub_process = subprocess.Popen([job],
                                        stdout=log_file,
                                        stderr=subprocess.STDOUT,
+                                       env=env,
                                        preexec_fn=os.setpgrp)
+        if self.journal is not None:
+            self.journal.record_start(job, start_time)
         self.logbook[sub_process.pid] = [sub_process,
                                          job,
-                                         log_file]
+                                         log_file,
+                                         resources,
+                                         gpu_ids,
+                                         start_time]
         self.running_pid.append(sub_process.pid)
         return sub_process.pid
 
     def __clear_job__(self, pid):
-        sub_process, job, log_file = self.logbook[pid]
+        sub_process, job, log_file, resources, gpu_ids, _ = self.logbook[pid]
         self.running_pid.remove(pid)
+        if resources is not None:
+            self.resource_pool.release(resources, gpu_ids)
         if self.log_dir is not None:
             log_file.close()
         del self.logbook[pid]
@@ -167,17 +657,45 @@ class JobLogBook(object):
 @click.option('-l', '--log_path', default=None,
               type=click.Path(resolve_path=True),
               help='Path to a dir where the stdout/stderr should be saved')
-@click.option('--resume/--no-resume', default=False)
-def main(path, binary_pattern, n_jobs, log_path, resume):
+@click.option('--resume/--no-resume', default=False,
+              help='Resume from the journal.txt (or resume.txt) given as '
+                   'path or found in the directory given as path')
+@click.option('--retry_failed/--no-retry_failed', default=False,
+              help='Process failed jobs again when resuming')
+@click.option('--cpus', default=None, type=int,
+              help='Number of cpu cores the jobs may use. '
+                   'Default: all cores')
+@click.option('--memory', default=None,
+              help='Memory the jobs may use, e.g. 32gb. '
+                   'Default: physical memory')
+@click.option('--gpus', default=None,
+              help='Comma separated ids of the gpus the jobs may use. '
+                   'Default: $CUDA_VISIBLE_DEVICES')
+def main(path, binary_pattern, n_jobs, log_path, resume, retry_failed,
+         cpus, memory, gpus):
     path = os.path.abspath(path)
 
-    log_book = JobLogBook(n_jobs=n_jobs, log_dir=log_path)
+    if cpus is None:
+        cpus = multiprocessing.cpu_count()
+    if memory is None:
+        memory = get_physical_memory()
+    else:
+        memory = parse_memory(memory)
+    if gpus is None:
+        gpus = os.environ.get('CUDA_VISIBLE_DEVICES', '')
+    gpus = [gpu.strip() for gpu in gpus.split(',') if gpu.strip() != '']
+    resource_pool = ResourcePool(cpus=cpus, memory=memory, gpus=gpus)
+
+    log_book = JobLogBook(n_jobs=n_jobs, log_dir=log_path,
+                          resource_pool=resource_pool)
     log_book.register_sigint()
     click.echo('Starting processing!')
     if resume:
+        if os.path.isdir(path):
+            path = os.path.join(path, 'journal.txt')
         click.echo('Resuming {} with max. {} parralel jobs!'.format(
             path, n_jobs))
-        log_book.resume(path)
+        log_book.resume(path, retry=retry_failed)
     else:
         binaries = list(glob.glob(os.path.join(path, binary_pattern)))
         log_book.process(binaries)
@@ -12,5 +12,6 @@ setup(
         [console_scripts]
         simulation_scripts_write=simulation_scripts:main
         simulation_scripts_process=process_local:main
+        simulation_scripts_worker=worker:main
     ''',
 )
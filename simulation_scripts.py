@@ -1,13 +1,24 @@
 import os
+import copy
 import stat
 import string
+from multiprocessing.pool import ThreadPool
 
 import click
 import yaml
 import getpass
 
 from batch_processing import create_pbs_files, create_dagman_files
-from steps.utils import get_run_folder
+from batch_processing import create_dagman_chain_files
+from process_local import parse_memory
+from steps.utils import get_run_folder, get_compression, set_compression
+from steps.utils import split_file_extension
+
+try:
+    from os import scandir
+except ImportError:
+    # python 2
+    scandir = None
 
 #from batch_processing import adjust_resources
 
@@ -33,6 +44,126 @@ class DefaultDict(dict):
         return self.default_value
 
 
+def scan_folder(folder, need_stat=False):
+    """List the files in a folder.
+
+    Parameters
+    ----------
+    folder : str
+        The folder to scan.
+    need_stat : bool, optional
+        If True, size and modification time of the files are obtained.
+
+    Returns
+    -------
+    dict
+        Maps the file names to (size, mtime). Size and mtime are None if
+        need_stat is False. Empty if the folder does not exist.
+    """
+    files = {}
+    if scandir is None:
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            return files
+        for name in names:
+            path = os.path.join(folder, name)
+            if need_stat:
+                st = os.stat(path)
+                if stat.S_ISREG(st.st_mode):
+                    files[name] = (st.st_size, st.st_mtime)
+            elif os.path.isfile(path):
+                files[name] = (None, None)
+        return files
+
+    try:
+        entries = scandir(folder)
+    except OSError:
+        return files
+    try:
+        for entry in entries:
+            if entry.is_file():
+                if need_stat:
+                    st = entry.stat()
+                    files[entry.name] = (st.st_size, st.st_mtime)
+                else:
+                    files[entry.name] = (None, None)
+    finally:
+        # the iterator only supports the context manager since python 3.6
+        if hasattr(entries, 'close'):
+            entries.close()
+    return files
+
+
+class OutputIndex(object):
+
+    """In-memory index of the existing output files.
+
+    Every folder is listed once instead of checking every file
+    separately. The folders are scanned in parallel.
+
+    Parameters
+    ----------
+    folders : list of str
+        The folders to scan.
+    min_size : int, optional
+        Minimum size in bytes a file must have to count as existing.
+    min_mtime : float, optional
+        Minimum modification time (unix time) a file must have to count
+        as existing.
+    n_threads : int, optional
+        Number of folders that are scanned in parallel.
+    """
+
+    def __init__(self, folders, min_size=None, min_mtime=None,
+                 n_threads=16):
+        self.min_size = min_size
+        self.min_mtime = min_mtime
+        need_stat = min_size is not None or min_mtime is not None
+
+        folders = sorted(set(folders))
+        self.folders = {}
+        if len(folders) > 0:
+            pool = ThreadPool(max(1, min(n_threads, len(folders))))
+            try:
+                scanned = pool.map(lambda f: scan_folder(f, need_stat),
+                                   folders)
+            finally:
+                pool.close()
+            self.folders = dict(zip(folders, scanned))
+
+    def folder_exists(self, folder):
+        """Check if a folder existed during the scan.
+
+        Only folders that contain at least one file are known.
+        """
+        return len(self.folders.get(folder, {})) > 0
+
+    def exists(self, path):
+        """Check if a file exists and passes the size and mtime checks.
+
+        Parameters
+        ----------
+        path : str
+            Path to the file.
+
+        Returns
+        -------
+        bool
+            True if the file exists.
+        """
+        folder, name = os.path.split(path)
+        files = self.folders.get(folder, {})
+        if name not in files:
+            return False
+        size, mtime = files[name]
+        if self.min_size is not None and size < self.min_size:
+            return False
+        if self.min_mtime is not None and mtime < self.min_mtime:
+            return False
+        return True
+
+
 def fetch_chain(chain_name):
     processing_chains_f = os.path.join(SCRIPT_FOLDER, 'processing_chains.yaml')
     with open(processing_chains_f, 'r') as stream:
@@ -57,7 +188,208 @@ def fetch_chain(chain_name):
             if not os.path.isabs(template):
                 job_template_enum[k] = os.path.join(SCRIPT_FOLDER, template)
         step_enum = chain_definition['steps']
-    return step_enum, default_config, job_template_enum
+        if 'fused' in chain_definition:
+            fused_groups = get_fused_groups(chain_definition['fused'],
+                                            step_enum)
+        else:
+            fused_groups = []
+    return step_enum, default_config, job_template_enum, fused_groups
+
+
+def get_previous_step(step, step_enum):
+    """Get the step whose output is the input of a step.
+
+    Processing chain can implement different branches. These branches
+    can be defined by using step numbers greater than 9. If the previous
+    step is defined in the processing chain, then the files will be used
+    as input. If it does not exist, files form step % 10 -1 will be used,
+    unless step % 10 is zero.
+
+    Parameters
+    ----------
+    step : int
+        The step.
+    step_enum : dict
+        The steps of the processing chain.
+
+    Returns
+    -------
+    int
+        The previous step.
+    """
+    if step % 10 == 0:
+        # the branch does not have any previous input
+        previous_step = (step % 10) - 1
+
+    else:
+        # the branch can have previous input
+        previous_step = step - 1
+        if previous_step not in step_enum:
+            previous_step = (step % 10) - 1
+    return previous_step
+
+
+def parse_steps(steps, step_enum):
+    """Parse a selection of steps.
+
+    Parameters
+    ----------
+    steps : str or int
+        Comma separated steps or ranges of steps, e.g. '1', '0-5' or
+        '0-3,13'. A range includes all steps of the chain within the range.
+    step_enum : dict
+        The steps of the processing chain.
+
+    Returns
+    -------
+    list of int
+        The sorted steps.
+    """
+    selected = set()
+    for part in str(steps).split(','):
+        try:
+            if '-' in part:
+                start, stop = [int(p) for p in part.split('-')]
+                in_range = [s for s in step_enum if start <= s <= stop]
+                if len(in_range) == 0:
+                    raise click.BadParameter(
+                        'No steps in range {!r}'.format(part))
+                selected.update(in_range)
+            else:
+                selected.add(int(part))
+        except ValueError:
+            raise click.BadParameter('Can not parse steps {!r}'.format(steps))
+    for step in selected:
+        if step not in step_enum:
+            raise click.BadParameter(
+                'Step {} is not part of the chain'.format(step))
+    return sorted(selected)
+
+
+def get_fused_groups(fused, step_enum):
+    """Parse the groups of steps that can be run in a single job.
+
+    Parameters
+    ----------
+    fused : list of str
+        The groups of steps, e.g. ['0-3'].
+    step_enum : dict
+        The steps of the processing chain.
+
+    Returns
+    -------
+    list of list of int
+        The steps of each group.
+
+    Raises
+    ------
+    ValueError
+        If the steps of a group do not process each others output.
+    """
+    fused_groups = []
+    for group in fused:
+        steps = parse_steps(group, step_enum)
+        for previous_step, step in zip(steps[:-1], steps[1:]):
+            if get_previous_step(step, step_enum) != previous_step:
+                raise ValueError(
+                    'Fused steps {!r}: step {} does not process the output '
+                    'of step {}'.format(group, step, previous_step))
+        if len(steps) > 1:
+            fused_groups.append(steps)
+    return fused_groups
+
+
+def build_fused_config(configs, side_outputs=None):
+    """Build the config of a job running several steps at once.
+
+    The job runs steps/fused_steps.py, which passes the frames of every
+    step to the next one through a pipe. The output of the job is the
+    output of the last step. Each step is started by a launcher script
+    rendered from its own job template. Memory and cpus of the steps add
+    up, as all steps run at the same time.
+
+    Parameters
+    ----------
+    configs : list of dict
+        The configs of the steps in processing order.
+    side_outputs : list of int, optional
+        Steps whose output is written in addition to the steps listed
+        in 'fused_side_outputs' of the config.
+
+    Returns
+    -------
+    dict
+        The config of the fused job.
+    """
+    first_config = configs[0]
+    config = copy.deepcopy(configs[-1])
+    config['previous_step'] = first_config['previous_step']
+    config['previous_step_name'] = first_config['previous_step_name']
+    config['infile_pattern'] = first_config['infile_pattern']
+    config['fused_steps'] = [{'step': c['step'],
+                              'step_name': c['step_name'],
+                              'yaml_copy': c['yaml_copy']} for c in configs]
+    config['fused_name'] = 'fused_steps_{}_{}'.format(
+        first_config['step'], config['step'])
+    config['step_name'] = 'fused_steps'
+    fused_side_outputs = set(config.get('fused_side_outputs', None) or [])
+    fused_side_outputs.update(side_outputs or [])
+    config['fused_side_outputs'] = sorted(
+        [c['step'] for c in configs[:-1] if c['step'] in fused_side_outputs])
+    config['script_name'] = config['fused_name'] + \
+        '{name_addition}_{run_number}.sh'
+
+    # every step is run through its own job template, which sets up the
+    # environment of the step. The run dependent values are passed by
+    # steps/fused_steps.py as environment variables.
+    launcher_folder = os.path.join(config['processing_folder'], 'fused')
+    if not os.path.isdir(launcher_folder):
+        os.makedirs(launcher_folder)
+    for c, fused_step in zip(configs, config['fused_steps']):
+        with open(c['job_template']) as f:
+            template = f.read()
+        launcher_config = SafeDict(c)
+        launcher_config.update({
+            'yaml_copy': '"$FUSED_STEP_YAML"',
+            'final_out': '"$FUSED_STEP_OUTPUT"',
+            'output_folder': '"$FUSED_OUTPUT_FOLDER"',
+            'run_number': '${FUSED_RUN_NUMBER}'})
+        launcher = os.path.join(launcher_folder, '{}_step_{}.sh'.format(
+            config['fused_name'], c['step']))
+        with open(launcher, 'w') as f:
+            f.write(string.Formatter().vformat(template, (), launcher_config))
+        fused_step['launcher'] = launcher
+
+    # the template of a GPU step sets up the GPU environment of the job
+    resources = config['resources']
+    for c in configs:
+        gpus = resources.get('gpus', None) or {}
+        if gpus.get(c['step'], 0) > 0:
+            config['job_template'] = c['job_template']
+            break
+
+    def combine(kind, func):
+        values = resources.get(kind, None) or {}
+        values = [values[c['step']] for c in configs
+                  if values.get(c['step'], None) is not None]
+        if len(values) > 0:
+            if resources.get(kind, None) is None:
+                resources[kind] = {}
+            resources[kind][config['step']] = func(values)
+
+    combine('gpus', max)
+    combine('cpus', sum)
+    combine('walltime', max)
+    combine('memory', lambda values: '{:d}mb'.format(
+        int(sum([parse_memory(v) for v in values]))))
+
+    outfile = 'fused_{}_{}_{}'.format(first_config['step'],
+                                      config['step'],
+                                      os.path.basename(config['yaml_copy']))
+    config['yaml_copy'] = os.path.join(config['processing_folder'], outfile)
+    with open(config['yaml_copy'], 'w') as yaml_copy:
+        yaml.dump(dict(config), yaml_copy, default_flow_style=False)
+    return config
 
 
 def create_filename(cfg, input=False):
@@ -68,17 +400,22 @@ def create_filename(cfg, input=False):
         cfg['step'] = cfg['previous_step']
         filename = cfg['output_pattern'].format(**cfg)
         full_path = os.path.join(cfg['input_folder'], filename)
+        compression = get_compression(cfg)
         cfg['step_name'] = step_name
         cfg['step'] = step
     else:
         filename = cfg['output_pattern'].format(**cfg)
         full_path = os.path.join(cfg['output_folder'], filename)
+        compression = get_compression(cfg)
+    full_path = set_compression(full_path, compression)
     full_path = full_path.replace(' ', '0')
     return full_path
 
 
 def write_job_files(config, step, check_existing=False,
-                    run_start=None, run_stop=None):
+                    run_start=None, run_stop=None,
+                    min_file_size=None, min_file_mtime=None,
+                    write_scripts=True):
     with open(config['job_template']) as f:
         template = f.read()
     output_base = os.path.join(config['processing_folder'], 'jobs')
@@ -104,19 +441,39 @@ def write_job_files(config, step, check_existing=False,
         if run_start >= run_stop or run_stop > config['n_runs']:
             raise ValueError('run_stop is out of range: {!r}'.format(run_stop))
 
+    final_outs = []
     for i in range(run_start, run_stop):
         config['run_number'] = i
         config['run_folder'] = get_run_folder(i)
         final_out = config['outfile_pattern'].format(**config)
-        final_out = final_out.replace(' ', '0')
+        final_outs.append(final_out.replace(' ', '0'))
+
+    output_index = None
+    if check_existing:
+        output_index = OutputIndex(
+            [os.path.dirname(final_out) for final_out in final_outs],
+            min_size=min_file_size,
+            min_mtime=min_file_mtime)
+    existing_folders = set()
+
+    for i, final_out in zip(range(run_start, run_stop), final_outs):
+        config['run_number'] = i
+        config['run_folder'] = get_run_folder(i)
         config['final_out'] = final_out
         if check_existing:
-            if os.path.isfile(config['final_out']):
+            if output_index.exists(final_out):
                 continue
         output_folder = os.path.dirname(final_out)
-        if not os.path.isdir(output_folder):
-            os.makedirs(output_folder)
+        if output_folder not in existing_folders:
+            if output_index is None or \
+                    not output_index.folder_exists(output_folder):
+                if not os.path.isdir(output_folder):
+                    os.makedirs(output_folder)
+            existing_folders.add(output_folder)
         config['output_folder'] = output_folder
+        run_numbers.append(i)
+        if not write_scripts:
+            continue
         file_config = string.Formatter().vformat(template, (), config)
         script_name = string.Formatter().vformat(
             config['script_name'], (), config)
@@ -126,10 +483,138 @@ def write_job_files(config, step, check_existing=False,
         st = os.stat(script_path)
         os.chmod(script_path, st.st_mode | stat.S_IEXEC)
         scripts.append(script_path)
-        run_numbers.append(i)
     return scripts, run_numbers
 
 
+def get_bundle_resources(config, runs_per_job, parallel_runs=1):
+    """Get the resources of a job that processes a bundle of runs.
+
+    The cpus, memory and gpus of the step are requested for each run that
+    is processed in parallel, the walltime for each round of parallel
+    runs. Missing cpus and memory default to 1 cpu and 1gb per run as for
+    the batch systems.
+
+    Parameters
+    ----------
+    config : dict
+        The config of the step.
+    runs_per_job : int
+        Maximum number of runs per bundle.
+    parallel_runs : int, optional
+        Number of runs of a bundle that are processed in parallel.
+
+    Returns
+    -------
+    dict
+        The resources of the config with the values of the step scaled.
+    """
+    parallel_runs = max(min(parallel_runs, runs_per_job), 1)
+    n_rounds = (runs_per_job + parallel_runs - 1) // parallel_runs
+    resources = copy.deepcopy(config.get('resources', None) or {})
+    step = config['step']
+
+    def scale(kind, default, func):
+        values = resources.get(kind, None) or {}
+        if values.get(step, None) is None:
+            if default is None:
+                return
+            values[step] = default
+        values[step] = func(values[step])
+        resources[kind] = values
+
+    scale('cpus', 1, lambda value: int(value) * parallel_runs)
+    scale('gpus', None, lambda value: int(value) * parallel_runs)
+    scale('memory', '1gb', lambda value: '{:d}mb'.format(
+        int(parse_memory(value) * parallel_runs)))
+    scale('walltime', None, lambda value: value * n_rounds)
+    return resources
+
+
+def write_bundle_files(config, run_numbers, runs_per_job, parallel_runs=1):
+    """Write jobs that each process a bundle of runs.
+
+    A bundle job is rendered from the job template of the step, so the
+    environment is set up once per bundle. It runs steps/bundled_runs.py,
+    which processes the runs with at most parallel_runs workers (see
+    worker.py) that import the step once. Each run still writes its own
+    output, so that failed runs can be resumed individually. The exit
+    code of every run is appended to a status file in the log dir.
+    The bundle job fails if any of its runs fails. The resources of the
+    bundle job (see get_bundle_resources) are written to the bundle yaml,
+    from which process_local.py reads them.
+
+    Parameters
+    ----------
+    config : dict
+        The config of the step with the resources of a bundle job.
+    run_numbers : list of int
+        The run numbers.
+    runs_per_job : int
+        Maximum number of runs per bundle.
+    parallel_runs : int, optional
+        Number of runs of a bundle that are processed in parallel.
+
+    Returns
+    -------
+    list of str
+        The bundle job scripts.
+    list of int
+        The first run number of each bundle.
+    list of list of int
+        The run numbers of each bundle.
+    """
+    with open(config['job_template']) as f:
+        template = f.read()
+    output_base = os.path.join(config['processing_folder'], 'bundles')
+    if not os.path.isdir(output_base):
+        os.makedirs(output_base)
+    log_dir = os.path.join(config['processing_folder'], 'logs')
+
+    bundle_files = []
+    bundle_run_numbers = []
+    bundle_runs = []
+    for start in range(0, len(run_numbers), runs_per_job):
+        runs = run_numbers[start:start + runs_per_job]
+        bundle_name = '{}{}_bundle_{}_{}'.format(
+            config['step_name'], config['name_addition'], runs[0], runs[-1])
+
+        bundle_yaml = os.path.join(output_base, bundle_name + '.yaml')
+        with open(bundle_yaml, 'w') as f:
+            yaml.dump({
+                'bundle_step_name': config['step_name'],
+                'bundle_yaml_copy': config['yaml_copy'],
+                'bundle_runs': list(runs),
+                'bundle_parallel_runs': parallel_runs,
+                'bundle_log_prefix': os.path.join(log_dir, bundle_name),
+                'bundle_status_file': os.path.join(
+                    log_dir, bundle_name + '.status'),
+                'step': config['step'],
+                'resources': config['resources']},
+                f, default_flow_style=False)
+
+        bundle_config = SafeDict(config)
+        bundle_config['run_number'] = runs[0]
+        bundle_config['run_folder'] = get_run_folder(runs[0])
+        bundle_config['final_out'] = config['outfile_pattern'].format(
+            **bundle_config).replace(' ', '0')
+        bundle_config['output_folder'] = os.path.dirname(
+            bundle_config['final_out'])
+        bundle_config['step_name'] = 'bundled_runs'
+        bundle_config['yaml_copy'] = bundle_yaml
+        # the workers delete the outputs of failed runs
+        bundle_config['keep_crashed_files'] = 1
+
+        bundle_file = os.path.join(output_base, bundle_name + '.sh')
+        with open(bundle_file, 'w') as f:
+            f.write(string.Formatter().vformat(template, (), bundle_config))
+        st = os.stat(bundle_file)
+        os.chmod(bundle_file, st.st_mode | stat.S_IEXEC)
+        bundle_files.append(bundle_file)
+        bundle_run_numbers.append(runs[0])
+        bundle_runs.append(runs)
+    return bundle_files, bundle_run_numbers, bundle_runs
+
+
 def build_config(data_folder, custom_settings):
     if data_folder is None:
         default = '/data/user/{}/simulation_scripts/'.format(getpass.getuser())
@@ -169,14 +654,26 @@ def build_config(data_folder, custom_settings):
               help='Write/Not write files to start dagman process.')
 @click.option('--pbs/--no-pbs', default=False,
               help='Write/Not write files to start processing on a pbs system')
-@click.option('--step', '-s', default=1,
-              help='0=upto clsim\n1 = clsim\n2 =upto L2')
+@click.option('--step', '-s', default='1',
+              help='0=upto clsim\n1 = clsim\n2 =upto L2\n'
+                   'A range like 0-5 or 1-3,13 writes a single DAG in '
+                   'which every run starts after its previous step.')
 @click.option('--resume/--no-resume', default=False,
               help='Resume processing -> check for existing output')
+@click.option('--resume_min_size', default=None, type=int,
+              help='With --resume, existing output files smaller than this '
+                   'many bytes are processed again.')
+@click.option('--resume_min_mtime', default=None, type=float,
+              help='With --resume, existing output files last modified '
+                   'before this unix time are processed again.')
 @click.option('--run_start', default=None, type=int,
               help='Only process runs starting with this number.')
 @click.option('--run_stop', default=None, type=int,
               help='Only process runs up to this number.')
+@click.option('--fused/--no-fused', default=False,
+              help='Run the groups of steps marked as fused in the '
+                   'processing chain in a single job, if all steps of a '
+                   'group are selected.')
 def main(data_folder,
          config_file,
          processing_scratch,
@@ -184,99 +681,187 @@ def main(data_folder,
          pbs,
          dagman,
          resume,
+         resume_min_size,
+         resume_min_mtime,
          run_start,
-         run_stop):
+         run_stop,
+         fused):
     config_file = click.format_filename(config_file)
     with open(config_file, 'r') as stream:
         custom_settings = SafeDict(yaml.full_load(stream))
     chain_name = custom_settings['chain_name']
     click.echo('Initialized {} chain!'.format(chain_name))
-    step_enum, default_config, job_template_enum = fetch_chain(chain_name)
-
-    # Processing chain can implement different branches. These branches
-    # can be defined by using step numbers greater than 9. If the previous
-    # step is defined in the processing chain, then the files will be used
-    # as input. If it does not exist, files form step % 10 -1 will be used,
-    # unless step % 10 is zero.
-    if step % 10 == 0:
-        # the branch does not have any previous input
-        previous_step = (step % 10) - 1
-
-    else:
-        # the branch can have previous input
-        previous_step = step - 1
-        if previous_step not in step_enum:
-            previous_step = (step % 10) - 1
-    previous_step_name = step_enum.get(previous_step, None)
-
-    custom_settings.update({
-        'step': step,
-        'step_name': step_enum[step],
-        'job_template': job_template_enum[step],
-        'previous_step_name': previous_step_name,
-        'previous_step': previous_step})
-
-    if 'outfile_pattern' in custom_settings.keys():
-        click.echo('Building config for next step based on provided config!')
-        config = custom_settings
-        config['infile_pattern'] = config['outfile_pattern']
-        step = config['step'] + 1
-        config.update({
+    step_enum, default_config, job_template_enum, fused_groups = \
+        fetch_chain(chain_name)
+
+    steps = parse_steps(step, step_enum)
+    if len(steps) > 1 and 'outfile_pattern' in custom_settings.keys():
+        raise click.UsageError(
+            'A range of steps can only be used with a config from scratch!')
+
+    # fused groups whose steps are all selected
+    fused_group = {}
+    if fused:
+        for group in fused_groups:
+            if set(group) <= set(steps):
+                for s in group:
+                    fused_group[s] = tuple(group)
+    fused_configs = {}
+
+    step_jobs = []
+    for step in steps:
+        step_settings = copy.deepcopy(custom_settings)
+        previous_step = get_previous_step(step, step_enum)
+        previous_step_name = step_enum.get(previous_step, None)
+
+        step_settings.update({
             'step': step,
             'step_name': step_enum[step],
-            'previous_step_name': previous_step_name})
-        if 'processing_scratch' in config.keys():
-            processing_scratch = config['processing_scratch']
-    else:
-        click.echo('Building config from scratch!')
-        custom_settings['default_config'] = default_config
-        config = build_config(data_folder, custom_settings)
-        config['infile_pattern'] = create_filename(config, input=True)
-
-    config['processing_folder'] = PROCESSING_FOLDER.format(**config)
-    config['outfile_pattern'] = create_filename(config)
-    config['scratchfile_pattern'] = os.path.basename(config['outfile_pattern'])
-    config['script_name'] = '{step_name}{name_addition}_{run_number}.sh'
-    if not os.path.isdir(config['processing_folder']):
-        os.makedirs(config['processing_folder'])
-
-    outfile = os.path.basename(os.path.join(config_file))
-    filled_yaml = os.path.join(config['processing_folder'], outfile)
-    config['yaml_copy'] = filled_yaml
-    with open(config['yaml_copy'], 'w') as yaml_copy:
-        yaml.dump(dict(config), yaml_copy, default_flow_style=False)
-
-    if dagman or pbs:
-        if processing_scratch is None:
-            default = '/scratch/{}/simulation_scripts'.format(
-                getpass.getuser())
-            processing_scratch = click.prompt(
-                'Please enter a processing scrath:',
-                default=default)
-        config['processing_scratch'] = os.path.abspath(processing_scratch)
-
-    script_files, run_numbers = write_job_files(config, step,
-                                                check_existing=resume,
-                                                run_start=run_start,
-                                                run_stop=run_stop)
+            'job_template': job_template_enum[step],
+            'previous_step_name': previous_step_name,
+            'previous_step': previous_step})
+
+        if 'outfile_pattern' in step_settings.keys():
+            click.echo(
+                'Building config for next step based on provided config!')
+            config = step_settings
+            config['infile_pattern'] = config['outfile_pattern']
+            step = config['step'] + 1
+            config.update({
+                'step': step,
+                'step_name': step_enum[step],
+                'previous_step_name': previous_step_name})
+            if 'processing_scratch' in config.keys():
+                processing_scratch = config['processing_scratch']
+        else:
+            click.echo('Building config from scratch for step {}!'.format(
+                step))
+            step_settings['default_config'] = default_config
+            config = build_config(data_folder, step_settings)
+            config['infile_pattern'] = create_filename(config, input=True)
+            data_folder = config['data_folder']
+
+        config['processing_folder'] = PROCESSING_FOLDER.format(**config)
+        config['outfile_pattern'] = create_filename(config)
+        config['scratchfile_pattern'] = os.path.basename(
+            config['outfile_pattern'])
+        # used by the job templates to stage the output
+        config['file_extension'] = split_file_extension(
+            config['outfile_pattern'])[1] or '.i3.bz2'
+        config['script_name'] = '{step_name}{name_addition}_{run_number}.sh'
+        if not os.path.isdir(config['processing_folder']):
+            os.makedirs(config['processing_folder'])
+
+        outfile = os.path.basename(os.path.join(config_file))
+        filled_yaml = os.path.join(config['processing_folder'], outfile)
+        config['yaml_copy'] = filled_yaml
+        with open(config['yaml_copy'], 'w') as yaml_copy:
+            yaml.dump(dict(config), yaml_copy, default_flow_style=False)
+
+        if dagman or pbs:
+            if processing_scratch is None:
+                default = '/scratch/{}/simulation_scripts'.format(
+                    getpass.getuser())
+                processing_scratch = click.prompt(
+                    'Please enter a processing scrath:',
+                    default=default)
+            config['processing_scratch'] = os.path.abspath(processing_scratch)
+
+        if step in fused_group:
+            group = fused_group[step]
+            fused_configs.setdefault(group, {})[step] = config
+            if len(fused_configs[group]) < len(group):
+                continue
+            configs = [fused_configs[group][s] for s in group]
+            if config.get('distance_splits', None):
+                # the photon propagation reads one file per distance
+                # split, which can not be passed through a pipe
+                for c in configs:
+                    if ('photon_propagation' in c['step_name'] or
+                            'snowstorm_propagation' in c['step_name']):
+                        raise click.UsageError(
+                            'Steps with distance splits can not be fused, '
+                            'use --no-fused!')
+            # outputs needed by selected steps outside of the group
+            side_outputs = [get_previous_step(s, step_enum) for s in steps
+                            if s not in group]
+            config = build_fused_config(configs, side_outputs)
+            click.echo('Fusing steps {} into a single job!'.format(
+                ', '.join([str(s) for s in group])))
+            if len(config['fused_side_outputs']) > 0:
+                click.echo('Writing output of fused steps {}'.format(
+                    ', '.join([str(s) for s in config['fused_side_outputs']])))
+
+        # bundled runs are processed by bundle jobs instead of
+        # per-run job scripts
+        bundle_runs = ('runs_per_job' in config.keys() and
+                       config['runs_per_job'] > 1)
+        script_files, run_numbers = write_job_files(
+            config, step,
+            check_existing=resume,
+            run_start=run_start,
+            run_stop=run_stop,
+            min_file_size=resume_min_size,
+            min_file_mtime=resume_min_mtime,
+            write_scripts=not bundle_runs)
+        job_runs = [[i] for i in run_numbers]
+
+        if bundle_runs:
+            if 'parallel_runs_per_job' in config.keys():
+                parallel_runs = config['parallel_runs_per_job']
+            else:
+                parallel_runs = 1
+            # the batch systems and process_local.py request the
+            # resources of the whole bundle for each job
+            config = copy.copy(config)
+            config['resources'] = get_bundle_resources(
+                config, config['runs_per_job'], parallel_runs)
+            script_files, run_numbers, job_runs = write_bundle_files(
+                config, run_numbers,
+                runs_per_job=config['runs_per_job'],
+                parallel_runs=parallel_runs)
+
+        step_jobs.append((config, script_files, run_numbers, job_runs))
 
     if dagman or pbs:
-        scratch_subfolder = '{dataset_number}_{step_name}'.format(**config)
-        scratch_folder = os.path.join(config['processing_scratch'],
-                                      scratch_subfolder)
-        if not os.path.isdir(scratch_folder):
-            os.makedirs(scratch_folder)
-        if dagman:
+        scratch_folders = []
+        for config, _, _, _ in step_jobs:
+            scratch_subfolder = '{}_{}'.format(
+                config['dataset_number'],
+                config.get('fused_name', config['step_name']))
+            scratch_folder = os.path.join(config['processing_scratch'],
+                                          scratch_subfolder)
+            if not os.path.isdir(scratch_folder):
+                os.makedirs(scratch_folder)
+            scratch_folders.append(scratch_folder)
+
+        if dagman and len(step_jobs) > 1:
+            # one DAG for all steps in which each run waits for the
+            # previous step of the same run
+            config = step_jobs[0][0]
+            chain_subfolder = '{}_steps_{}'.format(
+                config['dataset_number'],
+                '_'.join([str(s) for s in steps]))
+            chain_folder = os.path.join(config['processing_scratch'],
+                                        chain_subfolder)
+            if not os.path.isdir(chain_folder):
+                os.makedirs(chain_folder)
+            create_dagman_chain_files(step_jobs,
+                                      scratch_folders,
+                                      chain_folder)
+        elif dagman:
+            config, script_files, run_numbers, _ = step_jobs[0]
             create_dagman_files(config,
                                 script_files,
                                 run_numbers,
-                                scratch_folder)
+                                scratch_folders[0])
         if pbs:
-            create_pbs_files(config,
-                             script_files,
-                             run_numbers,
-                             scratch_folder)
-
+            for (config, script_files, run_numbers, _), scratch_folder in zip(
+                    step_jobs, scratch_folders):
+                create_pbs_files(config,
+                                 script_files,
+                                 run_numbers,
+                                 scratch_folder)
 
 if __name__ == '__main__':
     main()
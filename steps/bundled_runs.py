@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+'''Process a bundle of runs of a step in a single job.
+
+The job template of the step sets up the environment once for the whole
+bundle. The runs are put into a RunQueue from which at most
+'bundle_parallel_runs' workers (see worker.py) take them. Every worker
+imports the step once and keeps cached services, e.g. the GCD file,
+between its runs. A worker takes the next run as soon as it has finished
+one. The outputs are written directly to their final location.
+
+The exit code of every run is appended to the status file of the bundle.
+Runs that were not finished by a worker get the exit code -1.
+'''
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+import click
+import yaml
+
+STEP_FOLDER = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_FOLDER = os.path.dirname(STEP_FOLDER)
+if SCRIPT_FOLDER not in sys.path:
+    sys.path.insert(0, SCRIPT_FOLDER)
+
+from worker import RunQueue
+
+
+def load_config(path):
+    with open(path, 'r') as stream:
+        if int(yaml.__version__[0]) < 5:
+            # backwards compatibility for yaml versions before version 5
+            return yaml.load(stream)
+        else:
+            return yaml.full_load(stream)
+
+
+@click.command()
+@click.argument('cfg', type=click.Path(exists=True))
+@click.argument('run_number', type=int)
+@click.option('--scratch/--no-scratch', default=True)
+def main(cfg, run_number, scratch):
+    cfg = load_config(cfg)
+    runs = cfg['bundle_runs']
+    n_workers = max(min(int(cfg['bundle_parallel_runs']), len(runs)), 1)
+
+    if scratch:
+        queue_dir = tempfile.mkdtemp(prefix='bundle_', dir=os.getcwd())
+    else:
+        queue_dir = tempfile.mkdtemp(prefix='bundle_')
+    workers = []
+    try:
+        queue = RunQueue(queue_dir)
+        for run in runs:
+            queue.put(run)
+
+        click.echo('Processing {} runs with {} workers'.format(len(runs),
+                                                               n_workers))
+        for i in range(n_workers):
+            log_file = '{}_worker_{}.log'.format(cfg['bundle_log_prefix'], i)
+            with open(log_file, 'w') as log:
+                proc = subprocess.Popen(
+                    [sys.executable, os.path.join(SCRIPT_FOLDER, 'worker.py'),
+                     'run', cfg['bundle_step_name'], cfg['bundle_yaml_copy'],
+                     queue_dir],
+                    stdout=log, stderr=subprocess.STDOUT)
+            workers.append(proc)
+        for proc in workers:
+            proc.wait()
+
+        exit_codes = dict([(run, -1) for run in runs])
+        exit_codes.update(queue.get_exit_codes())
+    finally:
+        for proc in workers:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        shutil.rmtree(queue_dir, ignore_errors=True)
+
+    with open(cfg['bundle_status_file'], 'a') as status_file:
+        for run in runs:
+            status_file.write('{};{}\n'.format(run, exit_codes[run]))
+    n_failed = len([run for run in runs if exit_codes[run] != 0])
+    click.echo('{} of {} runs failed'.format(n_failed, len(runs)))
+    if n_failed > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,17 @@
+import heapq
 import warnings
 import numpy as np
+from scipy.spatial import cKDTree
 
 from icecube import phys_services, icetray, dataclasses, MuonGun
 
+from utils import split_file_extension
+from resources.gcd_cache import get_geometry_table
+
+
+# index of an event in the generated order, used to merge the streams
+EVENT_INDEX_KEY = 'MCOversizeEventIndex'
+
 
 def get_numu_particles(frame, numu):
     particles = []
@@ -50,9 +59,50 @@ def get_muon_v_stop(frame, muon):
             # meter is saved in Ef: 
             # Ef = - length [meter]
                 v_stop = muon.pos + muon.dir * muon.length
+    if v_stop is None:
+        return None
     return np.array(v_stop)
 
 
+def get_line_range_in_box(v_pos, v_dir, box_min, box_max,
+                          t_min=-np.inf, t_max=np.inf):
+    '''Get the range of t for which v_pos + t * v_dir is inside of an axis
+    aligned box.
+
+    Parameters
+    ----------
+    v_pos : array-like shape=(3,)
+        A point of the line.
+    v_dir : array-like shape=(3,)
+        Directional vector of the line.
+    box_min : array-like shape=(3,)
+        Lower corner of the box.
+    box_max : array-like shape=(3,)
+        Upper corner of the box.
+    t_min : float, optional
+        Only consider the part of the line after t_min.
+    t_max : float, optional
+        Only consider the part of the line before t_max.
+
+    Returns
+    -------
+    t_range : tuple of float or None
+        (t_0, t_1) or None if the line does not intersect with the box.
+    '''
+    for pos_i, dir_i, min_i, max_i in zip(v_pos, v_dir, box_min, box_max):
+        if dir_i == 0:
+            if pos_i < min_i or pos_i > max_i:
+                return None
+        else:
+            t_0 = (min_i - pos_i) / dir_i
+            t_1 = (max_i - pos_i) / dir_i
+            t_min = max(t_min, min(t_0, t_1))
+            t_max = min(t_max, max(t_0, t_1))
+    if t_min > t_max:
+        return None
+    return t_min, t_max
+
+
 class OversizeStream(object):
     def __init__(self,
                  distance_cut,
@@ -142,8 +192,8 @@ class OversizeStream(object):
         return self.__str__()
 
     def transform_filepath(self, filepath):
-        return filepath.replace('i3.bz2',
-                                '{}.i3.bz2'.format(self.file_addition))
+        base, extension = split_file_extension(filepath)
+        return '{}.{}{}'.format(base, self.file_addition, extension)
 
       
 def generate_stream_object(cut_distances, dom_limits, oversize_factors):
@@ -204,6 +254,10 @@ class OversizeSplitterNSplits(icetray.I3ConditionalModule):
                           'Specify type of simulation. Currently available '
                           '["muongun", "numu", "nue"]',
                           'muongun')
+        self.AddParameter('GCDFile',
+                          'GCD file whose cached geometry table is used. If '
+                          'None, the geometry of the G frame is used.',
+                          None)
 
     def Configure(self):
         self.stream_objects = generate_stream_object(
@@ -217,6 +271,11 @@ class OversizeSplitterNSplits(icetray.I3ConditionalModule):
             self.thresholds[i] = stream_i.distance_cut
             self.lim_doms[i] = stream_i.dom_limit
             self.oversize_factors[i] = stream_i.oversize_factor
+        self.stream_indices = np.arange(len(self.stream_objects))
+
+        # If every stream requires a single DOM, a stream is selected if the
+        # closest DOM of any particle is within its distance cut
+        self.single_dom_limits = bool(np.all(self.lim_doms == 1.))
 
         self.simulation_type = self.GetParameter('simulaton_type').lower()
         if self.simulation_type not in self.supported_simulations:
@@ -229,15 +288,33 @@ class OversizeSplitterNSplits(icetray.I3ConditionalModule):
         else:
             self.default_idx = None
 
-            self.relevance_dist = self.GetParameter('relevance_dist')
+        self.relevance_dist = self.GetParameter('relevance_dist')
+        self.event_index = 0
+
+        # DOMs further away than this are irrelevant for all decisions
+        self.query_dist = max(np.max(self.thresholds), 0.)
+        if self.relevance_dist is not None:
+            self.query_dist = max(self.query_dist, self.relevance_dist)
+
+        self.gcd_file = self.GetParameter('GCDFile')
+        if self.gcd_file is not None:
+            self.set_dom_positions(get_geometry_table(self.gcd_file)['pos'])
 
         self.Register(self.S_stream, self.SFrame)
 
+    def set_dom_positions(self, dom_positions):
+        self.dom_positions = dom_positions
+        self.dom_tree = cKDTree(self.dom_positions)
+        self.dom_box_min = np.min(self.dom_positions, axis=0) - self.query_dist
+        self.dom_box_max = np.max(self.dom_positions, axis=0) + self.query_dist
+
     def Geometry(self, frame):
-        omgeo = frame['I3Geometry'].omgeo
-        self.dom_positions = np.zeros((len(omgeo), 3))
-        for i, (_, om) in enumerate(omgeo.iteritems()):
-            self.dom_positions[i, :] = np.array(om.position)
+        if self.gcd_file is None:
+            omgeo = frame['I3Geometry'].omgeo
+            dom_positions = np.zeros((len(omgeo), 3))
+            for i, (_, om) in enumerate(omgeo.iteritems()):
+                dom_positions[i, :] = np.array(om.position)
+            self.set_dom_positions(dom_positions)
         self.PushFrame(frame)
 
     def SFrame(self, frame):
@@ -251,35 +328,118 @@ class OversizeSplitterNSplits(icetray.I3ConditionalModule):
                 self.oversize_factors)
         self.PushFrame(frame)
 
+    def get_close_doms(self, v_pos, v_dir=None, t_min=-np.inf,
+                       t_max=np.inf):
+        """Get indices of DOMs that might be within query_dist.
+
+        Parameters
+        ----------
+        v_pos : array-like shape=(3,)
+            Position of a point or point of a line.
+        v_dir : array-like shape=(3,), optional
+            Normalized direction of the line. If None, DOMs around the
+            point v_pos are searched.
+        t_min : float, optional
+            Start of the line segment: v_pos + t_min * v_dir.
+        t_max : float, optional
+            End of the line segment: v_pos + t_max * v_dir.
+
+        Returns
+        -------
+        array-like shape=(n_doms,)
+            Indices of the DOMs. All DOMs within query_dist of the point or
+            line segment are included, but further DOMs might be included
+            as well.
+        """
+        no_doms = np.array([], dtype=int)
+        if self.query_dist <= 0:
+            return no_doms
+        if v_dir is None:
+            return np.asarray(
+                self.dom_tree.query_ball_point(v_pos, self.query_dist),
+                dtype=int)
+
+        # the closest point on the line of a relevant DOM is within the
+        # bounding box of all DOMs extended by query_dist
+        t_range = get_line_range_in_box(v_pos, v_dir,
+                                        self.dom_box_min, self.dom_box_max,
+                                        t_min=t_min, t_max=t_max)
+        if t_range is None:
+            return no_doms
+
+        # Query balls along the segment with a spacing of at most
+        # query_dist. Every point of the segment is then within
+        # query_dist / 2 of a ball center.
+        n_points = int(np.ceil((t_range[1] - t_range[0]) /
+                               self.query_dist)) + 1
+        t_s = np.linspace(t_range[0], t_range[1], n_points)
+        points = v_pos + t_s[:, np.newaxis] * v_dir
+        indices = self.dom_tree.query_ball_point(
+            points, self.query_dist * np.sqrt(1.25))
+        return np.unique(np.concatenate(
+            [no_doms] + [np.asarray(idx, dtype=int) for idx in indices]))
+
     def get_distances(self,
                       frame,
                       particle,
                       check_starting=False,
                       check_stopping=False):
+        """Get distances of the DOMs close to a particle.
+
+        Only DOMs that might be within query_dist are considered. Counts of
+        DOMs closer than any threshold or the relevance distance are
+        therefore the same as for the distances of all DOMs.
+
+        Parameters
+        ----------
+        frame : I3Frame
+            The current I3Frame.
+        particle : I3Particle
+            The particle. Hadrons are treated as points, muons as lines.
+        check_starting : bool, optional
+            Use the distance to the vertex for DOMs behind the muon vertex.
+        check_stopping : bool, optional
+            Use the distance to the stopping point for DOMs after the stopping
+            point of the muon.
+
+        Returns
+        -------
+        array-like shape=(n_doms,)
+            Distances of the close DOMs.
+        """
         v_dir = np.array([particle.dir.x, particle.dir.y, particle.dir.z])
         v_pos = np.array(particle.pos)
         if particle.type == particle.Hadrons:
-            v_pos = np.array(particle.pos)
-            return np.linalg.norm(v_pos - self.dom_positions, axis=1)
+            dom_positions = self.dom_positions[self.get_close_doms(v_pos)]
+            return np.linalg.norm(v_pos - dom_positions, axis=1)
         elif particle.type in [particle.MuMinus, particle.MuPlus]:
+            t_min = -np.inf
+            t_max = np.inf
+            if check_starting:
+                t_min = 0.
+            if check_stopping:
+                v_stop = get_muon_v_stop(frame, particle)
+                if v_stop is not None:
+                    t_max = np.dot(v_stop - v_pos, v_dir)
+            dom_positions = self.dom_positions[
+                self.get_close_doms(v_pos, v_dir, t_min=t_min, t_max=t_max)]
             distances = np.linalg.norm(
-                np.cross(v_dir,v_pos - self.dom_positions),
+                np.cross(v_dir, v_pos - dom_positions),
                 axis=1)
             if check_starting:
                 is_infront = is_infront_of_point(v_dir,
                                                  v_pos,
-                                                 self.dom_positions)
+                                                 dom_positions)
                 distances[~is_infront] = np.linalg.norm(
-                    v_pos - self.dom_positions[~is_infront, :],
+                    v_pos - dom_positions[~is_infront, :],
                     axis=1)
             if check_stopping:
-                v_stop = get_muon_v_stop(frame, particle)
                 if v_stop is not None:
                     is_infront = is_infront_of_point(v_dir,
                                                      v_stop,
-                                                     self.dom_positions)
+                                                     dom_positions)
                     distances[is_infront] = np.linalg.norm(
-                        v_stop - self.dom_positions[is_infront, :],
+                        v_stop - dom_positions[is_infront, :],
                         axis=1)
         return distances
 
@@ -297,44 +457,165 @@ class OversizeSplitterNSplits(icetray.I3ConditionalModule):
             check_starting = True
             check_stopping = True
 
-        stream_list = []
-        for p in particle_list:
+        n_particles = len(particle_list)
+        passes_cut = np.zeros((n_particles, len(self.stream_objects)),
+                              dtype=bool)
+        for j, p in enumerate(particle_list):
             distances = self.get_distances(
                 frame,
                 p,
                 check_starting=check_starting,
                 check_stopping=check_stopping)
 
+            if self.single_dom_limits:
+                if len(distances) > 0:
+                    passes_cut[j] = np.min(distances) < self.thresholds
+                continue
+
+            # number of DOMs closer than each threshold
+            distances = np.sort(distances)
+            n_close_doms = np.searchsorted(distances, self.thresholds)
+
             if self.relevance_dist is not None:
-                n_relevant_doms = distances < self.relevance_dist
+                n_relevant_doms = np.searchsorted(distances,
+                                                  self.relevance_dist)
             else:
                 n_relevant_doms = self.dom_positions.shape[0]
-
-            for i, stream_i in enumerate(self.stream_objects):
-                if stream_i.dom_limit < 1.:
-                    limit_i = n_relevant_doms * stream_i.dom_limit
-                else:
-                    limit_i = stream_i.dom_limit
-                if np.sum(distances < stream_i.distance_cut) >= limit_i:
-                    stream_list.append(stream_i)
+            limits = np.where(self.lim_doms < 1.,
+                              n_relevant_doms * self.lim_doms,
+                              self.lim_doms)
+            passes_cut[j] = n_close_doms >= limits
+
+        # first particle for which the stream passed
+        is_candidate = np.any(passes_cut, axis=0)
+        first_particle = np.zeros(len(self.stream_objects), dtype=int)
+        if n_particles > 0:
+            first_particle = np.argmax(passes_cut, axis=0)
             if self.default_idx is not None:
-                stream_list.append(self.stream_objects[self.default_idx])
+                is_candidate[self.default_idx] = True
+                first_particle[self.default_idx] = 0
 
+        # select the candidate with the lowest oversize factor. Ties are
+        # resolved by the order in which the candidates were found.
         selected_stream = None
-        lowest_oversize = None
-        for i, stream_i in enumerate(stream_list):
-            if lowest_oversize is None:
-                lowest_oversize = stream_i.oversize_factor
-                selected_stream = stream_i
-            else:
-                if stream_i.oversize_factor < lowest_oversize:
-                    selected_stream = stream_i
-                    lowest_oversize = stream_i.oversize_factor
+        if np.any(is_candidate):
+            candidates = self.stream_indices[is_candidate]
+            order = np.lexsort((candidates,
+                                first_particle[candidates],
+                                self.oversize_factors[candidates]))
+            selected_stream = self.stream_objects[candidates[order[0]]]
 
         for stream_i in self.stream_objects:
             if stream_i is selected_stream:
                 frame[stream_i.stream_name] = icetray.I3Bool(True)
             else:
                 frame[stream_i.stream_name] = icetray.I3Bool(False)
+        frame[EVENT_INDEX_KEY] = icetray.I3Int(self.event_index)
+        self.event_index += 1
         self.PushFrame(frame)
 
+
+def get_order_key(frame):
+    """Get the position of an event in the generated order.
+
+    Parameters
+    ----------
+    frame : I3Frame
+        The Q frame of the event.
+
+    Returns
+    -------
+    tuple or None
+        The index stamped by the OversizeSplitterNSplits or run and event
+        id of the event header. None if the frame has neither.
+    """
+    if EVENT_INDEX_KEY in frame:
+        return (frame[EVENT_INDEX_KEY].value,)
+    elif 'I3EventHeader' in frame:
+        header = frame['I3EventHeader']
+        return (header.run_id, header.event_id)
+    return None
+
+
+def iter_events(i3file):
+    """Group the frames of a file by event.
+
+    An event consists of the frames before its Q frame, the Q frame and
+    the following P frames.
+
+    Parameters
+    ----------
+    i3file : I3File
+        The file.
+
+    Yields
+    ------
+    tuple or None
+        The order key of the event. None for the frames after the last
+        event.
+    list of I3Frame
+        The frames.
+    """
+    frames = []
+    has_q_frame = False
+    while i3file.more():
+        frame = i3file.pop_frame()
+        if frame.Stop == icetray.I3Frame.DAQ:
+            if has_q_frame:
+                yield get_order_key(q_frame), frames
+                frames = []
+            q_frame = frame
+            has_q_frame = True
+        elif frame.Stop != icetray.I3Frame.Physics and has_q_frame:
+            yield get_order_key(q_frame), frames
+            frames = []
+            has_q_frame = False
+        frames.append(frame)
+    if has_q_frame:
+        yield get_order_key(q_frame), frames
+    elif len(frames) > 0:
+        yield None, frames
+
+
+def iter_merged_events(i3files):
+    """Merge the events of several files in the generated order.
+
+    Events without order key are yielded after the ordered events, file
+    by file.
+
+    Parameters
+    ----------
+    i3files : list of I3File or I3FrameSequence
+        The files, e.g. the distance split streams of a run.
+
+    Yields
+    ------
+    list of I3Frame
+        The frames of an event, see iter_events.
+    """
+    def next_event(i, events):
+        for key, frames in events:
+            if key is None:
+                # unordered frames are sorted after the ordered events
+                # and keep the order of the streams
+                return (1, i, 0), frames, events
+            return (0, key, i), frames, events
+        return None
+
+    heap = []
+    for i, i3file in enumerate(i3files):
+        event = next_event(i, iter_events(i3file))
+        if event is not None:
+            heap.append(event)
+    heapq.heapify(heap)
+
+    while len(heap) > 0:
+        key, frames, events = heapq.heappop(heap)
+        yield frames
+        if key[0] == 1:
+            i = key[1]
+        else:
+            i = key[2]
+        event = next_event(i, events)
+        if event is not None:
+            heapq.heappush(heap, event)
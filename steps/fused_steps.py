@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+'''Run consecutive steps of a processing chain in a single job.
+
+All steps are started at the same time. Each step writes its frames
+uncompressed into a named pipe from which the next step reads, so that
+intermediate files are neither written to disk nor compressed. Every step
+is started by a launcher rendered from its own job template, which sets up
+the environment of the step in a clean environment. The output of the last
+step is written to the scratch folder of the job if requested and staged
+by the job template of the fused job.
+
+Intermediate outputs of steps listed in 'fused_side_outputs' are
+additionally written to their usual location, compressed with the codec
+given by their file extension.
+'''
+import os
+import sys
+import time
+import shutil
+import signal
+import tempfile
+import subprocess
+
+import click
+import yaml
+
+from utils import get_run_folder, get_compress_command
+
+
+# variables passed on to the launchers of the steps. Variables of the
+# batch system are dropped, so that the launchers run without scratch.
+ENVIRONMENT_KEYS = ['HOME', 'USER', 'LOGNAME', 'SHELL', 'TMPDIR', 'LANG',
+                    'TERM', 'HOSTNAME', 'CUDA_VISIBLE_DEVICES']
+DEFAULT_PATH = '/usr/local/bin:/usr/bin:/bin'
+
+
+def load_config(path):
+    with open(path, 'r') as stream:
+        if int(yaml.__version__[0]) < 5:
+            # backwards compatibility for yaml versions before version 5
+            return yaml.load(stream)
+        else:
+            return yaml.full_load(stream)
+
+
+def get_outfile(cfg, run_number):
+    cfg = dict(cfg)
+    cfg['run_number'] = run_number
+    cfg['run_folder'] = get_run_folder(run_number)
+    return cfg['outfile_pattern'].format(**cfg).replace(' ', '0')
+
+
+def start_side_output(in_pipe, out_pipe, side_file):
+    """Copy frames from one pipe to another and into a compressed file.
+
+    The copy is done by tee and the compression tool of the side file in
+    their own process group, see terminate.
+
+    Parameters
+    ----------
+    in_pipe : str
+        The pipe the step writes to.
+    out_pipe : str
+        The pipe the next step reads from.
+    side_file : str
+        Path of the compressed side output.
+
+    Returns
+    -------
+    subprocess.Popen
+        The process. The exit code is non-zero if tee or the compression
+        failed.
+    """
+    side_folder = os.path.dirname(side_file)
+    if side_folder and not os.path.isdir(side_folder):
+        os.makedirs(side_folder)
+    command = 'tee "$1" < "$0" | {} > "$2"'.format(
+        ' '.join(get_compress_command(side_file)))
+    return subprocess.Popen(
+        ['bash', '-o', 'pipefail', '-c', command,
+         in_pipe, out_pipe, side_file],
+        preexec_fn=os.setsid)
+
+
+def get_step_environment(step_yaml, step_output, run_number):
+    env = dict([(k, os.environ[k]) for k in ENVIRONMENT_KEYS
+                if k in os.environ])
+    env['PATH'] = DEFAULT_PATH
+    env['FUSED_STEP_YAML'] = step_yaml
+    env['FUSED_STEP_OUTPUT'] = step_output
+    env['FUSED_OUTPUT_FOLDER'] = os.path.dirname(step_output)
+    env['FUSED_RUN_NUMBER'] = str(run_number)
+    return env
+
+
+def terminate(processes):
+    # the launchers run in their own process group, which includes the
+    # steps started by them
+    for _, proc in processes:
+        if proc.poll() is None:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+    for _, proc in processes:
+        proc.wait()
+
+
+@click.command()
+@click.argument('cfg', type=click.Path(exists=True))
+@click.argument('run_number', type=int)
+@click.option('--scratch/--no-scratch', default=True)
+def main(cfg, run_number, scratch):
+    cfg = load_config(cfg)
+    fused_steps = cfg['fused_steps']
+    side_outputs = cfg.get('fused_side_outputs', None) or []
+    if cfg.get('keep_crashed_files', 0):
+        keep_crashed_files = True
+    else:
+        keep_crashed_files = False
+
+    pipe_dir = tempfile.mkdtemp(prefix='fused_steps_')
+    processes = []
+    side_files = []
+    failed_step = None
+    try:
+        # pipe each step reads its input from
+        in_pipe = None
+        for i, fused_step in enumerate(fused_steps):
+            step_cfg = load_config(fused_step['yaml_copy'])
+            is_last = i == len(fused_steps) - 1
+            if in_pipe is not None:
+                step_cfg['infile_pattern'] = in_pipe
+            out_pipe = None
+            if not is_last:
+                out_pipe = os.path.join(pipe_dir, 'step_{}.i3'.format(
+                    fused_step['step']))
+                os.mkfifo(out_pipe)
+                step_cfg['outfile_pattern'] = out_pipe
+            elif scratch:
+                # the launchers run without scratch, the job template of
+                # the fused job stages the output
+                step_cfg['outfile_pattern'] = step_cfg['scratchfile_pattern']
+            step_output = get_outfile(step_cfg, run_number)
+            step_yaml = os.path.join(pipe_dir, 'step_{}.yaml'.format(
+                fused_step['step']))
+            with open(step_yaml, 'w') as stream:
+                yaml.dump(step_cfg, stream, default_flow_style=False)
+
+            launcher = fused_step['launcher']
+            click.echo('Starting step {}: {}'.format(fused_step['step'],
+                                                     launcher))
+            proc = subprocess.Popen(
+                ['bash', launcher],
+                env=get_step_environment(step_yaml, step_output, run_number),
+                preexec_fn=os.setsid)
+            processes.append(('Step {}'.format(fused_step['step']), proc))
+
+            if out_pipe is not None and fused_step['step'] in side_outputs:
+                side_file = get_outfile(
+                    load_config(fused_step['yaml_copy']), run_number)
+                tee_pipe = os.path.join(pipe_dir, 'step_{}_tee.i3'.format(
+                    fused_step['step']))
+                os.mkfifo(tee_pipe)
+                processes.append((
+                    'Side output of step {}'.format(fused_step['step']),
+                    start_side_output(out_pipe, tee_pipe, side_file)))
+                side_files.append(side_file)
+                click.echo('Writing side output: {}'.format(side_file))
+                out_pipe = tee_pipe
+            in_pipe = out_pipe
+
+        # a failed step or side output leaves its neighbours blocked on
+        # the pipes, so all of them are stopped as soon as one fails
+        while failed_step is None:
+            running = False
+            for name, proc in processes:
+                return_code = proc.poll()
+                if return_code is None:
+                    running = True
+                elif return_code != 0:
+                    failed_step = name
+                    click.echo('{} failed with exit code {}'.format(
+                        name, return_code))
+                    break
+            if not running:
+                break
+            time.sleep(1.)
+    finally:
+        terminate(processes)
+        shutil.rmtree(pipe_dir, ignore_errors=True)
+
+    if failed_step is not None:
+        if not keep_crashed_files:
+            for side_file in side_files:
+                if os.path.isfile(side_file):
+                    click.echo('Deleting partially processed file! {}'.format(
+                        side_file))
+                    os.remove(side_file)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
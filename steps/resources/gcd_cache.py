@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Local cache of GCD files.
+
+GCD files are usually read from /cvmfs and have to be decompressed by
+every step of every run. The cache keeps an uncompressed copy of the
+G, C and D frames and a numpy table of the geometry in a local directory.
+Entries are keyed by the path and the checksum of the GCD file.
+
+The cache directory is given by the environment variable
+SIMULATION_SCRIPTS_GCD_CACHE and defaults to a directory in the system's
+temporary directory.
+'''
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+
+
+# strings of the DeepCore infill
+DEEPCORE_STRINGS = list(range(79, 87))
+
+# frames that are loaded in this process
+_FRAME_CACHE = {}
+
+
+def get_cache_dir():
+    """Get the directory of the GCD cache.
+
+    Returns
+    -------
+    str
+        The cache directory.
+    """
+    if 'SIMULATION_SCRIPTS_GCD_CACHE' in os.environ:
+        cache_dir = os.environ['SIMULATION_SCRIPTS_GCD_CACHE']
+    else:
+        cache_dir = os.path.join(
+            tempfile.gettempdir(),
+            'simulation_scripts_gcd_cache_{}'.format(os.getuid()))
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # created by a concurrent job
+            if not os.path.isdir(cache_dir):
+                raise
+    return cache_dir
+
+
+def _write_atomic(path, write):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        write(tmp_path)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_checksum(gcd_file):
+    """Get the md5 checksum of a GCD file.
+
+    The checksum is stored together with size and modification time of
+    the file, so that the file is only read again if it changes.
+
+    Parameters
+    ----------
+    gcd_file : str
+        Path to the GCD file.
+
+    Returns
+    -------
+    str
+        The checksum.
+    """
+    gcd_file = os.path.abspath(gcd_file)
+    st = os.stat(gcd_file)
+    file_id = '{} {}'.format(st.st_size, st.st_mtime)
+    stamp_file = os.path.join(
+        get_cache_dir(),
+        hashlib.sha1(gcd_file.encode('utf-8')).hexdigest() + '.stamp')
+
+    if os.path.isfile(stamp_file):
+        with open(stamp_file) as f:
+            stamp = f.read().strip()
+        if stamp.startswith(file_id + ' '):
+            return stamp[len(file_id) + 1:]
+
+    md5 = hashlib.md5()
+    with open(gcd_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    checksum = md5.hexdigest()
+
+    def write(path):
+        with open(path, 'w') as f:
+            f.write('{} {}\n'.format(file_id, checksum))
+
+    _write_atomic(stamp_file, write)
+    return checksum
+
+
+def _get_entry(gcd_file):
+    name = os.path.basename(gcd_file)
+    for extension in ['.gz', '.bz2', '.zst', '.i3']:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return os.path.join(get_cache_dir(), '{}_{}'.format(
+        get_checksum(gcd_file), name))
+
+
+def get_cached_gcd_file(gcd_file):
+    """Get the path to an uncompressed local copy of a GCD file.
+
+    The copy is created if it does not exist yet. If the cache can not be
+    used, the original path is returned.
+
+    Parameters
+    ----------
+    gcd_file : str
+        Path to the GCD file.
+
+    Returns
+    -------
+    str
+        Path to the uncompressed copy.
+    """
+    try:
+        cached_file = _get_entry(gcd_file) + '.i3'
+        if not os.path.isfile(cached_file):
+            from icecube import dataio
+
+            def write(path):
+                frames = get_gcd_frames(gcd_file, use_cache=False)
+                out_file = dataio.I3File(path, 'w')
+                for frame in frames:
+                    out_file.push(frame)
+                out_file.close()
+
+            _write_atomic(cached_file, write)
+    except (IOError, OSError) as e:
+        print('GCD cache not available: {}'.format(e))
+        return gcd_file
+    return cached_file
+
+
+def get_gcd_frames(gcd_file, use_cache=True):
+    """Get the frames of a GCD file.
+
+    The frames are only read once per process. Copies of the frames are
+    returned.
+
+    Parameters
+    ----------
+    gcd_file : str
+        Path to the GCD file.
+    use_cache : bool, optional
+        If True, the frames are read from the uncompressed local copy.
+
+    Returns
+    -------
+    list of I3Frame
+        The frames of the GCD file.
+    """
+    from icecube import icetray, dataio
+
+    key = (os.path.abspath(gcd_file), use_cache)
+    if key not in _FRAME_CACHE:
+        if use_cache:
+            path = get_cached_gcd_file(gcd_file)
+        else:
+            path = gcd_file
+        _FRAME_CACHE[key] = list(dataio.I3File(path))
+    # copies, so that modules changing the frames do not alter the cache
+    return [icetray.I3Frame(frame) for frame in _FRAME_CACHE[key]]
+
+
+def get_omgeo(gcd_file):
+    """Get the I3OMGeoMap of a GCD file.
+
+    Parameters
+    ----------
+    gcd_file : str
+        Path to the GCD file.
+
+    Returns
+    -------
+    I3OMGeoMap
+        The geometry of the DOMs.
+    """
+    for frame in get_gcd_frames(gcd_file):
+        if 'I3Geometry' in frame:
+            return frame['I3Geometry'].omgeo
+    raise ValueError('No I3Geometry in {}'.format(gcd_file))
+
+
+def get_geometry_table(gcd_file):
+    """Get the DOM geometry of a GCD file as numpy arrays.
+
+    Parameters
+    ----------
+    gcd_file : str
+        Path to the GCD file.
+
+    Returns
+    -------
+    dict of np.ndarray
+        'string', 'om': The OMKey of each DOM.
+        'pos': The positions of the DOMs, shape (n_doms, 3).
+        'is_deepcore': True for the DOMs on DeepCore strings.
+    """
+    try:
+        table_file = _get_entry(gcd_file) + '.npz'
+    except (IOError, OSError):
+        table_file = None
+
+    if table_file is not None and os.path.isfile(table_file):
+        with np.load(table_file) as table:
+            return dict(table)
+
+    omgeo = get_omgeo(gcd_file)
+    keys = sorted(omgeo.keys())
+    table = {
+        'string': np.array([key.string for key in keys], dtype=int),
+        'om': np.array([key.om for key in keys], dtype=int),
+        'pos': np.array([[omgeo[key].position.x,
+                          omgeo[key].position.y,
+                          omgeo[key].position.z] for key in keys]),
+    }
+    table['is_deepcore'] = np.isin(table['string'], DEEPCORE_STRINGS)
+
+    if table_file is not None:
+        def write(path):
+            with open(path, 'wb') as f:
+                np.savez(f, **table)
+
+        try:
+            _write_atomic(table_file, write)
+        except (IOError, OSError):
+            pass
+    return table
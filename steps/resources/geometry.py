@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 '''Helper functions for geometry calculations.
 '''
+import weakref
+
 import numpy as np
 
 
@@ -56,6 +58,132 @@ def ray_triangle_intersection(ray_near, ray_dir, triangle):
     return t
 
 
+class HullTriangles(object):
+    '''Cached triangle arrays of a convex hull.
+
+    Holds the first vertex, both edge vectors and the (unnormalized) normal
+    of every simplex, so that many rays can be intersected with the hull in
+    a single broadcast Möller–Trumbore pass.
+
+    Parameters
+    ----------
+    convex_hull : scipy.spatial.ConvexHull
+        defining the desired convex volume
+    '''
+    def __init__(self, convex_hull):
+        triangles = np.asarray(convex_hull.points)[convex_hull.simplices]
+        self.v1 = triangles[:, 0]
+        self.edge1 = triangles[:, 1] - self.v1
+        self.edge2 = triangles[:, 2] - self.v1
+        self.normals = np.cross(self.edge1, self.edge2)
+        self.offsets = np.sum(self.v1 * self.normals, axis=1)
+
+    def __len__(self):
+        return len(self.v1)
+
+
+_hull_triangle_cache = weakref.WeakKeyDictionary()
+
+
+def get_hull_triangles(convex_hull):
+    '''Get the cached HullTriangles of a convex hull.
+
+    Parameters
+    ----------
+    convex_hull : scipy.spatial.ConvexHull
+        defining the desired convex volume
+
+    Returns
+    -------
+    hull_triangles : HullTriangles
+        Edge and normal arrays of the hull. They are only computed once
+        per hull object.
+    '''
+    try:
+        return _hull_triangle_cache[convex_hull]
+    except KeyError:
+        hull_triangles = HullTriangles(convex_hull)
+        _hull_triangle_cache[convex_hull] = hull_triangles
+        return hull_triangles
+
+
+def get_intersections_batch(convex_hull, v_pos, v_dir, chunk_size=4096):
+    '''Function to get the entry and exit points of N infinite lines and the
+    convex hull. All line/triangle combinations are evaluated in one
+    vectorized Möller–Trumbore pass. The returned t's are the scaling
+    factors for v_dir to get the intersection points. If t < 0 the
+    intersection is 'behind' v_pos.
+
+    Parameters
+    ----------
+    convex_hull : scipy.spatial.ConvexHull or HullTriangles
+        defining the desired convex volume
+
+    v_pos : array-like shape=(n_rays, 3) or (3,)
+        A point of each line.
+
+    v_dir : array-like shape=(n_rays, 3) or (3,)
+        Directional vector of each line. A single direction is broadcast
+        to all points.
+
+    chunk_size : int, optional (default=4096)
+        Number of lines which are processed at once. Limits the memory
+        usage to O(chunk_size * n_simplices).
+
+    Returns
+    -------
+    t_entry : array-like shape=(n_rays,)
+        Smallest scaling factor of the intersections or np.nan if the line
+        does not intersect with the hull.
+
+    t_exit : array-like shape=(n_rays,)
+        Largest scaling factor of the intersections or np.nan if the line
+        does not intersect with the hull.
+    '''
+    if isinstance(convex_hull, HullTriangles):
+        hull = convex_hull
+    else:
+        hull = get_hull_triangles(convex_hull)
+    v_pos = np.atleast_2d(np.asarray(v_pos, dtype=float))
+    v_dir = np.atleast_2d(np.asarray(v_dir, dtype=float))
+    v_pos, v_dir = np.broadcast_arrays(v_pos, v_dir)
+    n_rays = len(v_pos)
+
+    eps = 0.000001
+    t_entry = np.full(n_rays, np.nan)
+    t_exit = np.full(n_rays, np.nan)
+    for start in range(0, n_rays, chunk_size):
+        stop = min(start + chunk_size, n_rays)
+        pos = v_pos[start:stop, np.newaxis, :]
+        direction = v_dir[start:stop, np.newaxis, :]
+
+        # det = edge1 . (dir x edge2) = -dir . normal
+        det = -np.dot(v_dir[start:stop], hull.normals.T)
+        valid = np.abs(det) >= eps
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_det = 1. / det
+            tvec = pos - hull.v1
+            u = np.sum(tvec * np.cross(direction, hull.edge2), axis=2)
+            u *= inv_det
+            valid &= (u >= 0.) & (u <= 1.)
+            v = np.sum(direction * np.cross(tvec, hull.edge1), axis=2)
+            v *= inv_det
+            valid &= (v >= 0.) & (u + v <= 1.)
+            # t = edge2 . (tvec x edge1) = tvec . normal
+            t = (np.dot(v_pos[start:stop], hull.normals.T) - hull.offsets)
+            t *= inv_det
+        # intersections directly at v_pos are ignored, as for the
+        # scalar ray_triangle_intersection in both directions
+        valid &= np.abs(t) >= eps
+
+        has_hit = valid.any(axis=1)
+        t_entry[start:stop][has_hit] = np.where(
+            valid, t, np.inf).min(axis=1)[has_hit]
+        t_exit[start:stop][has_hit] = np.where(
+            valid, t, -np.inf).max(axis=1)[has_hit]
+    return t_entry, t_exit
+
+
 def get_intersections(convex_hull, v_pos, v_dir, eps=1e-4):
     '''Function to get the intersection points of an infinite line and the
     convex hull. The returned t's are the scaling factors for v_dir to
@@ -83,38 +211,15 @@ def get_intersections(convex_hull, v_pos, v_dir, eps=1e-4):
         Scaling factors for v_dir to get the intersection points.
         Actual intersection points are v_pos + t * v_dir.
     '''
-    if not isinstance(v_pos, np.ndarray):
-        v_pos = np.array(v_pos)
-    if not isinstance(v_dir, np.ndarray):
-        v_dir = np.array(v_dir)
-    t_s = [ray_triangle_intersection(v_pos,
-                                     v_dir,
-                                     convex_hull.points[simp])
-           for simp in convex_hull.simplices]
-    t_s = np.array(t_s)
-    t_s = t_s[np.isfinite(t_s)]
-    if len(t_s) != 2:   # A line should have at max 2 intersection points
-                        # with a convex hull
-        t_s_back = [ray_triangle_intersection(v_pos,
-                                              -v_dir,
-                                              convex_hull.points[simp])
-                    for simp in convex_hull.simplices]
-        t_s_back = np.array(t_s_back)
-        t_s_back = t_s_back[np.isfinite(t_s_back)]
-        t_s = np.hstack((t_s, t_s_back * (-1.)))
-    if isinstance(eps, float):  # Remove similar intersections
-        if eps >= 0.:
-            t_selected = []
-            intersections = []
-            for t_i in t_s:
-                intersection_i = v_pos + t_i * v_dir
-                distances = [np.linalg.norm(intersection_i - intersection_j)
-                             for intersection_j in intersections]
-                if not (np.array(distances) < eps).any():
-                    t_selected.append(t_i)
-                    intersections.append(intersection_i)
-            t_s = np.array(t_selected)
-    return t_s
+    t_entry, t_exit = get_intersections_batch(convex_hull, v_pos, v_dir)
+    t_entry, t_exit = t_entry[0], t_exit[0]
+    if np.isnan(t_entry):
+        return np.array([])
+    if isinstance(eps, float) and eps >= 0.:  # Remove similar intersections
+        distance = (t_exit - t_entry) * np.linalg.norm(v_dir)
+        if distance < eps:
+            return np.array([t_entry])
+    return np.array([t_entry, t_exit])
 
 
 def point_is_inside(convex_hull,
@@ -132,8 +237,8 @@ def point_is_inside(convex_hull,
     convex_hull : scipy.spatial.ConvexHull
         defining the desired convex volume
 
-    v_pos : array-like shape=(3,)
-        Position.
+    v_pos : array-like shape=(3,) or (n_points, 3)
+        Position(s).
 
     default_v_dir : array-like shape=(3,), optional (default=[0, 0, 1])
         See get_intersections()
@@ -143,12 +248,21 @@ def point_is_inside(convex_hull,
 
     Returns
     -------
-    is_inside : boolean
+    is_inside : boolean or array-like shape=(n_points,)
         True if the point is inside the detector.
         False if the point is outside the detector
     '''
-    t_s = get_intersections(convex_hull, v_pos, default_v_dir, eps)
-    return len(t_s) == 2 and (t_s >= 0).any() and (t_s <= 0).any()
+    t_entry, t_exit = get_intersections_batch(convex_hull,
+                                              v_pos,
+                                              default_v_dir)
+    if not isinstance(eps, float) or eps < 0.:
+        eps = 0.
+    with np.errstate(invalid='ignore'):
+        distance = (t_exit - t_entry) * np.linalg.norm(default_v_dir)
+        is_inside = (distance >= eps) & (t_entry <= 0) & (t_exit >= 0)
+    if np.ndim(v_pos) == 1:
+        return bool(is_inside[0])
+    return is_inside
 
 
 def distance_to_convex_hull(convex_hull, v_pos):
@@ -286,6 +400,185 @@ def get_edge_intersection(edge_point1, edge_point2, point):
     return float('nan')
 
 
+ICECUBE_HULL_POINTS = [
+       [-570.90002441, -125.13999939, 0],  # string 31
+       [-256.14001465, -521.08001709, 0],  # string 1
+       [ 361.        , -422.82998657, 0],  # string 6
+       [ 576.36999512,  170.91999817, 0],  # string 50
+       [ 338.44000244,  463.72000122, 0],  # string 74
+       [ 101.04000092,  412.79000854, 0],  # string 72
+       [  22.11000061,  509.5       , 0],  # string 78
+       [-347.88000488,  451.51998901, 0],  # string 75
+        ]
+
+DEEPCORE_HULL_POINTS = [
+       [-77.80000305175781, -54.33000183105469, 0],  # string 35
+       [1.7100000381469727, -150.6300048828125, 0],  # string 26
+       [124.97000122070312, -131.25, 0],  # string 27
+       [194.33999633789062, -30.920000076293945, 0],  # string 37
+       [90.48999786376953, 82.3499984741211, 0],  # string 46
+       [-32.959999084472656, 62.439998626708984, 0],  # string 45
+        ]
+
+
+class AxisAlignedVolume(object):
+    '''Volume defined by z_min, z_max and a 2D-Polygon described through a
+    list of counterclockwise points. The polygon edges are computed once,
+    so that distances for many points can be calculated in one vectorized
+    pass.
+
+    Parameters
+    ----------
+    points : array-like shape=(?,3)
+        List of counterclockwise points
+        describing the polygon of the volume
+        in the x-y-plane
+    z_min : float
+        Bottom layer of IceCube-Doms
+    z_max : float
+        Top layer of IceCube-Doms
+    '''
+    def __init__(self, points, z_min, z_max):
+        points = np.asarray(points, dtype=float)[:, :2]
+        self.z_min = z_min
+        self.z_max = z_max
+        self.edge_starts = points
+        self.edge_vectors = np.roll(points, -1, axis=0) - points
+        self.edge_norms_squared = np.sum(self.edge_vectors**2, axis=1)
+        if (self.edge_norms_squared == 0).any():
+            raise ValueError('Points do not define line.')
+
+    def signed_distance(self, pos):
+        '''Function to determine the closest distance of points
+        to the edge of the volume.
+
+        Parameters
+        ----------
+        pos : I3Position or array-like shape=(3,) or (n_points, 3)
+            Position(s).
+
+        Returns
+        -------
+        distance: float or array-like shape=(n_points,)
+            closest distance from the point
+            to the edge of the volume
+            negativ if point is inside,
+            positiv if point is outside
+        '''
+        pos_array = np.asarray(pos, dtype=float)
+        is_scalar = pos_array.ndim == 1
+        pos_array = np.atleast_2d(pos_array)
+
+        # ---- Calculate xy_distance to the closest edge
+        vec_point = pos_array[:, np.newaxis, :2] - self.edge_starts
+        t_projection = np.sum(vec_point * self.edge_vectors, axis=2)
+        t_projection /= self.edge_norms_squared
+        t_clipped = np.clip(t_projection, 0., 1.)
+        closest = t_clipped[..., np.newaxis] * self.edge_vectors
+        xy_distance = np.sqrt(np.min(
+            np.sum((vec_point - closest)**2, axis=2), axis=1))
+
+        # ---- Check if inside polygon (see get_edge_intersection)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            u = vec_point[..., 0] / self.edge_vectors[:, 0]
+        t = u * self.edge_vectors[:, 1] - vec_point[..., 1]
+        has_t = (u > -1e-8) & (u < 1 + 1e-8)
+        n_ts = np.sum(has_t, axis=1)
+        # u's are pos and negativ or point is exactly on border
+        is_inside_xy = (n_ts == 2) & (
+            (np.prod(np.where(has_t, t, 1.), axis=1) < 0) |
+            (np.sum(has_t & (t == 0), axis=1) == 1))
+
+        # ---- Calculate z_distance
+        pos_z = pos_array[:, 2]
+        is_inside_z = (pos_z >= self.z_min) & (pos_z < self.z_max)
+        z_distance = np.where(
+            pos_z < self.z_min,
+            self.z_min - pos_z,
+            np.where(is_inside_z,
+                     np.minimum(pos_z - self.z_min, self.z_max - pos_z),
+                     pos_z - self.z_max))
+
+        # ---- Combine distances
+        distance = np.where(
+            is_inside_z,
+            np.where(is_inside_xy,
+                     -np.minimum(xy_distance, z_distance),
+                     xy_distance),
+            np.where(is_inside_xy,
+                     z_distance,
+                     np.sqrt(z_distance**2 + xy_distance**2)))
+
+        if is_scalar:
+            return float(distance[0])
+        return distance
+
+
+_volume_cache = {}
+
+
+def get_axis_aligned_volume(points, z_min, z_max):
+    '''Get a cached AxisAlignedVolume.
+
+    Parameters
+    ----------
+    points : array-like shape=(?,3)
+        See AxisAlignedVolume
+    z_min : float
+        Bottom layer of IceCube-Doms
+    z_max : float
+        Top layer of IceCube-Doms
+
+    Returns
+    -------
+    volume : AxisAlignedVolume
+        The volume. It is only built once per set of arguments.
+    '''
+    key = (tuple(tuple(p) for p in points), z_min, z_max)
+    try:
+        return _volume_cache[key]
+    except KeyError:
+        volume = AxisAlignedVolume(points, z_min, z_max)
+        _volume_cache[key] = volume
+        return volume
+
+
+def get_icecube_volume(z_min=-502, z_max=501):
+    '''Get the cached volume of the icecube hull.
+
+    Parameters
+    ----------
+    z_min : float
+        Bottom layer of IceCube-Doms
+    z_max : float
+        Top layer of IceCube-Doms
+
+    Returns
+    -------
+    volume : AxisAlignedVolume
+        The icecube volume.
+    '''
+    return get_axis_aligned_volume(ICECUBE_HULL_POINTS, z_min, z_max)
+
+
+def get_deepcore_volume(z_min=-502, z_max=188):
+    '''Get the cached volume of the deep core hull.
+
+    Parameters
+    ----------
+    z_min : float
+        Bottom layer of DeepCore-Doms
+    z_max : float
+        Top layer of DeepCore-Doms
+
+    Returns
+    -------
+    volume : AxisAlignedVolume
+        The deep core volume.
+    '''
+    return get_axis_aligned_volume(DEEPCORE_HULL_POINTS, z_min, z_max)
+
+
 def distance_to_axis_aligned_Volume(pos, points, z_min, z_max):
     '''Function to determine the closest distance of a point
        to the edge of a Volume defined by z_zmin,z_max and a
@@ -314,59 +607,7 @@ def distance_to_axis_aligned_Volume(pos, points, z_min, z_max):
         negativ if point is inside,
         positiv if point is outside
     '''
-    no_of_points = len(points)
-    edges = [(points[i], points[(i + 1) % (no_of_points)])
-             for i in range(no_of_points)]
-    xy_distance = float('inf')
-    list_of_ts = []
-
-    for edge in edges:
-        x = (edge[0][0], edge[1][0])
-        y = (edge[0][1], edge[1][1])
-        distance = get_distance_to_edge(edge[0], edge[1],
-                                        [pos[0], pos[1], 0])
-        t = get_edge_intersection(edge[0], edge[1],
-                                  [pos[0], pos[1], 0])
-        if not np.isnan(t):
-            list_of_ts.append(t)
-        if distance < xy_distance:
-            xy_distance = distance
-    is_inside_xy = False
-    if len(list_of_ts) == 2:
-        # u's are pos and negativ
-        if list_of_ts[0]*list_of_ts[1] < 0:
-            is_inside_xy = True
-        # point is exactly on border
-        elif len([t for t in list_of_ts if t == 0]) == 1:
-            is_inside_xy = True
-
-    # ---- Calculate z_distance
-    is_inside_z = False
-    if pos[2] < z_min:
-        # underneath detector
-        z_distance = z_min - pos[2]
-    elif pos[2] < z_max:
-        # same height
-        is_inside_z = True
-        z_distance = min(pos[2] - z_min, z_max - pos[2])
-    else:
-        # above detector
-        z_distance = pos[2] - z_max
-
-    # ---- Combine distances
-    if is_inside_z:
-        if is_inside_xy:
-            # inside detector
-            distance = - min(xy_distance, z_distance)
-        else:
-            distance = xy_distance
-    else:
-        if is_inside_xy:
-            distance = z_distance
-        else:
-            distance = np.sqrt(z_distance**2 + xy_distance**2)
-
-    return distance
+    return AxisAlignedVolume(points, z_min, z_max).signed_distance(pos)
 
 
 def distance_to_icecube_hull(pos, z_min=-502, z_max=501):
@@ -377,8 +618,8 @@ def distance_to_icecube_hull(pos, z_min=-502, z_max=501):
     Parameters
     ----------
 
-    pos :I3Position
-        Position.
+    pos :I3Position or array-like shape=(n_points, 3)
+        Position(s).
     z_max : float
         Top layer of IceCube-Doms
     z_min : float
@@ -386,23 +627,13 @@ def distance_to_icecube_hull(pos, z_min=-502, z_max=501):
 
     Returns
     -------
-    distance: float
+    distance: float or array-like shape=(n_points,)
         closest distance from the point
         to the icecube hull
         negativ if point is inside,
         positiv if point is outside
     '''
-    points = [
-           [-570.90002441, -125.13999939, 0],  # string 31
-           [-256.14001465, -521.08001709, 0],  # string 1
-           [ 361.        , -422.82998657, 0],  # string 6
-           [ 576.36999512,  170.91999817, 0],  # string 50
-           [ 338.44000244,  463.72000122, 0],  # string 74
-           [ 101.04000092,  412.79000854, 0],  # string 72
-           [  22.11000061,  509.5       , 0],  # string 78
-           [-347.88000488,  451.51998901, 0],  # string 75
-            ]
-    return distance_to_axis_aligned_Volume(pos, points, z_min, z_max)
+    return get_icecube_volume(z_min, z_max).signed_distance(pos)
 
 
 def distance_to_deepcore_hull(pos, z_min=-502, z_max=188):
@@ -413,8 +644,8 @@ def distance_to_deepcore_hull(pos, z_min=-502, z_max=188):
     Parameters
     ----------
 
-    pos :I3Position
-        Position.
+    pos :I3Position or array-like shape=(n_points, 3)
+        Position(s).
     z_max : float
         Top layer of IceCube-Doms
     z_min : float
@@ -422,21 +653,13 @@ def distance_to_deepcore_hull(pos, z_min=-502, z_max=188):
 
     Returns
     -------
-    distance: float
+    distance: float or array-like shape=(n_points,)
         closest distance from the point
         to the icecube hull
         negativ if point is inside,
         positiv if point is outside
     '''
-    points = [
-           [-77.80000305175781, -54.33000183105469, 0],  # string 35
-           [1.7100000381469727, -150.6300048828125, 0],  # string 26
-           [124.97000122070312, -131.25, 0],  # string 27
-           [194.33999633789062, -30.920000076293945, 0],  # string 37
-           [90.48999786376953, 82.3499984741211, 0],  # string 46
-           [-32.959999084472656, 62.439998626708984, 0],  # string 45
-            ]
-    return distance_to_axis_aligned_Volume(pos, points, z_min, z_max)
+    return get_deepcore_volume(z_min, z_max).signed_distance(pos)
 
 
 def is_in_detector_bounds(pos, extend_boundary=60):
@@ -445,16 +668,367 @@ def is_in_detector_bounds(pos, extend_boundary=60):
 
     Parameters
     ----------
-    pos : I3Position
-        Position to be checked.
+    pos : I3Position or array-like shape=(n_points, 3)
+        Position(s) to be checked.
 
     extend_boundary : float
         Extend boundary of detector by extend_boundary
 
     Returns
     -------
-    is_inside : bool
+    is_inside : bool or array-like shape=(n_points,)
         True if within detector bounds + extend_boundary
     '''
-    distance = distance_to_icecube_hull(pos)
+    distance = get_icecube_volume().signed_distance(pos)
     return distance - extend_boundary <= 0
+
+
+def get_icosphere(n_subdivisions=4):
+    '''Function to create a triangulated unit sphere by subdividing an
+    icosahedron.
+
+    Parameters
+    ----------
+    n_subdivisions : int, optional (default=4)
+        Number of times each triangle is split into 4 triangles.
+
+    Returns
+    -------
+    vertices : array-like shape=(n_vertices, 3)
+        Unit vectors of the vertices.
+
+    faces : array-like shape=(n_faces, 3)
+        Vertex indices of the triangles.
+    '''
+    phi = (1. + np.sqrt(5.)) / 2.
+    vertices = [[-1, phi, 0], [1, phi, 0], [-1, -phi, 0], [1, -phi, 0],
+                [0, -1, phi], [0, 1, phi], [0, -1, -phi], [0, 1, -phi],
+                [phi, 0, -1], [phi, 0, 1], [-phi, 0, -1], [-phi, 0, 1]]
+    vertices = [list(np.array(v) / np.linalg.norm(v)) for v in vertices]
+    faces = [[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11],
+             [1, 5, 9], [5, 11, 4], [11, 10, 2], [10, 7, 6], [7, 1, 8],
+             [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9],
+             [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]]
+    for _ in range(n_subdivisions):
+        midpoints = {}
+
+        def get_midpoint(i, j):
+            key = (min(i, j), max(i, j))
+            if key not in midpoints:
+                midpoint = np.add(vertices[i], vertices[j])
+                vertices.append(list(midpoint / np.linalg.norm(midpoint)))
+                midpoints[key] = len(vertices) - 1
+            return midpoints[key]
+
+        new_faces = []
+        for i, j, k in faces:
+            a = get_midpoint(i, j)
+            b = get_midpoint(j, k)
+            c = get_midpoint(k, i)
+            new_faces.extend([[i, a, c], [j, b, a], [k, c, b], [a, b, c]])
+        faces = new_faces
+    return np.array(vertices), np.array(faces)
+
+
+class ExtendedVolumeSampler(object):
+    '''Sampler for points which are uniformly distributed within a box and
+    within a maximum distance to an AxisAlignedVolume.
+
+    The points are drawn uniformly within an envelope which encloses the
+    region and are rejected if they are outside of the region. The sampled
+    distribution is therefore exactly uniform within the region.
+
+    The envelope is built for the convex region which is obtained if the
+    polygon of the volume is replaced by its convex hull. Its radial extent
+    around a center point is computed for the directions of an icosphere
+    and the region is triangulated into tetrahedra which all share the
+    center point. The convex region is contained in the half spaces of the
+    box faces and in the half spaces which touch the extended convex
+    volume at the corners of a tetrahedron. The outer corners of every
+    tetrahedron are moved outwards until it covers the intersection of
+    these half spaces with its cone of directions and therefore the whole
+    region within this cone. A tetrahedron is chosen according to its volume and a
+    point is drawn uniformly within it. Every candidate needs exactly 4
+    uniform random numbers.
+
+    Parameters
+    ----------
+    volume : AxisAlignedVolume
+        The detector volume.
+    max_distance : float
+        Maximum distance of the points to the volume.
+    x_range : array-like shape=(2,)
+        [min, max] of the box in x.
+    y_range : array-like shape=(2,)
+        [min, max] of the box in y.
+    z_range : array-like shape=(2,)
+        [min, max] of the box in z.
+    n_subdivisions : int, optional (default=5)
+        Subdivisions of the icosphere. The envelope consists of
+        20 * 4**n_subdivisions tetrahedra.
+    n_bisections : int, optional (default=50)
+        Number of bisection steps to find the radial extent.
+    max_candidates : int, optional (default=10000)
+        Maximum number of candidates to draw for a single point.
+    '''
+    n_uniforms = 4
+
+    def __init__(self, volume, max_distance, x_range, y_range, z_range,
+                 n_subdivisions=5, n_bisections=50, max_candidates=10000):
+        from scipy.spatial import ConvexHull
+
+        self.volume = volume
+        self.max_distance = max_distance
+        self.max_candidates = max_candidates
+        self.box_min = np.array([x_range[0], y_range[0], z_range[0]],
+                                dtype=float)
+        self.box_max = np.array([x_range[1], y_range[1], z_range[1]],
+                                dtype=float)
+        self.box_volume = np.prod(self.box_max - self.box_min)
+
+        # the region with the convex hull of the polygon is convex
+        # and contains the region
+        hull_points = volume.edge_starts[
+            ConvexHull(volume.edge_starts).vertices]
+        self.convex_volume = AxisAlignedVolume(hull_points,
+                                               volume.z_min, volume.z_max)
+
+        # center of the region: the mean of the points of a grid which are
+        # within the convex region is inside of the convex region
+        grid_min = np.maximum(self.box_min, np.append(
+            np.min(hull_points, axis=0), volume.z_min) - max_distance)
+        grid_max = np.minimum(self.box_max, np.append(
+            np.max(hull_points, axis=0), volume.z_max) + max_distance)
+        grid = np.stack(np.meshgrid(*[
+            np.linspace(low, high, 21)[1:] - (high - low) / 40.
+            for low, high in zip(grid_min, grid_max)]), axis=-1)
+        grid = grid.reshape(-1, 3)
+        grid_is_inside = self._is_inside_convex(grid)
+        if not grid_is_inside.any():
+            raise ValueError('The sampling region is empty!')
+        self.center = np.mean(grid[grid_is_inside], axis=0)
+
+        directions, faces = get_icosphere(n_subdivisions)
+        lower, upper = self._get_radial_extent(directions, n_bisections)
+        if not (lower > 0).all():
+            raise ValueError('Center {!r} is not inside of the sampling '
+                             'region!'.format(self.center))
+        corners = self.center + lower[:, np.newaxis] * directions
+        origins = corners[faces[:, 0]]
+        edges = np.stack([corners[faces[:, 1]] - origins,
+                          corners[faces[:, 2]] - origins,
+                          self.center - origins], axis=1)
+
+        # half spaces n * x <= offset which contain the convex region:
+        # the box faces and the touching planes of the extended
+        # convex volume at the corners of the tetrahedra. The planes are
+        # computed slightly outside of the region to get stable normals.
+        box_normals = np.concatenate([np.eye(3), -np.eye(3)])
+        box_offsets = np.concatenate([self.box_max, -self.box_min])
+        corner_normals, corner_offsets = self._get_touching_planes(
+            self.center + 1.001 * upper[:, np.newaxis] * directions)
+        normals = np.concatenate([
+            np.broadcast_to(box_normals, (len(faces), 6, 3)),
+            corner_normals[faces]], axis=1)
+        offsets = np.concatenate([
+            np.broadcast_to(box_offsets, (len(faces), 6)),
+            corner_offsets[faces]], axis=1)
+
+        # every direction u within the cone of a face is a normalized
+        # positive combination of the corner directions v_i, so
+        # n * u >= min_i(n * v_i) and the distance to the plane along u is
+        # at most (offset - n * center) / min_i(n * v_i) if this is positive
+        min_cos = np.min(np.einsum('fpj,fij->fpi', normals,
+                                   directions[faces]), axis=2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            plane_radii = np.where(
+                min_cos > 0,
+                (offsets - np.dot(normals, self.center)) / min_cos,
+                np.inf)
+        max_radii = np.min(plane_radii, axis=1)
+        if not np.isfinite(max_radii).all():
+            raise ValueError('Unable to build an envelope of the sampling '
+                             'region. Increase n_subdivisions.')
+
+        # the cone is covered if the plane of the outer face is at least
+        # max_radii away from the center: either scale up the
+        # tetrahedron or put all corners at the same radius, whichever
+        # leads to the smaller volume
+        normals = np.cross(edges[:, 0], edges[:, 1])
+        heights = np.abs(np.sum(edges[:, 2] * normals, axis=1)) / \
+            np.linalg.norm(normals, axis=1)
+        scaled_radii = np.maximum(max_radii / heights, 1.)[:, np.newaxis] * \
+            lower[faces]
+        unit_normals = np.cross(
+            directions[faces[:, 1]] - directions[faces[:, 0]],
+            directions[faces[:, 2]] - directions[faces[:, 0]])
+        unit_heights = np.abs(np.sum(
+            directions[faces[:, 0]] * unit_normals, axis=1)) / \
+            np.linalg.norm(unit_normals, axis=1)
+        equal_radii = np.repeat((max_radii / unit_heights)[:, np.newaxis],
+                                3, axis=1)
+        corner_radii = np.where(
+            (np.prod(scaled_radii, axis=1) <
+             np.prod(equal_radii, axis=1))[:, np.newaxis],
+            scaled_radii, equal_radii)
+
+        outer_corners = self.center + \
+            corner_radii[..., np.newaxis] * directions[faces]
+        self.origins = outer_corners[:, 0]
+        self.edges = np.stack([outer_corners[:, 1] - self.origins,
+                               outer_corners[:, 2] - self.origins,
+                               self.center - self.origins], axis=1)
+        volumes = np.abs(np.linalg.det(self.edges)) / 6.
+        self.envelope_volume = np.sum(volumes)
+        self.cdf = np.cumsum(volumes) / self.envelope_volume
+
+    def _is_inside(self, pos):
+        in_box = np.all((pos >= self.box_min) & (pos <= self.box_max),
+                        axis=1)
+        distance = self.volume.signed_distance(pos)
+        return in_box & (distance < self.max_distance)
+
+    def _is_inside_convex(self, pos):
+        in_box = np.all((pos >= self.box_min) & (pos <= self.box_max),
+                        axis=1)
+        distance = self.convex_volume.signed_distance(pos)
+        return in_box & (distance < self.max_distance)
+
+    def _get_touching_planes(self, pos):
+        # planes n * x <= offset which touch the extended convex volume
+        # at max_distance from the closest point of the convex volume
+        volume = self.convex_volume
+        vec_point = pos[:, np.newaxis, :2] - volume.edge_starts
+        t_projection = np.sum(vec_point * volume.edge_vectors, axis=2)
+        t_projection /= volume.edge_norms_squared
+        t_clipped = np.clip(t_projection, 0., 1.)
+        closest = volume.edge_starts + \
+            t_clipped[..., np.newaxis] * volume.edge_vectors
+        closest_index = np.argmin(np.sum(
+            (pos[:, np.newaxis, :2] - closest)**2, axis=2), axis=1)
+        closest_xy = closest[np.arange(len(pos)), closest_index]
+
+        # the hull points are counterclockwise
+        is_inside_xy = np.all(
+            volume.edge_vectors[:, 0] * vec_point[..., 1] -
+            volume.edge_vectors[:, 1] * vec_point[..., 0] >= 0, axis=1)
+        closest_xy[is_inside_xy] = pos[is_inside_xy, :2]
+        closest_z = np.clip(pos[:, 2], volume.z_min, volume.z_max)
+        closest_pos = np.concatenate([closest_xy, closest_z[:, np.newaxis]],
+                                     axis=1)
+
+        # points within the convex volume do not define a plane
+        normals = pos - closest_pos
+        norms = np.linalg.norm(normals, axis=1)
+        is_outside = norms > 0
+        normals[is_outside] /= norms[is_outside, np.newaxis]
+        offsets = np.where(
+            is_outside,
+            np.sum(normals * closest_pos, axis=1) + self.max_distance,
+            np.inf)
+        return normals, offsets
+
+    def _get_radial_extent(self, directions, n_bisections):
+        # distance to the box boundary along each direction
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_box = np.where(directions > 0,
+                             (self.box_max - self.center) / directions,
+                             (self.box_min - self.center) / directions)
+        t_box = np.where(directions == 0, np.inf, t_box).min(axis=1)
+
+        # the convex region is star-shaped around the center:
+        # points are inside up to the radial extent and outside afterwards
+        lower = np.zeros(len(directions))
+        upper = np.array(t_box)
+        upper_is_inside = self._is_inside_convex(
+            self.center + 1.001 * upper[:, np.newaxis] * directions)
+        lower[upper_is_inside] = upper[upper_is_inside]
+        for _ in range(n_bisections):
+            middle = (lower + upper) / 2.
+            is_inside = self._is_inside_convex(
+                self.center + middle[:, np.newaxis] * directions)
+            lower = np.where(is_inside, middle, lower)
+            upper = np.where(is_inside, upper, middle)
+        return lower, upper
+
+    def get_region_volume(self, acceptance):
+        '''Estimate the volume of the region.
+
+        Parameters
+        ----------
+        acceptance : float
+            Fraction of accepted candidates.
+
+        Returns
+        -------
+        region_volume : float
+            Estimated volume of the region.
+        '''
+        return self.envelope_volume * acceptance
+
+    def transform(self, uniforms):
+        '''Transform uniform random numbers to candidate points, which are
+        uniformly distributed in the envelope.
+
+        Parameters
+        ----------
+        uniforms : array-like shape=(4,) or (n_points, 4)
+            Random numbers uniformly distributed in [0, 1).
+
+        Returns
+        -------
+        pos : array-like shape=(3,) or (n_points, 3)
+            Positions uniformly distributed in the envelope.
+        '''
+        uniforms = np.asarray(uniforms, dtype=float)
+        is_scalar = uniforms.ndim == 1
+        uniforms = np.atleast_2d(uniforms)
+        index = np.searchsorted(self.cdf, uniforms[:, 0], side='right')
+        index = np.minimum(index, len(self.cdf) - 1)
+
+        # uniform point in a tetrahedron by folding the unit cube
+        s, t, u = uniforms[:, 1], uniforms[:, 2], uniforms[:, 3]
+        fold = s + t > 1.
+        s, t = np.where(fold, 1. - s, s), np.where(fold, 1. - t, t)
+        fold_tu = t + u > 1.
+        fold_stu = ~fold_tu & (s + t + u > 1.)
+        s, t, u = (np.where(fold_stu, 1. - t - u, s),
+                   np.where(fold_tu, 1. - u, t),
+                   np.where(fold_tu, 1. - s - t,
+                            np.where(fold_stu, s + t + u - 1., u)))
+        coefficients = np.stack([s, t, u], axis=1)
+        pos = self.origins[index] + np.einsum('ni,nij->nj', coefficients,
+                                              self.edges[index])
+        if is_scalar:
+            return pos[0]
+        return pos
+
+    def sample(self, random_service):
+        '''Draw a position uniformly within the region. Every candidate
+        needs 4 calls to random_service.uniform.
+
+        Parameters
+        ----------
+        random_service : I3RandomService
+            The random service to use.
+
+        Returns
+        -------
+        pos : array-like shape=(3,)
+            Position uniformly distributed in the region.
+        n_candidates : int
+            Number of drawn candidates.
+
+        Raises
+        ------
+        RuntimeError
+            If no candidate within max_candidates is inside of the region.
+        '''
+        for n_candidates in range(1, self.max_candidates + 1):
+            uniforms = [random_service.uniform(0., 1.)
+                        for _ in range(self.n_uniforms)]
+            pos = self.transform(uniforms)
+            if self._is_inside(pos[np.newaxis])[0]:
+                return pos, n_candidates
+        raise RuntimeError('No vertex found within {} candidates!'.format(
+            self.max_candidates))
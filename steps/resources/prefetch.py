@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Read the input frames of a tray ahead of time.
+
+Usually the input is read and decompressed by the thread that executes the
+tray, so the propagation waits for every frame that is read. The
+prefetchers in this module read the frames on a background thread into a
+bounded queue. Compressed files are decompressed by separate processes and
+the frames are read from named pipes. The pipes are filled without the
+GIL, which dataio may hold while it waits for data.
+'''
+import os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+try:
+    import queue
+except ImportError:
+    # python 2
+    import Queue as queue
+
+from icecube import icetray, dataio
+
+from utils import split_file_extension, get_decompress_command
+
+
+# marks the end of the frames in the queue
+_END = object()
+
+
+class DecompressProcess(object):
+
+    """Decompress an i3 file into a named pipe in a separate process.
+
+    Parameters
+    ----------
+    infile : str
+        The compressed file.
+    pipe : str
+        The pipe the uncompressed frames are written to.
+    """
+
+    def __init__(self, infile, pipe):
+        self.infile = infile
+        self.pipe = pipe
+        self.exception = None
+        self._process = None
+
+    def start(self):
+        # the shell opens the pipe, which blocks until it is opened for
+        # reading, so that the caller does not have to wait here
+        command = get_decompress_command(self.infile) + [self.infile]
+        self._process = subprocess.Popen(
+            ['sh', '-c', 'exec "$@" > "$0"', self.pipe] + command)
+
+    def join(self):
+        """Wait until the file is decompressed."""
+        return_code = self._process.wait()
+        if return_code != 0:
+            self.exception = IOError('Decompression exited with code '
+                                     '{}'.format(return_code))
+
+    def kill(self):
+        """Stop the decompression, e.g. if the pipe is never read."""
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+
+
+class FramePrefetcher(object):
+
+    """Read frames on a background thread into a bounded queue.
+
+    The prefetcher is an iterator over the frames and can be shared by
+    consecutive trays like an I3FrameSequence.
+
+    Parameters
+    ----------
+    frames : iterable of I3Frame
+        The frames. They are only accessed by the background thread.
+    depth : int
+        Maximum number of frames in the queue.
+    """
+
+    def __init__(self, frames, depth):
+        self.depth = max(int(depth), 1)
+        self.exception = None
+        self.num_frames = 0
+        self.num_empty = 0
+        self.wait_time = 0.
+        self._occupancy = 0
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._next = None
+        self._done = False
+        self._thread = threading.Thread(target=self._read,
+                                        args=(iter(frames),))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self, frames):
+        try:
+            for frame in frames:
+                self._queue.put(frame)
+        except Exception as e:
+            self.exception = e
+        finally:
+            self._queue.put(_END)
+
+    def _get(self):
+        occupancy = self._queue.qsize()
+        if occupancy == 0:
+            self.num_empty += 1
+            wait_start = time.time()
+            frame = self._queue.get()
+            self.wait_time += time.time() - wait_start
+        else:
+            frame = self._queue.get()
+        if frame is _END:
+            self._done = True
+            if self.exception is not None:
+                raise IOError('Failed to read frames: {}'.format(
+                    self.exception))
+            return None
+        self.num_frames += 1
+        self._occupancy += occupancy
+        return frame
+
+    def more(self):
+        if self._next is None and not self._done:
+            self._next = self._get()
+        return self._next is not None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.more():
+            raise StopIteration
+        frame, self._next = self._next, None
+        return frame
+
+    next = __next__
+
+    def statistics(self):
+        """Get the queue statistics.
+
+        Returns
+        -------
+        dict
+            'PrefetchQueueDepth': Maximum number of frames in the queue.
+            'PrefetchMeanQueueOccupancy': Mean fraction of the queue that
+            was filled when a frame was requested.
+            'PrefetchEmptyQueueFraction': Fraction of the requests that had
+            to wait for a frame.
+            'PrefetchWaitTime': Total time spent waiting for frames.
+        """
+        num_frames = max(self.num_frames, 1)
+        return {
+            'PrefetchQueueDepth': self.depth,
+            'PrefetchMeanQueueOccupancy':
+                float(self._occupancy) / num_frames / self.depth,
+            'PrefetchEmptyQueueFraction': float(self.num_empty) / num_frames,
+            'PrefetchWaitTime': self.wait_time,
+        }
+
+
+def iter_files(filenames):
+    """Iterate over the frames of several files.
+
+    The frames of all files are read with a single I3FrameSequence, so
+    that the frames of later files are mixed with e.g. the GCD frames of
+    earlier ones. bzip2 and gzip compressed files are decompressed by
+    separate processes.
+
+    Parameters
+    ----------
+    filenames : list of str
+        The files.
+
+    Yields
+    ------
+    I3Frame
+        The frames.
+    """
+    pipe_dir = tempfile.mkdtemp(prefix='prefetch_')
+    processes = []
+    try:
+        paths = []
+        for i, filename in enumerate(filenames):
+            extension = split_file_extension(filename)[1]
+            if extension in ['.i3.bz2', '.i3.gz']:
+                pipe = os.path.join(pipe_dir, 'file_{}.i3'.format(i))
+                os.mkfifo(pipe)
+                process = DecompressProcess(filename, pipe)
+                process.start()
+                processes.append(process)
+                paths.append(pipe)
+            else:
+                paths.append(filename)
+
+        sequence = dataio.I3FrameSequence(paths)
+        while sequence.more():
+            yield sequence.pop_frame()
+        sequence.close()
+
+        for process in processes:
+            process.join()
+            if process.exception is not None:
+                raise IOError('Failed to read {}: {}'.format(
+                    process.infile, process.exception))
+    finally:
+        for process in processes:
+            process.kill()
+        shutil.rmtree(pipe_dir, ignore_errors=True)
+
+
+def prefetch_files(filenames, depth):
+    """Read the frames of several files on a background thread.
+
+    Parameters
+    ----------
+    filenames : list of str
+        The files, see iter_files.
+    depth : int
+        Maximum number of frames in the queue.
+
+    Returns
+    -------
+    FramePrefetcher
+        The prefetched frames.
+    """
+    return FramePrefetcher(iter_files(filenames), depth)
+
+
+class PrefetchReader(icetray.I3Module):
+
+    """Replacement of the I3Reader that reads the frames ahead of time.
+
+    The queue statistics are added to the I3SummaryService if the tray has
+    one and are printed at the end.
+    """
+
+    def __init__(self, context):
+        icetray.I3Module.__init__(self, context)
+        self.AddParameter('FilenameList', 'The files to read', [])
+        self.AddParameter('QueueDepth',
+                          'Maximum number of frames read ahead of time',
+                          100)
+
+    def Configure(self):
+        self._frames = prefetch_files(self.GetParameter('FilenameList'),
+                                      self.GetParameter('QueueDepth'))
+
+    def Process(self):
+        if self._frames.more():
+            self.PushFrame(next(self._frames))
+        else:
+            self.RequestSuspension()
+
+    def Finish(self):
+        statistics = self._frames.statistics()
+        if 'I3SummaryService' in self.context:
+            summary = self.context['I3SummaryService']
+            for k, v in statistics.items():
+                summary[k] = v
+        for k in sorted(statistics.keys()):
+            print('{}: {}'.format(k, statistics[k]))
@@ -55,6 +55,16 @@ class CascadeFactory(icetray.I3ConditionalModule):
                           'position will be accepted regardless of its '
                           'distance to the convex hull.',
                           None)
+        self.AddParameter('vertex_sampling',
+                          'Method to sample the vertex if max_vertex_distance '
+                          'is set. Options are: "rejection": draw uniformly in '
+                          'the x/y/z ranges and reject vertices that are too '
+                          'far away from the convex hull. "exact": draw '
+                          'candidates in a tight envelope around the allowed '
+                          'region with 4 random numbers per candidate and '
+                          'reject candidates outside of the x/y/z ranges or '
+                          'too far away from the convex hull.',
+                          'rejection')
         self.AddParameter('flavors',
                           'List of neutrino flavors to simulate.',
                           ['NuE', 'NuMu', 'NuTau'])
@@ -101,6 +111,7 @@ class CascadeFactory(icetray.I3ConditionalModule):
         self.y_range = self.GetParameter('y_range')
         self.z_range = self.GetParameter('z_range')
         self.max_vertex_distance = self.GetParameter('max_vertex_distance')
+        self.vertex_sampling = self.GetParameter('vertex_sampling').lower()
         self.flavors = self.GetParameter('flavors')
         self.num_flavors = len(self.flavors)
         self.interaction_types = self.GetParameter('interaction_types')
@@ -119,6 +130,10 @@ class CascadeFactory(icetray.I3ConditionalModule):
         if self.constant_vars is None:
             self.constant_vars = []
         self.events_done = 0
+        self.detector_volume = geometry.get_icecube_volume()
+        self.num_vertices = 0
+        self.num_vertex_candidates = 0
+        self.num_vertex_draws = 0
 
         # make lowercase
         self.flavors = [f.lower() for f in self.flavors]
@@ -143,10 +158,25 @@ class CascadeFactory(icetray.I3ConditionalModule):
             if flavor not in ['nue', 'numu', 'nutau']:
                 raise ValueError('Flavor unknown: {!r}'.format(flavor))
 
+        if self.vertex_sampling not in ['rejection', 'exact']:
+            raise ValueError('Vertex sampling unknown: {!r}'.format(
+                self.vertex_sampling))
+
         if self.oversampling_factor < 1:
             raise ValueError('Oversampling must be set to "None" or integer'
                              ' greater than 1. It is currently set to: '
                              '{!r}'.format(self.oversampling_factor))
+        if (self.vertex_sampling == 'exact' and
+                np.isfinite(self.max_vertex_distance)):
+            self.vertex_sampler = geometry.ExtendedVolumeSampler(
+                                        volume=self.detector_volume,
+                                        max_distance=self.max_vertex_distance,
+                                        x_range=self.x_range,
+                                        y_range=self.y_range,
+                                        z_range=self.z_range)
+        else:
+            self.vertex_sampler = None
+
         # --------------------
         # sample constant vars
         # --------------------
@@ -188,9 +218,19 @@ class CascadeFactory(icetray.I3ConditionalModule):
 
         Returns
         -------
-        TYPE
-            Description
+        I3Position
+            The sampled vertex.
         """
+        if self.vertex_sampler is not None:
+            pos, num_candidates = self.vertex_sampler.sample(
+                                                        self.random_service)
+            vertex = dataclasses.I3Position(*pos)
+            self.num_vertices += 1
+            self.num_vertex_candidates += num_candidates
+            self.num_vertex_draws += \
+                num_candidates * self.vertex_sampler.n_uniforms
+            return vertex
+
         # vertex
         point_is_inside = False
         while not point_is_inside:
@@ -201,8 +241,11 @@ class CascadeFactory(icetray.I3ConditionalModule):
                             vertex_x * I3Units.m,
                             vertex_y * I3Units.m,
                             vertex_z * I3Units.m)
-            dist = geometry.distance_to_icecube_hull(vertex)
+            dist = self.detector_volume.signed_distance(vertex)
             point_is_inside = dist < self.max_vertex_distance
+            self.num_vertex_candidates += 1
+            self.num_vertex_draws += 3
+        self.num_vertices += 1
         return vertex
 
     def DAQ(self, frame):
@@ -367,6 +410,29 @@ class CascadeFactory(icetray.I3ConditionalModule):
         if self.events_done >= self.num_events:
             self.RequestSuspension()
 
+    def Finish(self):
+        """Report vertex sampling statistics.
+        """
+        if self.num_vertices > 0:
+            print('Vertex sampling ({}): {} vertices, {} candidates, '
+                  'acceptance: {:.4f}, random numbers per vertex: '
+                  '{:.2f}'.format(
+                    self.vertex_sampling,
+                    self.num_vertices,
+                    self.num_vertex_candidates,
+                    self.num_vertices / self.num_vertex_candidates,
+                    self.num_vertex_draws / self.num_vertices))
+        if self.vertex_sampler is not None and self.num_vertices > 0:
+            region_volume = self.vertex_sampler.get_region_volume(
+                self.num_vertices / self.num_vertex_candidates)
+            print('Vertex sampling envelope: {:.4g} m^3, region: {:.4g} m^3, '
+                  'box: {:.4g} m^3, expected rejection acceptance: '
+                  '{:.4f}'.format(
+                    self.vertex_sampler.envelope_volume,
+                    region_volume,
+                    self.vertex_sampler.box_volume,
+                    region_volume / self.vertex_sampler.box_volume))
+
 
 class DAQFrameMultiplier(icetray.I3ConditionalModule):
     def __init__(self, context):
@@ -511,6 +577,8 @@ def main(cfg, run_number, scratch):
         cfg['max_vertex_distance'] = None
     if 'constant_vars' not in cfg:
         cfg['constant_vars'] = None
+    if 'vertex_sampling' not in cfg:
+        cfg['vertex_sampling'] = 'rejection'
     if 'oversample_after_proposal' in cfg and \
             cfg['oversample_after_proposal']:
         oversampling_factor_injection = None
@@ -531,6 +599,7 @@ def main(cfg, run_number, scratch):
                    y_range=cfg['y_range'],
                    z_range=cfg['z_range'],
                    max_vertex_distance=cfg['max_vertex_distance'],
+                   vertex_sampling=cfg['vertex_sampling'],
                    flavors=cfg['flavors'],
                    interaction_types=cfg['interaction_types'],
                    num_events=cfg['n_events_per_run'],
@@ -581,7 +650,8 @@ def main(cfg, run_number, scratch):
                        "OversizeSplitterNSplits",
                        thresholds=distance_splits,
                        thresholds_doms=dom_limits,
-                       oversize_factors=oversize_factors)
+                       oversize_factors=oversize_factors,
+                       GCDFile=cfg['gcd'])
         for stream_i in stream_objects:
             outfile_i = stream_i.transform_filepath(outfile)
             tray.AddModule("I3Writer",
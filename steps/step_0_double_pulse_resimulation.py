@@ -16,6 +16,7 @@ from icecube import icetray, dataclasses
 from icecube import sim_services, MuonGun
 
 from utils import create_random_services, get_run_folder
+from utils import get_cached_service
 
 import healpy
 import os
@@ -305,7 +306,9 @@ class ParticleFactory(icetray.I3ConditionalModule):
                                  'csms_differential_v1.0')
         base_path = os.path.expandvars(base_path)
 
-        cross_section = sim_services.I3CrossSection(
+        # the tables are only loaded once per process
+        cross_section = get_cached_service(
+            sim_services.I3CrossSection,
             os.path.join(base_path, 'dsdxdy_nu_CC_iso.fits'),
             os.path.join(base_path, 'sigma_nu_CC_iso.fits'))
 
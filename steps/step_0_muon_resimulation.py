@@ -291,7 +291,8 @@ def main(cfg, run_number, scratch):
                        "OversizeSplitterNSplits",
                        thresholds=distance_splits,
                        thresholds_doms=dom_limits,
-                       oversize_factors=oversize_factors)
+                       oversize_factors=oversize_factors,
+                       GCDFile=cfg['gcd'])
         for stream_i in stream_objects:
             outfile_i = stream_i.transform_filepath(outfile)
             tray.AddModule("I3Writer",
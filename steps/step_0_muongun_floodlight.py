@@ -12,6 +12,7 @@ from icecube import icetray, dataclasses
 from icecube import sim_services, MuonGun
 
 from utils import create_random_services, get_run_folder
+from resources.gcd_cache import get_cached_gcd_file
 from dom_distance_cut import OversizeSplitterNSplits, generate_stream_object
 
 
@@ -56,7 +57,7 @@ def main(cfg, run_number, scratch):
 
     tray.AddModule("I3InfiniteSource",
                    "TheSource",
-                   Prefix=cfg['gcd'],
+                   Prefix=get_cached_gcd_file(cfg['gcd']),
                    Stream=icetray.I3Frame.DAQ)
 
     tray.AddSegment(
@@ -101,7 +102,8 @@ def main(cfg, run_number, scratch):
                        "OversizeSplitterNSplits",
                        thresholds=distance_splits,
                        thresholds_doms=dom_limits,
-                       oversize_factors=oversize_factors)
+                       oversize_factors=oversize_factors,
+                       GCDFile=cfg['gcd'])
         for stream_i in stream_objects:
             outfile_i = stream_i.transform_filepath(outfile)
             tray.AddModule("I3Writer",
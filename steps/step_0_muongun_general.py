@@ -13,6 +13,20 @@ import sys
 file_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(file_dir + '/..')
 from utils import create_random_services, get_run_folder
+from utils import get_cached_service
+from resources.gcd_cache import get_cached_gcd_file
+
+
+def load_model(name, min_multiplicity, max_multiplicity):
+    """Load a MuonGun model with the given bundle multiplicities.
+
+    The multiplicities are arguments, so that a model cached with
+    get_cached_service is never changed by a later run.
+    """
+    model = MuonGun.load_model(name)
+    model.flux.min_multiplicity = min_multiplicity
+    model.flux.max_multiplicity = max_multiplicity
+    return model
 
 
 @click.command()
@@ -41,9 +55,10 @@ def main(cfg, run_number, scratch):
 
     tray.context['I3RandomService'] = random_service
 
-    model = MuonGun.load_model(cfg['muongun_model'])
-    model.flux.min_multiplicity = cfg['muongun_min_multiplicity']
-    model.flux.max_multiplicity = cfg['muongun_max_multiplicity']
+    model = get_cached_service(load_model,
+                               cfg['muongun_model'],
+                               cfg['muongun_min_multiplicity'],
+                               cfg['muongun_max_multiplicity'])
     spectrum = MuonGun.OffsetPowerLaw(cfg['gamma'],
                                       cfg['e_min']*icetray.I3Units.GeV,
                                       cfg['e_min']*icetray.I3Units.GeV,
@@ -80,7 +95,7 @@ def main(cfg, run_number, scratch):
     tray.Add(MuonGun.segments.GenerateBundles, 'MuonGenerator',
              Generator=generator,
              NEvents=cfg['n_events_per_run'],
-             GCDFile=cfg['gcd'])
+             GCDFile=get_cached_gcd_file(cfg['gcd']))
 
     tray.Add("Rename", keys=["I3MCTree", "I3MCTree_preMuonProp"])
 
@@ -115,7 +130,8 @@ def main(cfg, run_number, scratch):
                        "OversizeSplitterNSplits",
                        thresholds=distance_splits,
                        thresholds_doms=dom_limits,
-                       oversize_factors=oversize_factors)
+                       oversize_factors=oversize_factors,
+                       GCDFile=cfg['gcd'])
         for stream_i in stream_objects:
             outfile_i = stream_i.transform_filepath(outfile)
             tray.AddModule("I3Writer",
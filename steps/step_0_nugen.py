@@ -12,6 +12,7 @@ from icecube import icetray, dataclasses
 from icecube import sim_services, MuonGun
 
 from utils import create_random_services, get_run_folder
+from resources.gcd_cache import get_cached_gcd_file
 from dom_distance_cut import OversizeSplitterNSplits, generate_stream_object
 
 
@@ -63,7 +64,7 @@ def main(cfg, run_number, scratch):
 
     tray.AddModule("I3InfiniteSource",
                    "TheSource",
-                   Prefix=cfg['gcd'],
+                   Prefix=get_cached_gcd_file(cfg['gcd']),
                    Stream=icetray.I3Frame.DAQ)
 
     tray.AddSegment(
@@ -112,7 +113,8 @@ def main(cfg, run_number, scratch):
                        thresholds=cfg['distance_splits'],
                        thresholds_doms=cfg['threshold_doms'],
                        oversize_factors=cfg['oversize_factors'],
-                       simulaton_type=cfg['neutrino_flavor'].lower())
+                       simulaton_type=cfg['neutrino_flavor'].lower(),
+                       GCDFile=cfg['gcd'])
         for stream_i in stream_objects:
             outfile_i = stream_i.transform_filepath(outfile)
             click.echo('\t{}'.format(stream_i))
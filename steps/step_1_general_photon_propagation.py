@@ -2,6 +2,9 @@
 #METAPROJECT simulation/V05-01-01
 import os
 import sys
+import time
+import shutil
+import tempfile
 
 import multiprocessing
 import traceback
@@ -16,14 +19,17 @@ from icecube.simprod import segments
 from I3Tray import I3Tray
 from icecube import icetray, dataclasses, dataio, phys_services
 from utils import create_random_services, get_run_folder
-from dom_distance_cut import generate_stream_object
+from utils import split_file_extension
+from resources.gcd_cache import get_cached_gcd_file
+from resources.prefetch import DecompressProcess, PrefetchReader
+from dom_distance_cut import generate_stream_object, iter_merged_events
 
 
 MAX_PARALLEL_EVENTS = 50
 SPLINE_TABLES = '/cvmfs/icecube.opensciencegrid.org/data/photon-tables/splines'
 
 
-def process_single_stream(cfg, infile, outfile):
+def process_single_stream(cfg, infile, outfile, i_th_stream=0, n_streams=1):
     click.echo('Input: {}'.format(infile))
     hybrid_mode = (cfg['clsim_hybrid_mode'] and
                    cfg['icemodel'].lower() != 'spicelea')
@@ -47,11 +53,18 @@ def process_single_stream(cfg, infile, outfile):
         dataset_number=cfg['dataset_number'],
         run_number=cfg['run_number'],
         seed=cfg['seed'],
-        n_services=process_single_stream.n_streams)
+        n_services=n_streams)
 
-    random_service = random_services[process_single_stream.i_th_stream]
+    random_service = random_services[i_th_stream]
     tray.context['I3RandomService'] = random_service
-    tray.Add('I3Reader', FilenameList=[cfg['gcd'], infile])
+    prefetch_depth = cfg.get('input_prefetch_depth', 0)
+    if prefetch_depth > 0:
+        tray.Add(PrefetchReader, FilenameList=[
+            get_cached_gcd_file(cfg['gcd']), infile],
+            QueueDepth=prefetch_depth)
+    else:
+        tray.Add('I3Reader', FilenameList=[
+            get_cached_gcd_file(cfg['gcd']), infile])
 
     if hybrid_mode:
         cascade_tables = segments.LoadCascadeTables(IceModel=cfg['icemodel'],
@@ -100,39 +113,127 @@ def process_single_stream(cfg, infile, outfile):
     tray.Finish()
 
 
-process_single_stream.n_streams = 1
-process_single_stream.i_th_stream = 0
+class DAQFrameCounter(object):
+    """Wrapper of an I3File which counts the popped DAQ frames.
 
+    Parameters
+    ----------
+    i3file : I3File
+        The file.
+    """
+    def __init__(self, i3file):
+        self.i3file = i3file
+        self.n_daq_frames = 0
 
-def filter_S_frame(frame):
-    if not filter_S_frame.already_added:
-        filter_S_frame.already_added = True
-        return True
-    else:
-        return False
+    def more(self):
+        return self.i3file.more()
+
+    def pop_frame(self):
+        frame = self.i3file.pop_frame()
+        if frame.Stop == icetray.I3Frame.DAQ:
+            self.n_daq_frames += 1
+        return frame
+
+    def close(self):
+        self.i3file.close()
+
+
+def count_daq_frames(infile):
+    """Count the DAQ frames of a file.
 
+    Parameters
+    ----------
+    infile : str
+        The file.
 
-filter_S_frame.already_added = False
+    Returns
+    -------
+    int
+        The number of DAQ frames.
+    """
+    i3file = dataio.I3File(infile)
+    n_daq_frames = 0
+    while i3file.more():
+        if i3file.pop_frame().Stop == icetray.I3Frame.DAQ:
+            n_daq_frames += 1
+    i3file.close()
+    return n_daq_frames
 
 
 def merge(infiles, outfile):
-    tray = I3Tray()
-    tray.context['I3FileStager'] = dataio.get_stagers()
-    tray.Add('I3Reader', FilenameList=infiles)
-    tray.AddModule(filter_S_frame,
-                   'S Frame Filter',
-                   Streams=[icetray.I3Frame.Stream('S')])
-    tray.AddModule("I3Writer", "writer",
-                   Filename=outfile,
-                   Streams=[icetray.I3Frame.DAQ,
-                            icetray.I3Frame.Physics,
-                            icetray.I3Frame.Stream('S'),
-                            icetray.I3Frame.Stream('M')])
-    tray.AddModule("TrashCan", "the can")
-    tray.Execute()
-    tray.Finish()
+    """Merge the outputs of the streams in the generated order.
+
+    The inputs are decompressed in parallel processes and the events of all
+    streams are merged in a single pass. Events without order key are
+    appended stream by stream. Only the first S frame is kept. The inputs
+    are only removed if the DAQ frames read from all streams were written
+    and the merged output contains them when it is read again.
+
+    Parameters
+    ----------
+    infiles : list of str
+        The outputs of the streams.
+    outfile : str
+        The merged output.
+    """
+    pipe_dir = tempfile.mkdtemp(prefix='merge_streams_')
+    processes = []
+    try:
+        i3files = []
+        for i, infile in enumerate(infiles):
+            extension = split_file_extension(infile)[1]
+            if extension in ['.i3.bz2', '.i3.gz']:
+                pipe = os.path.join(pipe_dir, 'stream_{}.i3'.format(i))
+                os.mkfifo(pipe)
+                process = DecompressProcess(infile, pipe)
+                process.start()
+                processes.append(process)
+                i3files.append(DAQFrameCounter(dataio.I3File(pipe)))
+            else:
+                i3files.append(DAQFrameCounter(dataio.I3File(infile)))
+
+        n_events = 0
+        has_s_frame = False
+        out_file = dataio.I3File(outfile, 'w')
+        for frames in iter_merged_events(i3files):
+            for frame in frames:
+                if frame.Stop == icetray.I3Frame.Stream('S'):
+                    if has_s_frame:
+                        continue
+                    has_s_frame = True
+                if frame.Stop == icetray.I3Frame.DAQ:
+                    n_events += 1
+                out_file.push(frame)
+        out_file.close()
+        for i3file in i3files:
+            i3file.close()
+
+        for process in processes:
+            process.join()
+            if process.exception is not None:
+                raise IOError('Failed to read {}: {}'.format(
+                    process.infile, process.exception))
+        if not os.path.isfile(outfile) or os.path.getsize(outfile) == 0:
+            raise IOError('Merged output {} is missing'.format(outfile))
+    finally:
+        for process in processes:
+            process.kill()
+        shutil.rmtree(pipe_dir, ignore_errors=True)
+
+    n_read = [i3file.n_daq_frames for i3file in i3files]
+    for infile, n_read_i in zip(infiles, n_read):
+        click.echo('Read {} events from {}'.format(n_read_i, infile))
+    if sum(n_read) != n_events:
+        raise IOError('Read {} events from the streams, but wrote {} to '
+                      '{}'.format(sum(n_read), n_events, outfile))
+    n_written = count_daq_frames(outfile)
+    if n_written != n_events:
+        raise IOError('Merged output {} contains {} instead of {} '
+                      'events'.format(outfile, n_written, n_events))
+    click.echo('Merged {} events of {} streams'.format(n_events,
+                                                       len(infiles)))
     for file_i in infiles:
-        click.echo('Remvoing {}:'.format(file_i))
+        click.echo('Removing {}'.format(file_i))
         os.remove(file_i)
 
 
@@ -158,6 +259,105 @@ class ExecProcess(multiprocessing.Process):
         return self._exception
 
 
+def get_device_slots(cfg):
+    """Get the devices the distance split streams can be run on.
+
+    The GPUs are taken from CUDA_VISIBLE_DEVICES, which is set by the
+    batch system for the requested GPUs. Every GPU runs up to
+    'clsim_streams_per_gpu' streams at the same time.
+
+    Parameters
+    ----------
+    cfg : dict
+        The config.
+
+    Returns
+    -------
+    list of str or None
+        One entry per stream that can be run at the same time. None means
+        that the device is not restricted.
+    """
+    devices = os.environ.get('CUDA_VISIBLE_DEVICES', '')
+    devices = [d.strip() for d in devices.split(',') if d.strip() != '']
+    if not cfg['clsim_usegpus'] or len(devices) == 0:
+        return [None]
+    streams_per_gpu = max(int(cfg.get('clsim_streams_per_gpu', 1)), 1)
+    return [d for _ in range(streams_per_gpu) for d in devices]
+
+
+def run_stream(cfg, infile, outfile, i_th_stream, n_streams, device):
+    if device is not None:
+        # has to be set before OpenCL is initialized in this process
+        os.environ['CUDA_VISIBLE_DEVICES'] = device
+        click.echo('Stream {} uses GPU {}'.format(i_th_stream, device))
+    process_single_stream(cfg, infile, outfile, i_th_stream, n_streams)
+
+
+def run_streams(cfg, stream_objects, infile, outfile):
+    """Propagate the distance split streams concurrently.
+
+    Each stream is processed in its own process on one of the device
+    slots. The i-th stream always uses the i-th random service.
+
+    Parameters
+    ----------
+    cfg : dict
+        The config.
+    stream_objects : list of OversizeStream
+        The streams.
+    infile : str
+        Input file; the stream files are derived from it.
+    outfile : str
+        Output file; the stream files are derived from it.
+
+    Returns
+    -------
+    list of tuple
+        Stream, exception and traceback of every failed stream.
+    """
+    free_slots = get_device_slots(cfg)
+    click.echo('Running {} streams on {} slots'.format(
+        len(stream_objects), len(free_slots)))
+    pending = list(enumerate(stream_objects))
+    running = []
+    failures = []
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(free_slots) > 0:
+            i, stream_i = pending.pop(0)
+            device = free_slots.pop(0)
+            stream_cfg = dict(cfg)
+            stream_cfg['clsim_dom_oversize'] = stream_i.oversize_factor
+            proc = ExecProcess(target=run_stream,
+                               args=(stream_cfg,
+                                     stream_i.transform_filepath(infile),
+                                     stream_i.transform_filepath(outfile),
+                                     i,
+                                     len(stream_objects),
+                                     device))
+            proc.start()
+            running.append((proc, stream_i, device))
+
+        time.sleep(1.)
+        still_running = []
+        for proc, stream_i, device in running:
+            if proc.is_alive():
+                still_running.append((proc, stream_i, device))
+                continue
+            proc.join()
+            free_slots.append(device)
+            if proc.exception:
+                error, tb = proc.exception
+                failures.append((stream_i, error, tb))
+            elif proc.exitcode != 0:
+                failures.append((stream_i,
+                                 'Exit code {}'.format(proc.exitcode),
+                                 ''))
+            else:
+                click.echo('Finished {}'.format(stream_i))
+        running = still_running
+    return failures
+
+
 @click.command()
 @click.argument('cfg', type=click.Path(exists=True))
 @click.argument('run_number', type=int)
@@ -192,20 +392,12 @@ def main(cfg, run_number, scratch):
         stream_objects = generate_stream_object(distance_splits[order],
                                                 dom_limits[order],
                                                 oversize_factors[order])
-        process_single_stream.n_streams = len(stream_objects)
-        for stream_i in stream_objects:
-            infile_i = stream_i.transform_filepath(infile)
-            outfile_i = stream_i.transform_filepath(outfile)
-            cfg['clsim_dom_oversize'] = stream_i.oversize_factor
-            proc = ExecProcess(target=process_single_stream,
-                               args=(cfg, infile_i, outfile_i))
-            proc.start()
-            proc.join()
-            process_single_stream.i_th_stream += 1
-        if proc.exception:
-            error, traceback = proc.exception
-            print(traceback)
-            print(error)
+        failures = run_streams(cfg, stream_objects, infile, outfile)
+        if len(failures) > 0:
+            for stream_i, error, tb in failures:
+                print('Failed: {}'.format(stream_i))
+                print(tb)
+                print(error)
             sys.exit(1)
         infiles = [stream_i.transform_filepath(outfile)
                    for stream_i in stream_objects]
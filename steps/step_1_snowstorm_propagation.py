@@ -33,12 +33,17 @@ import numpy as np
 import time
 import copy
 import itertools
+import collections
 import tempfile
+import traceback
+import multiprocessing
+import shutil
+import subprocess
 
 from I3Tray import I3Tray
 from icecube import icetray, dataclasses, dataio, phys_services, clsim
 from icecube.clsim.traysegments.common import \
-    setupPropagators, setupDetector, configureOpenCLDevices
+    setupPropagators, setupDetector
 from icecube.clsim.traysegments.I3CLSimMakePhotons import \
     I3CLSimMakePhotonsWithServer
 from icecube.ice_models import icewave
@@ -47,7 +52,11 @@ from icecube.snowstorm import \
     Perturber, MultivariateNormal, DeltaDistribution, UniformDistribution
 from icecube.snowstorm import all_perturbers
 
-from utils import create_random_services, get_run_folder
+from utils import create_random_services, get_run_folder, get_compress_command
+from resources.gcd_cache import get_cached_gcd_file, get_gcd_frames
+from resources.prefetch import FramePrefetcher, prefetch_files
+from dom_distance_cut import generate_stream_object, iter_merged_events, \
+    get_order_key
 
 
 # ----------------
@@ -136,13 +145,105 @@ class EnsureSFrame(icetray.I3Module):
             self.PushFrame(frame)
 
 
+class FrameOrder(object):
+    """Order of the frames before the client modules of the streams.
+
+    The client module of a stream only waits for the events of its stream.
+    The frames it skips are passed on at once, so they overtake the events
+    still queued by the module. The frames are identified by their stop,
+    the index stamped by the OversizeSplitterNSplits, if any, and the
+    number of frames with the same stop and index before them.
+    """
+
+    def __init__(self):
+        self._order = collections.deque()
+        self._frames = {}
+        self._recorded = {}
+        self._released = {}
+
+    @staticmethod
+    def _get_key(frame, counts):
+        key = (frame.Stop.id, get_order_key(frame))
+        counts[key] = counts.get(key, 0) + 1
+        return key + (counts[key],)
+
+    def record(self, frame):
+        """Record the position of a frame.
+
+        Parameters
+        ----------
+        frame : I3Frame
+            The frame before the client modules.
+        """
+        self._order.append(self._get_key(frame, self._recorded))
+
+    def release(self, frame):
+        """Get the frames that follow in the recorded order.
+
+        Parameters
+        ----------
+        frame : I3Frame
+            The frame after the client modules.
+
+        Returns
+        -------
+        list of I3Frame
+            The frames that can be pushed in the recorded order. The
+            frame is held back if an earlier frame is still missing.
+        """
+        self._frames[self._get_key(frame, self._released)] = frame
+        frames = []
+        while len(self._order) > 0 and self._order[0] in self._frames:
+            frames.append(self._frames.pop(self._order.popleft()))
+        return frames
+
+    def num_pending(self):
+        """Get the number of frames held back."""
+        return len(self._frames)
+
+
+class RecordFrameOrder(icetray.I3Module):
+    """Record the order of the frames for RestoreFrameOrder."""
+    def __init__(self, ctx):
+        super(RecordFrameOrder, self).__init__(ctx)
+        self.AddParameter("FrameOrder", "The shared FrameOrder", None)
+
+    def Configure(self):
+        self._order = self.GetParameter("FrameOrder")
+
+    def Process(self):
+        frame = self.PopFrame()
+        self._order.record(frame)
+        self.PushFrame(frame)
+
+
+class RestoreFrameOrder(icetray.I3Module):
+    """Push the frames in the order recorded by RecordFrameOrder."""
+    def __init__(self, ctx):
+        super(RestoreFrameOrder, self).__init__(ctx)
+        self.AddParameter("FrameOrder", "The shared FrameOrder", None)
+
+    def Configure(self):
+        self._order = self.GetParameter("FrameOrder")
+
+    def Process(self):
+        for frame in self._order.release(self.PopFrame()):
+            self.PushFrame(frame)
+
+    def Finish(self):
+        if self._order.num_pending() > 0:
+            raise RuntimeError(
+                '{} frames did not reach the output in order'.format(
+                    self._order.num_pending()))
+
+
 class GatherStatistics(icetray.I3Module):
     """Mimick the summary stage of I3CLSimModule::Finish()"""
     def Finish(self):
         if 'I3SummaryService' not in self.context:
             return
         summary = self.context['I3SummaryService']
-        server = self.context['CLSimServer']
+        servers = self.context['CLSimServers']
         if "TotalNumGeneratedHits" not in summary.keys():
             summary["TotalNumGeneratedHits"] = 0
         for k, v in summary.items():
@@ -150,15 +251,522 @@ class GatherStatistics(icetray.I3Module):
                     k.endswith("NumGeneratedHits")):
                 summary["TotalNumGeneratedHits"] += v
                 summary.pop(k)
-        for k, v in server.GetStatistics().items():
-            if k in summary and (k.startswith('Total') or
-                                 k.startswith('Num')):
-                summary[k] += v
+        for server in servers:
+            for k, v in server.get_statistics().items():
+                if k in summary and (k.startswith('Total') or
+                                     k.startswith('Num')):
+                    summary[k] += v
+                else:
+                    summary[k] = v
+
+
+class EventsPerModelController(object):
+    """Choose the number of events of each ice model.
+
+    Every new ice model requires the setup of its propagators. The number
+    of events of the next model is chosen, such that this setup takes the
+    fraction `target_overhead` of the time spent on the model. The time per
+    event is estimated from the time per photon of the last model and the
+    average number of photons per event of all events so far.
+
+    Parameters
+    ----------
+    num_events : int
+        Number of events of the first model.
+    min_events : int
+        Minimum number of events per model.
+    max_events : int
+        Maximum number of events per model.
+    target_overhead : float
+        Targeted fraction of the initialization time.
+    """
+
+    def __init__(self, num_events, min_events, max_events, target_overhead):
+        if not 0. < target_overhead < 1.:
+            raise ValueError('Target overhead {} not in (0, 1)'.format(
+                target_overhead))
+        if min_events > max_events:
+            raise ValueError('MinEventsPerModel > MaxEventsPerModel')
+        self.min_events = min_events
+        self.max_events = max_events
+        self.target_overhead = target_overhead
+        self.num_events = self._clip(num_events)
+        self._total_events = 0
+        self._total_photons = 0.
+
+    def _clip(self, num_events):
+        return int(min(max(num_events, self.min_events), self.max_events))
+
+    def update(self, init_time, tray_time, num_events, num_photons):
+        """Choose the number of events of the next model.
+
+        Parameters
+        ----------
+        init_time : float
+            Initialization time of the last model.
+        tray_time : float
+            Time needed to propagate the events of the last model.
+        num_events : int
+            Number of events of the last model.
+        num_photons : float
+            Number of photons generated for the last model.
+
+        Returns
+        -------
+        int
+            The number of events of the next model.
+        """
+        if num_events <= 0:
+            return self.num_events
+        self._total_events += num_events
+        self._total_photons += num_photons
+        if num_photons > 0:
+            time_per_event = tray_time / num_photons * \
+                self._total_photons / self._total_events
+        else:
+            time_per_event = tray_time / num_events
+        if time_per_event <= 0.:
+            return self.num_events
+        self.num_events = self._clip(
+            init_time * (1. - self.target_overhead) /
+            (self.target_overhead * time_per_event))
+        return self.num_events
+
+    def to_frame(self, frame):
+        """Write the settings to the S frame."""
+        settings = dataclasses.I3MapStringDouble()
+        settings['MinEventsPerModel'] = self.min_events
+        settings['MaxEventsPerModel'] = self.max_events
+        settings['TargetInitOverhead'] = self.target_overhead
+        frame['SnowstormNumEventsPerModel'] = settings
+
+
+# items of the CLSim configuration the propagators are compiled from
+KERNEL_SETTINGS = ['MediumProperties', 'WavelengthGenerationBias']
+
+
+class PersistentCLSimServer(object):
+    """CLSim server that is kept alive across the ice models.
+
+    The OpenCL kernels are compiled with the medium properties and the
+    wavelength bias of the model, so the propagators can not be changed once
+    they are initialized. They are only rebuilt if a model changes one of
+    these settings (see KERNEL_SETTINGS); otherwise the running server with
+    its compiled kernels is used for the next model as well. Perturbations
+    of the scattering or absorption change the medium properties, so the
+    server is rebuilt for every model if they are perturbed.
+
+    Every server runs in its own process, which builds the propagators and
+    listens on its own address. The propagators of the next model can be
+    built with `prepare` while the current model is propagated, as neither
+    the build nor the tray has to wait for the GIL of the other process.
+    Both sets of propagators are allocated on the devices at the same time.
+
+    Parameters
+    ----------
+    cfg : dict
+        Dictionary with configuration settings.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.num_setups = 0
+        self.hidden_init_time = 0.
+        self._server = None
+        self._statistics = {}
+        self._pending = None
+        self._execution = None
+
+    @staticmethod
+    def _get_kernel_settings(settings):
+        return dict((k, settings[k]) for k in KERNEL_SETTINGS
+                    if k in settings)
+
+    @staticmethod
+    def _is_equal(settings, other):
+        # the other items, e.g. the DOM efficiency and angular acceptance,
+        # are only used by the client modules
+        if other is None:
+            return False
+        settings = PersistentCLSimServer._get_kernel_settings(settings)
+        other = PersistentCLSimServer._get_kernel_settings(other)
+        if sorted(settings.keys()) != sorted(other.keys()):
+            return False
+        for k, v in settings.items():
+            if other[k] != v:
+                return False
+        return True
+
+    def _build(self, config, seed):
+        # the propagators get their own random service, so that they
+        # do not depend on the random numbers drawn by the tray
+        converters = setupPropagators(
+            phys_services.I3GSLRandomService(seed), config,
+            UseGPUs=self.cfg['UseGPUs'],
+            UseCPUs=not self.cfg['UseGPUs'],
+            OverrideApproximateNumberOfWorkItems=self.cfg[
+                                    'OverrideApproximateNumberOfWorkItems'],
+            DoNotParallelize=self.cfg['DoNotParallelize'],
+            UseOnlyDeviceNumber=self.cfg['UseOnlyDeviceNumber']
+        )
+        return clsim.I3CLSimStepToPhotonConverterSeries(converters)
+
+    def _serve(self, config, seed, address, conn):
+        # runs in the server process until it is stopped
+        build_start = time.time()
+        try:
+            server = clsim.I3CLSimServer(address, self._build(config, seed))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+            return
+        conn.send(('ready', build_start, time.time()))
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                break
+            if request != 'statistics':
+                break
+            conn.send(dict(server.GetStatistics().items()))
+        del server
+
+    def _start(self, config, settings, seed):
+        location = tempfile.mkstemp(prefix='clsim-server-')[1]
+        conn, server_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=self._serve,
+            args=(config, seed, 'ipc://'+location, server_conn))
+        process.daemon = True
+        process.start()
+        server_conn.close()
+        return {'process': process, 'conn': conn, 'location': location,
+                'address': 'ipc://'+location, 'settings': dict(settings),
+                'seed': seed, 'build_interval': None}
+
+    def _wait(self, server):
+        try:
+            message = server['conn'].recv()
+        except EOFError:
+            message = ('error', 'The server process exited with code '
+                       '{}'.format(server['process'].exitcode))
+        if message[0] != 'ready':
+            self._stop(server)
+            raise RuntimeError(
+                'Failed to build the CLSim server:\n{}'.format(message[1]))
+        server['build_interval'] = message[1:]
+
+    @staticmethod
+    def _stop(server):
+        if server is None:
+            return
+        if server['build_interval'] is None:
+            # an unused build is not finished
+            server['process'].terminate()
+        else:
+            try:
+                server['conn'].send('stop')
+            except (IOError, OSError):
+                pass
+            server['process'].join(60.)
+            if server['process'].is_alive():
+                server['process'].terminate()
+        server['process'].join()
+        server['conn'].close()
+        if os.path.exists(server['location']):
+            os.unlink(server['location'])
+
+    def prepare(self, config, settings, seed):
+        """Start building the propagators of the next model.
+
+        Parameters
+        ----------
+        config : dict
+            The CLSim configuration of the model.
+        settings : dict
+            The items of the configuration that are changed by the model.
+        seed : int
+            Seed of the random service of the propagators.
+        """
+        if self._server is not None and \
+                self._is_equal(settings, self._server['settings']):
+            return
+        self._stop(self._pending)
+        self._pending = self._start(config, settings, seed)
+
+    def record_execution(self, start, end):
+        """Record when the tray of the current model was executed.
+
+        The part of the build of a prepared server that overlaps with the
+        execution is counted as hidden initialization time.
+
+        Parameters
+        ----------
+        start : float
+            Start of the execution as returned by time.time().
+        end : float
+            End of the execution.
+        """
+        self._execution = (start, end)
+
+    def setup(self, config, settings, seed):
+        """Get a server for the given model.
+
+        Parameters
+        ----------
+        config : dict
+            The CLSim configuration of the model.
+        settings : dict
+            The items of the configuration that are changed by the model.
+        seed : int
+            Seed of the random service of the propagators.
+
+        Returns
+        -------
+        str
+            The address of the server.
+        """
+        if self._server is not None and \
+                self._is_equal(settings, self._server['settings']):
+            return self._server['address']
+
+        pending, self._pending = self._pending, None
+        if pending is not None and pending['seed'] == seed and \
+                self._is_equal(settings, pending['settings']):
+            self._wait(pending)
+            if self._execution is not None:
+                build_start, build_end = pending['build_interval']
+                self.hidden_init_time += max(
+                    min(build_end, self._execution[1]) -
+                    max(build_start, self._execution[0]), 0.)
+            self._stop(self._server)
+            server = pending
+        else:
+            self._stop(pending)
+            # free the devices before the new kernels are compiled
+            self._stop(self._server)
+            self._server = None
+            server = self._start(config, settings, seed)
+            self._wait(server)
+        self._server = server
+        self._statistics = {}
+        self.num_setups += 1
+        return server['address']
+
+    def get_statistics(self):
+        """Get the statistics of the server since the last call.
+
+        Returns
+        -------
+        dict
+            The statistics. Totals and counters only include the photons
+            propagated since the last call.
+        """
+        self._server['conn'].send('statistics')
+        statistics = {}
+        for k, v in self._server['conn'].recv().items():
+            if k.startswith('Total') or k.startswith('Num'):
+                statistics[k] = v - self._statistics.get(k, 0.)
+                self._statistics[k] = v
             else:
-                summary[k] = v
+                statistics[k] = v
+        return statistics
+
+    def close(self):
+        """Stop the server processes and remove their sockets."""
+        self._stop(self._pending)
+        self._pending = None
+        self._stop(self._server)
+        self._server = None
+
+
+class PropagationStream(object):
+    """Propagator setup of one distance split stream.
+
+    Every stream has its own baseline detector setup with the oversize
+    factor of the stream, its own CLSim server and its own StepGenerator.
+
+    Parameters
+    ----------
+    cfg : dict
+        Dictionary with configuration settings.
+    clsimParams : dict
+        The baseline detector setup of the stream.
+    stream : OversizeStream, optional
+        The distance split stream. None if the events are not split.
+    """
+
+    def __init__(self, cfg, clsimParams, stream=None):
+        self.clsimParams = clsimParams
+        self.stream = stream
+        self.server = PersistentCLSimServer(cfg)
+        self.client_args = dict(cfg['ExtraArgumentsToI3CLSimClientModule'])
+        if stream is None:
+            self.name = 'I3CLSimMakePhotons'
+        else:
+            self.name = 'I3CLSimMakePhotons_{}'.format(stream.stream_name)
+
+    def get_config(self, settings):
+        """Get the CLSim configuration of a model.
+
+        Parameters
+        ----------
+        settings : dict
+            The items of the configuration that are changed by the model.
+
+        Returns
+        -------
+        dict
+            The configuration.
+        """
+        config = dict(self.clsimParams)
+        config.update(settings)
+        return config
+
+
+class MergedStreams(object):
+    """Read the distance split streams of a run in the generated order.
+
+    The events of the streams are merged by the index stamped by the
+    OversizeSplitterNSplits. Only the first S frame is kept. Like the
+    I3FrameSequence used for a single input file, the object is an iterator
+    over the frames and can be shared by consecutive trays.
+
+    Parameters
+    ----------
+    infiles : list of str
+        The input files of the streams.
+    """
+
+    def __init__(self, infiles):
+        self._i3files = [dataio.I3File(infile) for infile in infiles]
+        self._frames = self._iter_frames()
+        self._next = next(self._frames, None)
+
+    def _iter_frames(self):
+        has_s_frame = False
+        for frames in iter_merged_events(self._i3files):
+            for frame in frames:
+                if frame.Stop == icetray.I3Frame.Stream('S'):
+                    if has_s_frame:
+                        continue
+                    has_s_frame = True
+                yield frame
+
+    def more(self):
+        return self._next is not None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._next is None:
+            raise StopIteration
+        frame = self._next
+        self._next = next(self._frames, None)
+        return frame
+
+    next = __next__
+
+
+class ModelWriter(object):
+    """Append the output of the per-model trays to a single file.
+
+    The I3Writer of each tray writes the frames of its model to a temporary
+    file. A completed model is appended to the input of a single compression
+    process while the next model is propagated, so the output is one
+    compressed stream with all completed models. The frames of a failed
+    model are never appended.
+
+    Parameters
+    ----------
+    outfile : str
+        Path to the output file. The compression is given by its extension.
+    tmp_dir : str
+        Directory for the files of the models.
+    """
+
+    def __init__(self, outfile, tmp_dir):
+        self.outfile = outfile
+        # the next model is written while the previous one is appended
+        self._model_files = [os.path.join(tmp_dir, 'model_{}.i3'.format(i))
+                             for i in range(2)]
+        self.completed_models = 0
+        self._file = open(outfile, 'wb')
+        self._compression = subprocess.Popen(
+            get_compress_command(outfile),
+            stdin=subprocess.PIPE, stdout=self._file)
+        self._append = None
+
+    @property
+    def model_file(self):
+        """The file the frames of the current model are written to."""
+        return self._model_files[self.completed_models % 2]
+
+    def _wait_for_append(self):
+        if self._append is None:
+            return
+        return_code = self._append.wait()
+        self._append = None
+        if return_code != 0:
+            raise IOError('Failed to append a model to {}: cat exited with '
+                          'code {}'.format(self.outfile, return_code))
+
+    def finish_model(self):
+        """Start appending the frames of the completed model."""
+        self._wait_for_append()
+        self._append = subprocess.Popen(['cat', self.model_file],
+                                        stdout=self._compression.stdin)
+        self.completed_models += 1
+
+    def close(self):
+        """Append the last completed model and finish the output."""
+        if self._file.closed:
+            return
+        try:
+            self._wait_for_append()
+        finally:
+            self._compression.stdin.close()
+            return_code = self._compression.wait()
+            self._file.close()
+        if return_code != 0:
+            raise IOError('Failed to write {}: compression exited with '
+                          'code {}'.format(self.outfile, return_code))
+
+
+def write_summary(cfg, summary):
+    """Calculate averages and write the summary file.
+
+    Parameters
+    ----------
+    cfg : dict
+        Dictionary with configuration settings.
+    summary : I3MapStringDouble
+        The summary.
+    """
+    print("Writing summary file... ", end='')
+    if cfg['UseGPUs']:
+        if summary.get('TotalHostTime', 0.) > 0.0:
+            summary['DeviceUtilization'] = \
+                summary['TotalDeviceTime']/summary['TotalHostTime']
+        if summary.get('TotalNumPhotonsGenerated', 0.) > 0.0:
+            summary['AverageDeviceTimePerPhoton'] = \
+                summary['TotalDeviceTime']/summary['TotalNumPhotonsGenerated']
+        if summary.get('TotalNumPhotonsGenerated', 0.) > 0.0:
+            summary['AverageHostTimePerPhoton'] = \
+                summary['TotalHostTime']/summary['TotalNumPhotonsGenerated']
+    if cfg['SummaryFile']:
+        with open(cfg['SummaryFile'], 'w') as f:
+            yaml.dump(dict(summary), f)
+    print("done")
+    print('--------')
+    print('Summary:')
+    print('--------')
+    for key, value in summary.items():
+        print('\t{}: {}'.format(key, value))
+    print('--------\n')
 
 
-def run_snowstorm_propagation(cfg, infile, outfile):
+def run_snowstorm_propagation(cfg, infile, outfile, stream_objects=None):
     """Run SnowStorm Propagation.
 
     Adopted from:
@@ -172,9 +780,13 @@ def run_snowstorm_propagation(cfg, infile, outfile):
     cfg : dict
         Dictionary with configuration settings.
     infile : str
-        Path to input file.
+        Path to input file. If the events are split into distance split
+        streams, the input files of the streams are derived from it.
     outfile : str
         Path to output file.
+    stream_objects : list of OversizeStream, optional
+        The distance split streams. Each stream is propagated with its own
+        oversize factor.
     """
 
     start_time = time.time()
@@ -192,6 +804,12 @@ def run_snowstorm_propagation(cfg, infile, outfile):
         # optional
         'UseGPUs': True,
         'SummaryFile': 'summary_snowstorm.yaml',
+        'PrecompileNextModel': True,
+        'PrefetchQueueDepth': 100,
+        'AdaptiveNumEventsPerModel': False,
+        'TargetInitOverhead': 0.1,
+        'MinEventsPerModel': 10,
+        'MaxEventsPerModel': 1000,
 
         'UseOnlyDeviceNumber': None,
         'MCTreeName': 'I3MCTree',
@@ -245,7 +863,7 @@ def run_snowstorm_propagation(cfg, infile, outfile):
     click.echo('\tGCDFile: {}'.format(cfg['gcd']))
     click.echo('\tOutput: {}'.format(outfile))
     for key in ['DOMOversizeFactor', 'UseI3PropagatorService', 'UseGPUs',
-                'SummaryFile']:
+                'PrecompileNextModel', 'PrefetchQueueDepth', 'SummaryFile']:
         click.echo('\t{}: {}'.format(key, cfg[key]))
     click.echo('---------------\n')
 
@@ -270,8 +888,8 @@ def run_snowstorm_propagation(cfg, infile, outfile):
     # this will help construct the baseline characteristics before applying
     # the perturbers
     print("Setting up detector... ", end="")
-    clsimParams = setupDetector(
-        GCDFile=cfg['gcd'],
+    detector_args = dict(
+        GCDFile=get_cached_gcd_file(cfg['gcd']),
         SimulateFlashers=bool(cfg['FlasherInfoVectName'] or
                               cfg['FlasherPulseSeriesName']),
         IceModelLocation=ice_model_location,
@@ -292,16 +910,24 @@ def run_snowstorm_propagation(cfg, infile, outfile):
         CableOrientation=cfg['CableOrientation'],
         IgnoreSubdetectors=cfg['IgnoreSubdetectors'],
     )
+    if stream_objects is None:
+        streams = [PropagationStream(cfg, setupDetector(**detector_args))]
+    else:
+        # every stream uses its own oversize factor
+        streams = []
+        for stream_i in stream_objects:
+            detector_args['DOMOversizeFactor'] = stream_i.oversize_factor
+            streams.append(PropagationStream(
+                cfg, setupDetector(**detector_args), stream_i))
     print("done")
-    print("Setting up OpenCLDevices... ", end="")
-    openCLDevices = configureOpenCLDevices(
-        UseGPUs=cfg['UseGPUs'],
-        UseCPUs=not cfg['UseGPUs'],
-        OverrideApproximateNumberOfWorkItems=cfg[
-                                    'OverrideApproximateNumberOfWorkItems'],
-        DoNotParallelize=cfg['DoNotParallelize'],
-        UseOnlyDeviceNumber=cfg['UseOnlyDeviceNumber'])
-    print("done")
+    if cfg['PrecompileNextModel'] and len(streams) > 1:
+        # every stream would keep two sets of propagators on the devices
+        # and build the next ones at the same time as the other streams
+        print("Disabling PrecompileNextModel for {} distance split "
+              "streams".format(len(streams)))
+        cfg['PrecompileNextModel'] = False
+    # the OpenCL devices are only set up in the CLSim server processes,
+    # OpenCL must not be initialized before they are forked
 
     # -------------------
     # Setup perturbations
@@ -353,20 +979,173 @@ def run_snowstorm_propagation(cfg, infile, outfile):
     print("done")
 
     # Setting up some other things
-    gcdFrames = list(dataio.I3File(cfg['gcd']))
-    inputStream = dataio.I3FrameSequence([infile])
+    gcdFrames = get_gcd_frames(cfg['gcd'])
+    # the input is read ahead of time on a background thread
+    if stream_objects is None:
+        if cfg['PrefetchQueueDepth'] > 0:
+            inputStream = prefetch_files([infile], cfg['PrefetchQueueDepth'])
+        else:
+            inputStream = dataio.I3FrameSequence([infile])
+    else:
+        inputStream = MergedStreams([stream_i.transform_filepath(infile)
+                                     for stream_i in stream_objects])
+        if cfg['PrefetchQueueDepth'] > 0:
+            inputStream = FramePrefetcher(inputStream,
+                                          cfg['PrefetchQueueDepth'])
     summary = dataclasses.I3MapStringDouble()
-    intermediateOutputFiles = []
+
+    # all models are written to the output file directly, the models are
+    # kept next to the output until they are appended
+    tmp_dir = tempfile.mkdtemp(prefix='snowstorm-',
+                               dir=os.path.dirname(os.path.abspath(outfile)))
+    modelWriter = ModelWriter(outfile, tmp_dir)
 
     # --------------
     # Run PhotonProp
     # --------------
 
-    # start a model counter
-    model_counter = 0
-
     # Execute photon propagation
     print("Executing photon propagation...", end="")
+    try:
+        run_models(cfg, streams, perturber, random_service, summary,
+                   gcdFrames, inputStream, modelWriter)
+        modelWriter.close()
+    except Exception:
+        # keep the completed models and a record of them
+        modelWriter.close()
+        summary["CompletedModels"] = modelWriter.completed_models
+        if isinstance(inputStream, FramePrefetcher):
+            for k, v in inputStream.statistics().items():
+                summary[k] = v
+        write_summary(cfg, summary)
+        raise
+    finally:
+        for stream in streams:
+            stream.server.close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    print("done")
+
+    # Add number of models to summary
+    summary["TotalNumberOfModels"] = modelWriter.completed_models
+    summary["NumCLSimServerSetups"] = sum(
+        stream.server.num_setups for stream in streams)
+    # the servers are only reused if the medium properties and the
+    # wavelength bias are not perturbed, e.g. not with the default
+    # Scattering and Absorption perturbations
+    summary["NumCLSimServerReuses"] = max(
+        modelWriter.completed_models * len(streams) -
+        summary["NumCLSimServerSetups"], 0)
+    summary["HiddenCLSimInitTime"] = sum(
+        stream.server.hidden_init_time for stream in streams)
+    if isinstance(inputStream, FramePrefetcher):
+        for k, v in inputStream.statistics().items():
+            summary[k] = v
+
+    # Recalculate averages
+    write_summary(cfg, summary)
+
+    # Hurray!
+    print("All finished!")
+    # say something about the runtime
+    end_time = time.time()
+    print("That took "+str(end_time - start_time)+" seconds.")
+
+
+def draw_model(clsimParams, perturber, random_service):
+    """Draw a perturbed ice model.
+
+    Parameters
+    ----------
+    clsimParams : dict
+        The baseline detector setup.
+    perturber : Perturber
+        Draws the perturbed ice models.
+    random_service : I3RandomService
+        The random service.
+
+    Returns
+    -------
+    model : I3Frame
+        The M frame with the perturbed items.
+    settings : dict
+        The items of the configuration that are changed by the model.
+    seed : int
+        Seed for the random service of the propagators.
+    """
+    # make a mutable copy of the config dict
+    config = dict(clsimParams)
+    # populate the M frame with I3FrameObjects from clsimParams
+    model = icetray.I3Frame('M')
+    for k, v in config.items():
+        if isinstance(v, icetray.I3FrameObject):
+            model[k] = v
+    # apply perturbations in the order they were configured
+    perturber.perturb(random_service, model)
+    # check for items in the M-frame that were changed/added
+    # by the perturbers
+    for k in model.keys():
+        if k.startswith('Snowstorm'):
+            # keep all Snowstorm keys
+            continue
+        if k not in config:
+            msg = "\n {} was put in the M frame, but does not appear in "
+            msg += "the CLSim configuration dict"
+            raise KeyError(msg.format(k))
+
+        if config[k] != model[k]:
+            # if an items was changed, copy it back to clsimParams
+            config[k] = model[k]
+        else:
+            # remove unmodified items from the M frame
+            del model[k]
+    settings = dict((k, config[k]) for k in model.keys()
+                    if not k.startswith('Snowstorm'))
+    seed = random_service.integer(2**31 - 1)
+    return model, settings, seed
+
+
+def run_models(cfg, streams, perturber, random_service, summary,
+               gcdFrames, inputStream, modelWriter):
+    """Propagate the events with a new ice model every NumEventsPerModel.
+
+    Parameters
+    ----------
+    cfg : dict
+        Dictionary with configuration settings.
+    streams : list of PropagationStream
+        The propagator setups of the streams.
+    perturber : Perturber
+        Draws the perturbed ice models.
+    random_service : I3RandomService
+        The random service.
+    summary : I3MapStringDouble
+        The summary the statistics are added to.
+    gcdFrames : list of I3Frame
+        The frames of the GCD file.
+    inputStream : I3FrameSequence or MergedStreams
+        The input frames.
+    modelWriter : ModelWriter
+        Writes the output of the models.
+    """
+    if cfg['AdaptiveNumEventsPerModel']:
+        controller = EventsPerModelController(
+            num_events=cfg['NumEventsPerModel'],
+            min_events=cfg['MinEventsPerModel'],
+            max_events=cfg['MaxEventsPerModel'],
+            target_overhead=cfg['TargetInitOverhead'])
+    else:
+        controller = None
+    num_events = cfg['NumEventsPerModel']
+
+    # the M frames are built from the baseline of the first stream,
+    # the perturbed items are the same for all streams
+    clsimParams = streams[0].clsimParams
+
+    model_counter = 0
+    # the next model is always drawn before the current one is propagated,
+    # so the random numbers do not depend on PrecompileNextModel
+    next_model = draw_model(clsimParams, perturber, random_service)
     while inputStream.more():
         # measure CLSimInit time
         time_CLSimInit_start = time.time()
@@ -374,101 +1153,96 @@ def run_snowstorm_propagation(cfg, infile, outfile):
         tray = I3Tray()
         tray.context['I3RandomService'] = random_service
         tray.context['I3SummaryService'] = summary
-        # make a mutable copy of the config dict
-        config = dict(clsimParams)
-        # populate the M frame with I3FrameObjects from clsimParams
-        model = icetray.I3Frame('M')
-        for k, v in config.items():
-            if isinstance(v, icetray.I3FrameObject):
-                model[k] = v
-        # apply perturbations in the order they were configured
-        perturber.perturb(random_service, model)
-        # check for items in the M-frame that were changed/added
-        # by the perturbers
-        for k in model.keys():
-            if k.startswith('Snowstorm'):
-                # keep all Snowstorm keys
-                continue
-            if k not in config:
-                msg = "\n {} was put in the M frame, but does not appear in "
-                msg += "the CLSim configuration dict"
-                raise KeyError(msg.format(k))
-
-            if config[k] != model[k]:
-                # if an items was changed, copy it back to clsimParams
-                config[k] = model[k]
-            else:
-                # remove unmodified items from the M frame
-                del model[k]
+        model, settings, seed = next_model
+        if controller is not None:
+            num_events = controller.num_events
+        # the number of events is needed for the weighting
+        model['SnowstormNumEvents'] = icetray.I3Int(num_events)
+        summary["NumEventsPerModel_{:03d}".format(model_counter)] = num_events
 
         # add "persistent" I3Reader
         tray.Add(FrameSequenceReader,
                  Sequence=itertools.chain(gcdFrames, [model], inputStream))
 
         # inject an S frame if it doesn't exist
-        tray.Add(EnsureSFrame, Enable=len(intermediateOutputFiles) == 0)
+        tray.Add(EnsureSFrame, Enable=model_counter == 0)
 
         # write pertubations to frame
         def populate_s_frame(frame):
             perturber.to_frame(frame)
+            if controller is not None:
+                controller.to_frame(frame)
         tray.Add(populate_s_frame, Streams=[icetray.I3Frame.Stream('S')])
 
-        # Add Bumper to stop the tray after NumEventsPerModel Q-frames
-        tray.Add(Bumper, NumFrames=cfg['NumEventsPerModel'])
-
-        # initialize CLSim server and setup the propagators
-        server_location = tempfile.mkstemp(prefix='clsim-server-')[1]
-        address = 'ipc://'+server_location
-        converters = setupPropagators(
-            random_service, config,
-            UseGPUs=cfg['UseGPUs'],
-            UseCPUs=not cfg['UseGPUs'],
-            OverrideApproximateNumberOfWorkItems=cfg[
-                                    'OverrideApproximateNumberOfWorkItems'],
-            DoNotParallelize=cfg['DoNotParallelize'],
-            UseOnlyDeviceNumber=cfg['UseOnlyDeviceNumber']
-        )
-        server = clsim.I3CLSimServer(
-            address, clsim.I3CLSimStepToPhotonConverterSeries(converters))
-
-        # stash server instance in the context to keep it alive
-        tray.context['CLSimServer'] = server
-
-        # recycle StepGenerator to prevent repeated, expensive initialization
-        if 'StepGenerator' in cfg['ExtraArgumentsToI3CLSimClientModule']:
-            stepGenerator = \
-                cfg['ExtraArgumentsToI3CLSimClientModule']['StepGenerator']
-            stepGenerator.SetMediumProperties(config['MediumProperties'])
-            stepGenerator.SetWlenBias(config['WavelengthGenerationBias'])
-
-        # add CLSim server to tray
-        module_config = \
-            tray.Add(
-                I3CLSimMakePhotonsWithServer,
-                ServerAddress=address,
-                DetectorSettings=config,
-                MCTreeName=cfg['MCTreeName'],
-                OutputMCTreeName=cfg['OutputMCTreeName'],
-                FlasherInfoVectName=cfg['FlasherInfoVectName'],
-                FlasherPulseSeriesName=cfg['FlasherPulseSeriesName'],
-                PhotonSeriesName=cfg['PhotonSeriesName'],
-                MCPESeriesName=cfg['MCPESeriesName'],
-                RandomService=random_service,
-                ParticleHistory=cfg['ParticleHistory'],
-                ParticleHistoryGranularity=cfg['ParticleHistoryGranularity'],
-                ExtraArgumentsToI3CLSimClientModule=cfg[
-                                        'ExtraArgumentsToI3CLSimClientModule'],
-            )
-
-        # recycle StepGenerator to prevent repeated, expensive initialization
-        cfg['ExtraArgumentsToI3CLSimClientModule']['StepGenerator'] = \
-            module_config['StepGenerator']
-
-        # write to temporary output file
-        intermediateOutputFiles.append(
-            tempfile.mkstemp(suffix=(outfile.split("/"))[-1])[1])
+        # Add Bumper to stop the tray after num_events Q-frames
+        tray.Add(Bumper, NumFrames=num_events)
+
+        # the events of the streams leave their client modules out of order
+        if len(streams) > 1:
+            frameOrder = FrameOrder()
+            tray.Add(RecordFrameOrder, FrameOrder=frameOrder)
+
+        for stream in streams:
+            config = stream.get_config(settings)
+            # get a CLSim server for this model, the propagators are only
+            # rebuilt if the model changed the settings they are compiled from.
+            # The streams are set up one after another.
+            time_stream_init_start = time.time()
+            address = stream.server.setup(config, settings, seed)
+            if stream.stream is not None:
+                time_stream_init = time.time() - time_stream_init_start
+                key = "CLSimInitTime_{}".format(stream.stream.stream_name)
+                summary["{}_{:03d}".format(key, model_counter)] = \
+                    time_stream_init
+                summary["Total" + key] = \
+                    summary.get("Total" + key, 0.) + time_stream_init
+
+            # recycle StepGenerator to prevent repeated, expensive
+            # initialization
+            if 'StepGenerator' in stream.client_args:
+                stepGenerator = stream.client_args['StepGenerator']
+                stepGenerator.SetMediumProperties(config['MediumProperties'])
+                stepGenerator.SetWlenBias(config['WavelengthGenerationBias'])
+
+            # only the events of the stream are propagated by its server
+            stream_args = {}
+            if stream.stream is not None:
+                stream_args['If'] = stream.stream
+
+            # add CLSim server to tray
+            module_config = \
+                tray.Add(
+                    I3CLSimMakePhotonsWithServer, stream.name,
+                    ServerAddress=address,
+                    DetectorSettings=config,
+                    MCTreeName=cfg['MCTreeName'],
+                    OutputMCTreeName=cfg['OutputMCTreeName'],
+                    FlasherInfoVectName=cfg['FlasherInfoVectName'],
+                    FlasherPulseSeriesName=cfg['FlasherPulseSeriesName'],
+                    PhotonSeriesName=cfg['PhotonSeriesName'],
+                    MCPESeriesName=cfg['MCPESeriesName'],
+                    RandomService=random_service,
+                    ParticleHistory=cfg['ParticleHistory'],
+                    ParticleHistoryGranularity=cfg[
+                                            'ParticleHistoryGranularity'],
+                    ExtraArgumentsToI3CLSimClientModule=stream.client_args,
+                    **stream_args
+                )
+
+            # recycle StepGenerator to prevent repeated, expensive
+            # initialization
+            stream.client_args['StepGenerator'] = \
+                module_config['StepGenerator']
+
+        if len(streams) > 1:
+            tray.Add(RestoreFrameOrder, FrameOrder=frameOrder)
+
+        # stash server instances in the context for the statistics
+        tray.context['CLSimServers'] = [stream.server for stream in streams]
+
+        # append to the output file
         tray.Add("I3Writer",
-                 Filename=intermediateOutputFiles[-1],
+                 Filename=modelWriter.model_file,
                  DropOrphanStreams=[icetray.I3Frame.TrayInfo],
                  Streams=[icetray.I3Frame.TrayInfo,
                           icetray.I3Frame.Simulation,
@@ -489,8 +1263,21 @@ def run_snowstorm_propagation(cfg, infile, outfile):
         # measure CLSimTray time
         time_CLSimTray_start = time.time()
 
+        # draw the next model and build its propagators in the background
+        next_model = draw_model(clsimParams, perturber, random_service)
+        if cfg['PrecompileNextModel']:
+            _, next_settings, next_seed = next_model
+            for stream in streams:
+                stream.server.prepare(stream.get_config(next_settings),
+                                      next_settings, next_seed)
+
         # Execute Tray
+        num_photons_start = summary.get("TotalNumPhotonsGenerated", 0.)
+        time_execute_start = time.time()
         tray.Execute()
+        for stream in streams:
+            stream.server.record_execution(time_execute_start, time.time())
+        modelWriter.finish_model()
 
         # measure CLSimTray time
         time_CLSimTray = time.time() - time_CLSimTray_start
@@ -499,66 +1286,20 @@ def run_snowstorm_propagation(cfg, infile, outfile):
             summary["TotalCLSimTrayTime"] = time_CLSimTray
         else:
             summary["TotalCLSimTrayTime"] += time_CLSimTray
-        # remove the temp file made by the server location thingy
-        os.unlink(server_location)
+
+        # choose the number of events of the next model. All but the last
+        # model are stopped by the Bumper after num_events events.
+        if controller is not None:
+            controller.update(
+                init_time=time_CLSimInit,
+                tray_time=time_CLSimTray,
+                num_events=num_events,
+                num_photons=summary.get("TotalNumPhotonsGenerated", 0.) -
+                num_photons_start)
 
         # increase model counter
         model_counter += 1
 
-    print("done")
-
-    # Add number of models to summary
-    summary["TotalNumberOfModels"] = model_counter
-
-    # Concatenate intermediate files
-    print("Concatenating temporary files... ", end='')
-    tray = I3Tray()
-    tray.Add(dataio.I3Reader, "I3Reader", FilenameList=intermediateOutputFiles)
-    tray.Add("I3Writer", Filename=outfile,
-             DropOrphanStreams=[icetray.I3Frame.TrayInfo],
-             Streams=[icetray.I3Frame.TrayInfo,
-                      icetray.I3Frame.Simulation,
-                      icetray.I3Frame.Stream('M'),
-                      icetray.I3Frame.DAQ,
-                      icetray.I3Frame.Physics])
-    tray.Execute()
-    tray.Finish()
-    print("done")
-
-    print("Cleaning up Temporary files... ")
-    for fname in intermediateOutputFiles:
-        os.unlink(fname)
-    print("done")
-
-    # Recalculate averages
-    print("Writing summary file... ", end='')
-    if cfg['UseGPUs']:
-        if summary['TotalHostTime'] > 0.0:
-            summary['DeviceUtilization'] = \
-                summary['TotalDeviceTime']/summary['TotalHostTime']
-        if summary['TotalNumPhotonsGenerated'] > 0.0:
-            summary['AverageDeviceTimePerPhoton'] = \
-                summary['TotalDeviceTime']/summary['TotalNumPhotonsGenerated']
-        if summary['TotalNumPhotonsGenerated'] > 0.0:
-            summary['AverageHostTimePerPhoton'] = \
-                summary['TotalHostTime']/summary['TotalNumPhotonsGenerated']
-    if cfg['SummaryFile']:
-        with open(cfg['SummaryFile'], 'w') as f:
-            yaml.dump(dict(summary), f)
-    print("done")
-    print('--------')
-    print('Summary:')
-    print('--------')
-    for key, value in summary.items():
-        print('\t{}: {}'.format(key, value))
-    print('--------\n')
-
-    # Hurray!
-    print("All finished!")
-    # say something about the runtime
-    end_time = time.time()
-    print("That took "+str(end_time - start_time)+" seconds.")
-
 
 @click.command()
 @click.argument('cfg', type=click.Path(exists=True))
@@ -580,7 +1321,16 @@ def main(cfg, run_number, scratch):
     outfile = outfile.replace(' ', '0')
 
     if cfg.get('distance_splits', False):
-        raise NotImplementedError('Distance splits are not supported!')
+        distance_splits = np.atleast_1d(cfg['distance_splits'])
+        dom_limits = np.atleast_1d(cfg['threshold_doms'])
+        if len(dom_limits) == 1:
+            dom_limits = np.ones_like(distance_splits) * cfg['threshold_doms']
+        oversize_factors = np.atleast_1d(cfg['oversize_factors'])
+        order = np.argsort(distance_splits)
+        stream_objects = generate_stream_object(distance_splits[order],
+                                                dom_limits[order],
+                                                oversize_factors[order])
+        run_snowstorm_propagation(cfg, infile, outfile, stream_objects)
     else:
         run_snowstorm_propagation(cfg, infile, outfile)
 
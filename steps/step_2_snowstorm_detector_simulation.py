@@ -9,6 +9,7 @@ from icecube.simprod import segments
 from I3Tray import I3Tray
 from icecube import icetray, dataclasses, dataio, phys_services
 from utils import create_random_services, get_run_folder
+from resources.gcd_cache import get_cached_gcd_file
 
 # Load libraries
 from icecube import clsim
@@ -58,7 +59,8 @@ def main(cfg, run_number, scratch):
     random_service = random_services[0]
     tray.context['I3RandomService'] = random_service
 
-    tray.Add('I3Reader', FilenameList=[cfg['gcd_pass2'], infile])
+    tray.Add('I3Reader', FilenameList=[
+        get_cached_gcd_file(cfg['gcd_pass2']), infile])
 
     """
     Perform Detector simulation:
@@ -105,7 +107,7 @@ def main(cfg, run_number, scratch):
     tray.AddSegment(segments.DetectorSim, "DetectorSim",
                     RandomService='I3RandomService',
                     RunID=run_id,
-                    GCDFile=cfg['gcd_pass2'],
+                    GCDFile=get_cached_gcd_file(cfg['gcd_pass2']),
                     KeepMCHits=cfg['det_keep_mc_hits'],
                     KeepPropagatedMCTree=cfg['det_keep_propagated_mc_tree'],
                     KeepMCPulses=cfg['det_keep_mc_pulses'],
@@ -119,6 +121,8 @@ def main(cfg, run_number, scratch):
                         "SnowstormParameters",
                         "SnowstormParametrizations",
                         "SnowstormProposalDistribution",
+                        "SnowstormNumEvents",
+                        "SnowstormNumEventsPerModel",
                         "WavelengthAcceptance",
                         "WavelengthGenerationBias",
                         "LeptonInjectorProperties",
@@ -6,6 +6,7 @@ import click
 import yaml
 
 from utils import get_run_folder, muongun_keys, create_random_services
+from resources.gcd_cache import get_cached_gcd_file
 
 from I3Tray import I3Tray
 from icecube import icetray, dataclasses, dataio, jeb_filter_2012
@@ -58,7 +59,7 @@ def main(config_file, run_number, scratch):
     tray = I3Tray()
     tray.AddModule('I3Reader',
                    'reader',
-                   FilenameList=[cfg['gcd_2012'], infile],
+                   FilenameList=[get_cached_gcd_file(cfg['gcd_2012']), infile],
                    SkipKeys=['I3DST11',
                              'I3SuperDST',
                              'I3VEMCalData',
@@ -122,7 +123,7 @@ def main(config_file, run_number, scratch):
         tray.AddModule("Delete",
                        "delete_triggerHierarchy",
                        Keys=["I3TriggerHierarchy", "TimeShift"])
-        gcd_file = dataio.I3File(cfg['gcd_2012'])
+        gcd_file = dataio.I3File(get_cached_gcd_file(cfg['gcd_2012']))
         tray.AddSegment(trigger_sim.TriggerSim,
                         "trig",
                         gcd_file=gcd_file)
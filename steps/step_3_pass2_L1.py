@@ -20,6 +20,7 @@ from os.path import expandvars
 
 
 from utils import get_run_folder, muongun_keys, create_random_services
+from resources.gcd_cache import get_cached_gcd_file
 
 
 SPLINE_TABLES = '/cvmfs/icecube.opensciencegrid.org/data/photon-tables/splines'
@@ -59,7 +60,8 @@ def main(cfg, run_number, scratch):
     """The main L1 script"""
     tray.AddModule('I3Reader',
                    'i3 reader',
-                   FilenameList=[cfg['gcd_pass2'], infile])
+                   FilenameList=[get_cached_gcd_file(cfg['gcd_pass2']),
+                                  infile])
 
     # run online filters
     online_kwargs = {}
@@ -6,6 +6,7 @@ import time
 
 import click
 import yaml
+import numpy as np
 
 from I3Tray import I3Tray, I3Units
 from icecube import icetray, dataclasses, simclasses
@@ -16,13 +17,24 @@ from icecube.STTools.seededRT.configuration_services import \
 from icecube import filter_tools
 
 from utils import get_run_folder
+from resources.gcd_cache import get_cached_gcd_file
 from step_3_pass2_get_pulses import MergeOversampledEvents
+from step_3_pass2_get_pulses import get_compact_pulse_keys
+from step_3_pass2_get_pulses import has_compact_pulses
+from step_3_pass2_get_pulses import get_pulse_series
 
 
 class GetMCPulses(icetray.I3ConditionalModule):
 
     """Creates I3RecoPulseSeriesMap from I3MCPESeriesMap and optionally
     creates and inserts new Physics-frames.
+
+    With CompactOutput, the MC pulses are instead stored as per-DOM time
+    and charge vectors in '{OutputKey}Times' and '{OutputKey}Charges' and
+    there is no I3RecoPulseSeriesMap under OutputKey. Modules that read
+    the MC pulses as an I3RecoPulseSeriesMap fail on these frames unless
+    ExpandCompactPulses is added in front of them. MergeOversampledEvents
+    handles both formats.
     """
 
     def __init__(self, context):
@@ -34,6 +46,10 @@ class GetMCPulses(icetray.I3ConditionalModule):
                           'MCPulses')
         self.AddParameter('CreatePFrames', 'Create P frames from q frames?.',
                           True)
+        self.AddParameter('CompactOutput',
+                          'Store the MC pulses as per-DOM time and charge '
+                          'vectors instead of an I3RecoPulseSeriesMap?',
+                          False)
 
     def Configure(self):
         """Configure the module.
@@ -41,10 +57,14 @@ class GetMCPulses(icetray.I3ConditionalModule):
         self._mcpe_series = self.GetParameter('I3MCPESeriesMap')
         self._output_key = self.GetParameter('OutputKey')
         self._create_p_frames = self.GetParameter('CreatePFrames')
+        self._compact_output = self.GetParameter('CompactOutput')
 
         assert isinstance(self._create_p_frames, bool), \
             'Expected CreatePFrames to be a boolean, but got {!r}'.format(
                 self._create_p_frames)
+        assert isinstance(self._compact_output, bool), \
+            'Expected CompactOutput to be a boolean, but got {!r}'.format(
+                self._compact_output)
 
     def DAQ(self, frame):
         """Create P-frames and add MC pulses.
@@ -100,6 +120,10 @@ class GetMCPulses(icetray.I3ConditionalModule):
         mcpe_series_map : I3MCPESeriesMap
             The I3MCPESeriesMap which will be converted.
         '''
+        if self._compact_output:
+            self._add_compact_mc_pulses(frame, mcpe_series_map)
+            return
+
         mc_pulse_map = dataclasses.I3RecoPulseSeriesMap()
         for omkey, mcpe_series in mcpe_series_map.items():
 
@@ -120,6 +144,81 @@ class GetMCPulses(icetray.I3ConditionalModule):
         # write to frame
         frame[self._output_key] = mc_pulse_map
 
+    def _add_compact_mc_pulses(self, frame, mcpe_series_map):
+        '''Create compact MC pulses from I3MCPESeriesMap
+
+        The times and the number of photo electrons (npe) of each DOM are
+        collected in contiguous arrays and stored as I3VectorDouble.
+        This avoids the creation of an I3RecoPulse object per MCPE. The
+        MCPEs can only be read one by one through their python wrappers,
+        so time and npe are read in a single pass over the series.
+
+        Parameters
+        ----------
+        frame : I3Frame
+            The I3Frame to which the MC Pulses will be added to.
+        mcpe_series_map : I3MCPESeriesMap
+            The I3MCPESeriesMap which will be converted.
+        '''
+        times_map = dataclasses.I3MapKeyVectorDouble()
+        charges_map = dataclasses.I3MapKeyVectorDouble()
+        for omkey, mcpe_series in mcpe_series_map.items():
+            values = np.array([(mcpe.time, mcpe.npe)
+                               for mcpe in mcpe_series],
+                              dtype=float).reshape(-1, 2)
+            times_map[omkey] = dataclasses.I3VectorDouble(values[:, 0])
+            charges_map[omkey] = dataclasses.I3VectorDouble(values[:, 1])
+
+        # write to frame
+        times_key, charges_key = get_compact_pulse_keys(self._output_key)
+        frame[times_key] = times_map
+        frame[charges_key] = charges_map
+
+
+class ExpandCompactPulses(icetray.I3ConditionalModule):
+
+    """Creates an I3RecoPulseSeriesMap from compact pulses as written by
+    GetMCPulses with CompactOutput.
+
+    Add this module in front of modules that require the pulses as an
+    I3RecoPulseSeriesMap.
+    """
+
+    def __init__(self, context):
+        icetray.I3ConditionalModule.__init__(self, context)
+        self.AddParameter('PulseKey',
+                          'Key of the pulses. The compact pulses are read '
+                          'from {PulseKey}Times and {PulseKey}Charges.',
+                          'MCPulses')
+        self.AddParameter('DeleteCompactPulses',
+                          'Remove the compact pulses from the frame after '
+                          'the pulse series map has been created?',
+                          False)
+
+    def Configure(self):
+        """Configure the module.
+        """
+        self._pulse_key = self.GetParameter('PulseKey')
+        self._delete_compact = self.GetParameter('DeleteCompactPulses')
+
+    def Physics(self, frame):
+        """Add the I3RecoPulseSeriesMap to the P-frame.
+
+        Parameters
+        ----------
+        frame : I3Frame
+            The current I3Frame.
+        """
+        if (self._pulse_key not in frame and
+                has_compact_pulses(frame, self._pulse_key)):
+            frame[self._pulse_key] = get_pulse_series(frame, self._pulse_key)
+
+            if self._delete_compact:
+                for key in get_compact_pulse_keys(self._pulse_key):
+                    del frame[key]
+
+        self.PushFrame(frame)
+
 
 @click.command()
 @click.argument('cfg', type=click.Path(exists=True))
@@ -155,13 +254,20 @@ def main(cfg, run_number, scratch, do_merging_if_necessary):
     tray = I3Tray()
     tray.AddModule('I3Reader',
                    'i3 reader',
-                   FilenameList=[cfg['gcd_pass2'], infile])
+                   FilenameList=[get_cached_gcd_file(cfg['gcd_pass2']),
+                                  infile])
+
+    if 'mc_pulses_compact' in cfg:
+        compact_output = cfg['mc_pulses_compact']
+    else:
+        compact_output = False
 
     # get MC pulses
     tray.AddModule(GetMCPulses, "GetMCPulses",
                    I3MCPESeriesMap='I3MCPESeriesMapWithoutNoise',
                    OutputKey='MCPulses',
-                   CreatePFrames=True)
+                   CreatePFrames=True,
+                   CompactOutput=compact_output)
 
     # merge oversampled events: calculate average hits
     if cfg['oversampling_factor'] is not None and do_merging_if_necessary:
@@ -6,6 +6,7 @@ import time
 
 import click
 import yaml
+import numpy as np
 
 from I3Tray import I3Tray, I3Units
 from icecube import icetray, dataclasses
@@ -16,6 +17,7 @@ from icecube.STTools.seededRT.configuration_services import \
 from icecube import filter_tools
 
 from utils import get_run_folder
+from resources.gcd_cache import get_cached_gcd_file
 
 
 @icetray.traysegment
@@ -70,6 +72,357 @@ def GetPulses(tray, name,
                         )
 
 
+def get_compact_pulse_keys(pulse_key):
+    """Get the frame keys of a pulse series map in the compact format.
+
+    The compact format stores the pulse times and charges of each DOM as
+    contiguous vectors in two I3MapKeyVectorDouble objects instead of
+    one I3RecoPulse object per pulse.
+
+    Parameters
+    ----------
+    pulse_key : str
+        The key of the pulse series map.
+
+    Returns
+    -------
+    str, str
+        The keys of the pulse times and charges.
+    """
+    return pulse_key + 'Times', pulse_key + 'Charges'
+
+
+def has_compact_pulses(frame, pulse_key):
+    """Check if the frame holds the pulses in the compact format.
+
+    Parameters
+    ----------
+    frame : I3Frame
+        The current I3Frame.
+    pulse_key : str
+        The key of the pulse series map.
+
+    Returns
+    -------
+    bool
+        True if the compact pulses exist in the frame.
+    """
+    times_key, charges_key = get_compact_pulse_keys(pulse_key)
+    return times_key in frame and charges_key in frame
+
+
+def compact_to_pulse_series(times_map, charges_map):
+    """Create an I3RecoPulseSeriesMap from compact pulses.
+
+    Width and flags of the pulses are left at the I3RecoPulse defaults.
+
+    Parameters
+    ----------
+    times_map : dataclasses.I3MapKeyVectorDouble
+        The pulse times of each DOM.
+    charges_map : dataclasses.I3MapKeyVectorDouble
+        The pulse charges of each DOM.
+
+    Returns
+    -------
+    dataclasses.I3RecoPulseSeriesMap
+        The pulse series map.
+    """
+    pulse_series = dataclasses.I3RecoPulseSeriesMap()
+    for omkey, times in times_map.items():
+        pulses = dataclasses.vector_I3RecoPulse()
+        for pulse_time, charge in zip(times, charges_map[omkey]):
+            pulse = dataclasses.I3RecoPulse()
+            pulse.time = pulse_time
+            pulse.charge = charge
+            pulses.append(pulse)
+        pulse_series[omkey] = pulses
+    return pulse_series
+
+
+def get_pulse_series(frame, pulse_key):
+    """Get the I3RecoPulseSeriesMap from the frame.
+
+    Masks and unions are applied. Pulses in the compact format are only
+    expanded if no pulse series map exists under the pulse key.
+
+    Parameters
+    ----------
+    frame : I3Frame
+        The current I3Frame.
+    pulse_key : str
+        The key of the pulse series map.
+
+    Returns
+    -------
+    dataclasses.I3RecoPulseSeriesMap
+        The pulse series map.
+    """
+    if pulse_key not in frame and has_compact_pulses(frame, pulse_key):
+        times_key, charges_key = get_compact_pulse_keys(pulse_key)
+        return compact_to_pulse_series(frame[times_key], frame[charges_key])
+
+    pulses = frame[pulse_key]
+    if isinstance(pulses, dataclasses.I3RecoPulseSeriesMapMask) or \
+            isinstance(pulses, dataclasses.I3RecoPulseSeriesMapUnion):
+        pulses = pulses.apply(frame)
+    return dataclasses.I3RecoPulseSeriesMap(pulses)
+
+
+# number of pulses of the DOMs that are merged together
+MERGE_BLOCK_SIZE = 50000
+
+
+class OversampledPulseBuffer(object):
+
+    """Collects the pulses of oversampled frames in numpy arrays and merges
+    them with array operations on all DOMs of a frame at once.
+
+    Parameters
+    ----------
+    min_separation : float
+        The minimum time in ns a merged pulse may be separated from a
+        previous one. If it is less, then the two pulses will be merged
+        into a single one.
+    """
+
+    def __init__(self, min_separation):
+        self.min_separation = min_separation
+        self.keys = []
+        self.frames = []
+        self._key_indices = {}
+
+    def _get_key_index(self, key):
+        if key not in self._key_indices:
+            self._key_indices[key] = len(self.keys)
+            self.keys.append(key)
+        return self._key_indices[key]
+
+    def add(self, pulse_series, delta_t=0.):
+        """Add the pulses of an oversampled frame.
+
+        Parameters
+        ----------
+        pulse_series : dataclasses.I3RecoPulseSeriesMap
+            The pulses of the frame.
+        delta_t : float, optional
+            Time shift of the frame relative to the first oversampled frame.
+        """
+        key_indices = []
+        values = []
+        for key, pulses in pulse_series:
+            # a single pass over the pulses of the DOM
+            pulse_values = [(p.time, p.charge, p.width, p.flags)
+                            for p in pulses]
+            key_indices.append(np.full(len(pulse_values),
+                                       self._get_key_index(key), dtype=int))
+            values.extend(pulse_values)
+        values = np.array(values, dtype=float).reshape(-1, 4)
+        self._add_frame(
+            np.concatenate(key_indices) if key_indices else
+            np.empty(0, dtype=int),
+            times=values[:, 0] + delta_t,
+            charges=values[:, 1],
+            widths=values[:, 2],
+            flags=values[:, 3].astype(int))
+
+    def add_compact(self, times_map, charges_map, delta_t=0.):
+        """Add the compact pulses of an oversampled frame.
+
+        Width and flags of the pulses are set to the I3RecoPulse defaults.
+
+        Parameters
+        ----------
+        times_map : dataclasses.I3MapKeyVectorDouble
+            The pulse times of each DOM.
+        charges_map : dataclasses.I3MapKeyVectorDouble
+            The pulse charges of each DOM.
+        delta_t : float, optional
+            Time shift of the frame relative to the first oversampled frame.
+        """
+        default_pulse = dataclasses.I3RecoPulse()
+        key_indices = [np.empty(0, dtype=int)]
+        times = [np.empty(0)]
+        charges = [np.empty(0)]
+        for key, key_times in times_map.items():
+            times.append(np.array(key_times, dtype=float))
+            charges.append(np.array(charges_map[key], dtype=float))
+            key_indices.append(np.full(len(times[-1]),
+                                       self._get_key_index(key), dtype=int))
+        times = np.concatenate(times) + delta_t
+        self._add_frame(
+            np.concatenate(key_indices),
+            times=times,
+            charges=np.concatenate(charges),
+            widths=np.full(len(times), default_pulse.width, dtype=float),
+            flags=np.full(len(times), default_pulse.flags, dtype=int))
+
+    def _add_frame(self, key_indices, times, charges, widths, flags):
+        self.frames.append((key_indices, times, charges, widths, flags))
+
+    def merge(self):
+        """Merge the pulses of all DOMs.
+
+        The frames are merged in the order they were added. The pulses of
+        the first frame that hits a DOM each start a group. A pulse of a
+        later frame is added to the preceding group of its DOM if it is
+        closer than min_separation to the first pulse of that group,
+        otherwise it starts a new group. The groups started by the earlier
+        pulses of the same frame count as preceding groups. The first pulse
+        of a group keeps its time, width and flags and the charges of the
+        group are added.
+
+        Returns
+        -------
+        dict
+            The merged times, charges, widths and flags of each DOM as
+            numpy arrays.
+        """
+        frames = []
+        num_pulses = np.zeros(len(self.keys), dtype=int)
+        for frame in self.frames:
+            # a stable sort keeps pulses with the same time in order
+            order = np.lexsort((frame[1], frame[0]))
+            frames.append([x[order] for x in frame])
+            num_pulses += np.bincount(frame[0], minlength=len(self.keys))
+
+        # the merged groups are copied for every frame, so the DOMs are
+        # merged in blocks of about MERGE_BLOCK_SIZE pulses
+        bounds = np.flatnonzero(np.diff(
+            np.cumsum(num_pulses) // MERGE_BLOCK_SIZE)) + 1
+        bounds = [0] + bounds.tolist() + [len(self.keys)]
+        has_groups = np.zeros(len(self.keys), dtype=bool)
+        pulses = dict((key, (np.empty(0), np.empty(0), np.empty(0),
+                             np.empty(0, dtype=int)))
+                      for key in self.keys)
+        for low, high in zip(bounds[:-1], bounds[1:]):
+            # the groups are sorted by DOM and time with the search keys in
+            # the last array, complex numbers are compared lexicographically
+            merged = [np.empty(0, dtype=int), np.empty(0), np.empty(0),
+                      np.empty(0), np.empty(0, dtype=int),
+                      np.empty(0, dtype=complex)]
+            for frame in frames:
+                start, stop = np.searchsorted(frame[0], [low, high])
+                if start < stop:
+                    merged = self._merge_frame(
+                        merged, has_groups, [x[start:stop] for x in frame])
+
+            key_indices = merged[0]
+            splits = np.flatnonzero(np.diff(key_indices)) + 1
+            starts = [0] + splits.tolist()
+            stops = splits.tolist() + [len(key_indices)]
+            for start, stop in zip(starts, stops):
+                if start < stop:
+                    pulses[self.keys[key_indices[start]]] = tuple(
+                        x[start:stop] for x in merged[1:5])
+        return pulses
+
+    def _merge_frame(self, merged, has_groups, frame):
+        key_indices, times, charges, widths, flags = frame
+        keys = key_indices + 1j * times
+        merged_key_indices, merged_times, merged_charges = merged[:3]
+        merged_keys = merged[5]
+
+        # groups start after the existing pulses with the same time
+        positions = np.searchsorted(merged_keys, keys, side='right')
+        preceding = np.maximum(positions - 1, 0)
+        starts_group = ~has_groups[key_indices]
+        if len(merged_keys) > 0:
+            has_preceding = (positions > 0) & (
+                merged_key_indices[preceding] == key_indices)
+            preceding_times = merged_times[preceding]
+        else:
+            has_preceding = np.zeros(len(times), dtype=bool)
+            preceding_times = np.zeros(len(times))
+
+        # pulses far enough from the preceding existing group start a
+        # group, unless they are close to a group started by this frame
+        starts_group |= ~has_preceding | (
+            times - preceding_times >= self.min_separation)
+        candidates = np.flatnonzero(starts_group)
+        # only a candidate closer than min_separation to the previous
+        # candidate of its DOM can depend on the groups started before it
+        close = np.flatnonzero(
+            (np.diff(times[candidates]) < self.min_separation) &
+            (np.diff(key_indices[candidates]) == 0) &
+            has_groups[key_indices[candidates[1:]]]) + 1
+        if len(close) > 0:
+            candidate_times = times[candidates].tolist()
+            candidate_has_preceding = has_preceding[candidates].tolist()
+            candidate_preceding_times = preceding_times[candidates].tolist()
+            candidate_starts = [True] * len(candidates)
+            last_start_time = None
+            for k in close.tolist():
+                if candidate_starts[k - 1]:
+                    last_start_time = candidate_times[k - 1]
+                if (not candidate_has_preceding[k] or
+                        last_start_time >= candidate_preceding_times[k]) and \
+                        candidate_times[k] - last_start_time < \
+                        self.min_separation:
+                    candidate_starts[k] = False
+            starts_group[candidates] = candidate_starts
+
+        # the last group started by this frame up to each pulse
+        new_groups = np.maximum.accumulate(
+            np.where(starts_group, np.arange(len(times)), -1))
+        joins_new_group = ~starts_group & (new_groups >= 0)
+        joining = np.flatnonzero(joins_new_group)
+        joins_new_group[joining] = \
+            (key_indices[new_groups[joining]] == key_indices[joining]) & (
+                ~has_preceding[joining] |
+                (times[new_groups[joining]] >= preceding_times[joining]))
+        joins_existing_group = ~starts_group & ~joins_new_group
+        np.add.at(merged_charges, positions[joins_existing_group] - 1,
+                  charges[joins_existing_group])
+        np.add.at(charges, new_groups[joins_new_group],
+                  charges[joins_new_group])
+        has_groups[key_indices] = True
+
+        # insert the new groups after the preceding existing groups
+        new_groups = np.flatnonzero(starts_group)
+        slots = positions[new_groups] + np.arange(len(new_groups))
+        is_existing_slot = np.ones(len(merged_keys) + len(slots), dtype=bool)
+        is_existing_slot[slots] = False
+        for j, x in enumerate((key_indices, times, charges, widths,
+                               flags, keys)):
+            values = np.empty(len(is_existing_slot), dtype=x.dtype)
+            values[is_existing_slot] = merged[j]
+            values[slots] = x[new_groups]
+            merged[j] = values
+
+        return merged
+
+    def to_pulse_series(self, charge_scale=1.):
+        """Create the merged pulse series map.
+
+        Parameters
+        ----------
+        charge_scale : float, optional
+            Factor that is applied to all merged charges.
+
+        Returns
+        -------
+        dataclasses.I3RecoPulseSeriesMap
+            Merged pulse series map.
+        """
+        pulse_series = dataclasses.I3RecoPulseSeriesMap()
+        for key, (times, charges, widths, flags) in self.merge().items():
+            charges = charges * charge_scale
+            # plain Python numbers are converted faster than numpy scalars
+            pulses = dataclasses.vector_I3RecoPulse()
+            for pulse_time, charge, width, flag in zip(
+                    times.tolist(), charges.tolist(), widths.tolist(),
+                    flags.tolist()):
+                pulse = dataclasses.I3RecoPulse()
+                pulse.time = pulse_time
+                pulse.charge = charge
+                pulse.width = width
+                pulse.flags = flag
+                pulses.append(pulse)
+            pulse_series[key] = pulses
+        return pulse_series
+
+
 class MergeOversampledEvents(icetray.I3ConditionalModule):
 
     def __init__(self, context):
@@ -92,17 +445,15 @@ class MergeOversampledEvents(icetray.I3ConditionalModule):
         self.current_aggregation_frame = None
         self.current_daq_frame = None
         self.oversampling_counter = None
+        self.pulse_buffer = None
         self.pushed_frame_already = False
 
     def push_aggregated_frame(self):
 
-        # adjust charges of pulses
-        for om_key in self.merged_pulse_series.keys():
-            for pulse in self.merged_pulse_series[om_key]:
-                pulse.charge /= self.oversampling_counter
-
+        # merge all pulses and adjust charges of pulses
         self.current_aggregation_frame['AggregatedPulses'] = \
-            self.merged_pulse_series
+            self.pulse_buffer.to_pulse_series(
+                charge_scale=1. / self.oversampling_counter)
 
         # update oversampling dictionary
         dic = dict(self.current_aggregation_frame['oversampling'])
@@ -117,104 +468,24 @@ class MergeOversampledEvents(icetray.I3ConditionalModule):
         self.current_daq_frame = None
         self.pushed_frame_already = True
 
-    def merge_pulse_series(self, pulse_series, new_pulses, time_shift):
-        """Merge two pulse series.
-
-        Assumes that new_pulses are to be merged into existing pulse_series,
-        e.g. new_pulses are smaller than pulse_series
-
-        Parameters
-        ----------
-        pulse_series : dataclasses.I3RecoPulseSeriesMap
-            Pulse series map to which the new pulses will be added
-        new_pulses : dataclasses.I3RecoPulseSeriesMap
-            New pulse series that will be merged into the existing pulse
-            series.
-        time_shift : float
-            The time shift of the new pulses.
-
-        Returns
-        -------
-        dataclasses.I3RecoPulseSeriesMap
-            Merged pulse series map.
-        """
-        pulse_series = dataclasses.I3RecoPulseSeriesMap(pulse_series)
-
-        # calculate relative time difference to first oversampling frame
-        delta_t = time_shift - self.current_time_shift
-
-        # Go through every key in new pulses:
-        for key, new_hits in new_pulses:
-            if key not in pulse_series:
-                # DOM has not been previously hit: just merge all hits
-                pulse_series[key] = new_hits
-
-                # correct times:
-                for new_hit in pulse_series[key]:
-                    new_hit.time += delta_t
-            else:
-                # DOM already has hits:
-                #   now need to merge new pulses in existing series
-                # Loop through existing pulses and sort them in
-                merged_hits = list(pulse_series[key])
-                len_merged_hits = len(merged_hits)
-                index = 0
-                for new_hit in new_hits:
-                    pulse_is_merged = False
-                    combine_pulses = False
-
-                    # correct for relative time shift difference
-                    new_hit.time += delta_t
-
-                    # sort the pulse into existing list
-                    while not pulse_is_merged:
-                        if (index >= len(merged_hits) or
-                                new_hit.time < merged_hits[index].time):
-
-                            time_diff = abs(
-                                new_hit.time - merged_hits[index - 1].time)
-                            combine_pulses = time_diff < self.min_separation
-                            if combine_pulses:
-                                # the pulses are close in time: merge
-                                merged_hits[index - 1].charge += new_hit.charge
-                            else:
-                                # insert pulse
-                                merged_hits.insert(index, new_hit)
-                                len_merged_hits += 1
-
-                            pulse_is_merged = True
-
-                        # only increase index if we did not combine 2 pulses
-                        if not combine_pulses:
-                            index += 1
-
-                # overwrite old pulse series
-                pulse_series[key] = merged_hits
-
-                # # sanity check
-                # assert len(pulse_series[key]) == len_merged_hits
-
-            # # sanity checks
-            # t_previous = pulse_series[key][0].time
-            # for p in pulse_series[key][1:]:
-            #     assert p.time >= t_previous
-            #     t_previous = p.time
-
-        return pulse_series
-
-    def _get_pulses(self, frame):
-        """Get the I3RecoPulseSeriesMap from the frame.
+    def _add_pulses(self, frame, delta_t=0.):
+        """Add the pulses of the frame to the pulse buffer.
 
         Parameters
         ----------
         frame : I3Frame
             The current I3Frame.
+        delta_t : float, optional
+            Time shift of the frame relative to the first oversampled frame.
         """
-        pulses = frame[self.pulse_key]
-        if isinstance(pulses, dataclasses.I3RecoPulseSeriesMapMask) or \
-                isinstance(pulses, dataclasses.I3RecoPulseSeriesMapUnion):
-            pulses = pulses.apply(frame)
-        return dataclasses.I3RecoPulseSeriesMap(pulses)
+        if (self.pulse_key not in frame and
+                has_compact_pulses(frame, self.pulse_key)):
+            times_key, charges_key = get_compact_pulse_keys(self.pulse_key)
+            self.pulse_buffer.add_compact(frame[times_key],
+                                          frame[charges_key], delta_t)
+        else:
+            self.pulse_buffer.add(get_pulse_series(frame, self.pulse_key),
+                                  delta_t)
 
     def DAQ(self, frame):
         if self.current_daq_frame is None:
@@ -237,17 +508,18 @@ class MergeOversampledEvents(icetray.I3ConditionalModule):
                 self.current_time_shift = frame['TimeShift'].value
                 self.current_aggregation_frame = frame
                 self.current_event_counter = oversampling['event_num_in_run']
-                self.merged_pulse_series = self._get_pulses(frame)
+                self.pulse_buffer = OversampledPulseBuffer(
+                                                        self.min_separation)
+                self._add_pulses(frame)
                 self.oversampling_counter = 1
                 self.pushed_frame_already = False
 
             else:
                 # same event, keep aggregating pulses
-                new_pulses = self._get_pulses(frame)
-                self.merged_pulse_series = self.merge_pulse_series(
-                                        self.merged_pulse_series,
-                                        new_pulses,
-                                        frame['TimeShift'].value)
+                # calculate relative time difference to first oversampling
+                # frame
+                delta_t = frame['TimeShift'].value - self.current_time_shift
+                self._add_pulses(frame, delta_t)
                 self.oversampling_counter += 1
 
             # Find out if event ended
@@ -296,7 +568,8 @@ def main(cfg, run_number, scratch, do_merging_if_necessary):
     tray = I3Tray()
     tray.AddModule('I3Reader',
                    'i3 reader',
-                   FilenameList=[cfg['gcd_pass2'], infile])
+                   FilenameList=[get_cached_gcd_file(cfg['gcd_pass2']),
+                                  infile])
 
     # get pulses
     tray.AddSegment(GetPulses, "GetPulses",
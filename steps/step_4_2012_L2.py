@@ -4,6 +4,7 @@ import click
 import yaml
 
 from utils import get_run_folder
+from resources.gcd_cache import get_cached_gcd_file
 
 from I3Tray import I3Tray
 from icecube import icetray, dataclasses, dataio
@@ -71,7 +72,7 @@ def main(cfg, run_number, scratch):
     tray = I3Tray()
     tray.AddModule('I3Reader',
                    'i3 reader',
-                   FilenameList=[cfg['gcd'], infile])
+                   FilenameList=[get_cached_gcd_file(cfg['gcd']), infile])
 
 
     class EmptyIceTopBadLists(icetray.I3ConditionalModule):
@@ -19,6 +19,7 @@ from icecube.filterscripts.offlineL2.level2_all_filters import OfflineFilter
 from icecube.filterscripts.offlineL2 import SpecialWriter
 
 from utils import get_run_folder
+from resources.gcd_cache import get_cached_gcd_file
 
 
 PHOTONICS_DIR = '/cvmfs/icecube.opensciencegrid.org/data/photon-tables'
@@ -58,7 +59,8 @@ def main(cfg, run_number, scratch):
     """The main L1 script"""
     tray.AddModule('I3Reader',
                    'i3 reader',
-                   FilenameList=[cfg['gcd_pass2'], infile])
+                   FilenameList=[get_cached_gcd_file(cfg['gcd_pass2']),
+                                  infile])
 
     tray.AddSegment(OfflineFilter,
                     "OfflineFilter",
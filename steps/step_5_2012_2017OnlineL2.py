@@ -32,6 +32,7 @@ from icecube.icetray import I3PacketModule, I3Units
 
 
 from utils import get_run_folder
+from resources.gcd_cache import get_cached_gcd_file
 
 
 PHOTONICS_DIR = '/cvmfs/icecube.opensciencegrid.org/data/photon-tables'
@@ -78,7 +79,8 @@ def main(cfg, run_number, scratch):
     # build tray
     tray = I3Tray()
     tray.context['I3FileStager'] = dataio.get_stagers()
-    tray.Add('I3Reader', FilenameList=[ cfg['gcd_pass2'], infile ],
+    tray.Add('I3Reader', FilenameList=[
+        get_cached_gcd_file(cfg['gcd_pass2']), infile],
              SkipKeys=[ 'I3MCTree' ] if 'corsika' in infile.lower() else [])
 
     # drop exisiting P-Frames (will do our own splitting later)
@@ -5,10 +5,11 @@ import os
 import click
 import yaml
 
-from utils import get_run_folder
+from utils import get_run_folder, get_cached_service
+from resources.gcd_cache import get_cached_gcd_file, get_omgeo
 
 from I3Tray import I3Tray
-from icecube import icetray, dataio, dataclasses, hdfwriter, phys_services
+from icecube import icetray, dataclasses, hdfwriter, phys_services
 from icecube import lilliput, gulliver, gulliver_modules
 from icecube import linefit
 from icecube.icetray import I3Units
@@ -35,7 +36,8 @@ DRIVER_FILE = 'mu_photorec.list'
 def taupede_segment(tray, name, cfg,
                     pulses='SplitInIcePulses',
                     seed_key='L3_MonopodFit4_AmptFit'):
-    cascade_service = I3PhotoSplineService(
+    cascade_service = get_cached_service(
+        I3PhotoSplineService,
         amplitudetable=os.path.join(SPLINE_TABLES, 'ems_mie_z20_a10.abs.fits'),
         timingtable=os.path.join(SPLINE_TABLES, 'ems_mie_z20_a10.prob.fits'),
         timingSigma=0)
@@ -60,11 +62,7 @@ def taupede_segment(tray, name, cfg,
         'PartialExclusion': True,
         'UseUnhitDOMs': True}
 
-    gcdfile = dataio.I3File(cfg['gcd_pass2'])
-    frame = gcdfile.pop_frame()
-    while 'I3Geometry' not in frame:
-        frame = gcdfile.pop_frame()
-    omgeo = frame['I3Geometry'].omgeo
+    omgeo = get_omgeo(cfg['gcd_pass2'])
 
     tray.AddSegment(TaupedeWrapper, 'TaupedeFit',
                     omgeo=omgeo,
@@ -121,7 +119,8 @@ def mu_millipede_segment(tray, name, cfg, pulses='InIcePulses'):
                        "$I3_BUILD/mue/resources/ice/mie"))
 
     # spline MPE as a seed for MuMillipede
-    spline_mie = I3PhotoSplineService(
+    spline_mie = get_cached_service(
+        I3PhotoSplineService,
         os.path.join(SPLINE_TABLES, 'InfBareMu_mie_abs_z20a10_V2.fits'),
         os.path.join(SPLINE_TABLES, 'InfBareMu_mie_prob_z20a10_V2.fits'), 4)
     llh = "MPE"
@@ -132,7 +131,8 @@ def mu_millipede_segment(tray, name, cfg, pulses='InIcePulses'):
                     Suffix="",
                     spline=spline_mie)
 
-    cascade_service_mie = I3PhotoSplineService(
+    cascade_service_mie = get_cached_service(
+        I3PhotoSplineService,
         amplitudetable=os.path.join(SPLINE_TABLES, 'ems_mie_z20_a10.abs.fits'),
         timingtable=os.path.join(SPLINE_TABLES, 'ems_mie_z20_a10.prob.fits'),
         timingSigma=0)
@@ -265,7 +265,8 @@ def main(cfg, run_number, scratch):
     tray = I3Tray()
 
     tray.AddModule('I3Reader', 'reader',
-                   filenamelist=[cfg['gcd_pass2'], infile])
+                   filenamelist=[get_cached_gcd_file(cfg['gcd_pass2']),
+                                  infile])
 
     def split_selector(frame):
         if frame.Stop == icetray.I3Frame.Physics:
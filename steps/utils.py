@@ -1,8 +1,18 @@
+import re
+
 import numpy as np
 
 MAX_DATASET_NUMBER = 100000
 MAX_RUN_NUMBER = 100000
 
+# file extensions of the compression codecs supported by dataio
+COMPRESSION_EXTENSIONS = {'bz2': '.i3.bz2',
+                          'gzip': '.i3.gz',
+                          'zstd': '.i3.zst',
+                          'none': '.i3'}
+COMPRESSION_ALIASES = {'gz': 'gzip', 'zst': 'zstd', 'uncompressed': 'none'}
+I3_EXTENSION = re.compile(r'\.i3(\.(bz2|gz|zst))?$')
+
 
 def create_random_services(dataset_number, run_number, seed, n_services=1,
                            use_gslrng=False):
@@ -36,6 +46,41 @@ def create_random_services(dataset_number, run_number, seed, n_services=1,
     return random_services, int_run_number
 
 
+# expensive services that are shared between runs processed in the
+# same process, see get_cached_service
+_SERVICE_CACHE = {}
+
+
+def get_cached_service(factory, *args, **kwargs):
+    """Create a service once per process and reuse it afterwards.
+
+    A persistent worker (worker.py) processes many runs in the same
+    process. Expensive, immutable services such as photon spline tables
+    or MuonGun models are then only loaded for the first run. The
+    services must not be changed by the caller: settings that may differ
+    between runs have to be passed to the factory, so that they are part
+    of the key.
+
+    Parameters
+    ----------
+    factory : callable
+        Creates the service.
+    *args
+        Positional arguments passed to the factory.
+    **kwargs
+        Keyword arguments passed to the factory.
+
+    Returns
+    -------
+    object
+        The service.
+    """
+    key = (factory, args, tuple(sorted(kwargs.items())))
+    if key not in _SERVICE_CACHE:
+        _SERVICE_CACHE[key] = factory(*args, **kwargs)
+    return _SERVICE_CACHE[key]
+
+
 def get_run_folder(run_number, runs_per_folder=1000):
     fill = int(np.log10(MAX_RUN_NUMBER) + 0.5)
     start = (run_number // runs_per_folder) * runs_per_folder
@@ -43,6 +88,142 @@ def get_run_folder(run_number, runs_per_folder=1000):
     return '{}-{}'.format(str(start).zfill(fill), str(stop).zfill(fill))
 
 
+def get_compression(cfg, step=None):
+    """Get the compression codec of the output of a step.
+
+    Parameters
+    ----------
+    cfg : dict
+        The config. 'compression' is either a single codec for all steps
+        or a dict with the codec of each step.
+    step : int, optional
+        The step. The current step of the config is used by default.
+
+    Returns
+    -------
+    str or None
+        The codec: 'bz2', 'gzip', 'zstd' or 'none'. None if no codec is
+        configured for the step.
+
+    Raises
+    ------
+    ValueError
+        If the codec is not supported.
+    """
+    compression = cfg.get('compression', None)
+    if isinstance(compression, dict):
+        if step is None:
+            step = cfg['step']
+        compression = compression.get(step, None)
+    if compression is None:
+        return None
+    compression = str(compression).lower()
+    compression = COMPRESSION_ALIASES.get(compression, compression)
+    if compression not in COMPRESSION_EXTENSIONS:
+        raise ValueError('Unknown compression {!r}, use one of {}'.format(
+            compression, ', '.join(sorted(COMPRESSION_EXTENSIONS))))
+    return compression
+
+
+def split_file_extension(filepath):
+    """Split the i3 file extension, e.g. '.i3.bz2', from a path.
+
+    Parameters
+    ----------
+    filepath : str
+        The path.
+
+    Returns
+    -------
+    str
+        The path without the extension.
+    str
+        The extension. Empty if the path is not an i3 file.
+    """
+    match = I3_EXTENSION.search(filepath)
+    if match is None:
+        return filepath, ''
+    return filepath[:match.start()], match.group(0)
+
+
+def set_compression(filepath, compression):
+    """Change the extension of an i3 file to the one of a codec.
+
+    Parameters
+    ----------
+    filepath : str
+        The path.
+    compression : str or None
+        The codec. If None, the path is returned unchanged.
+
+    Returns
+    -------
+    str
+        The path with the new extension.
+    """
+    if compression is None:
+        return filepath
+    base, extension = split_file_extension(filepath)
+    if extension == '':
+        return filepath
+    return base + COMPRESSION_EXTENSIONS[compression]
+
+
+def get_compress_command(filepath):
+    """Get the command that compresses stdin to stdout with the codec given
+    by the extension of a file.
+
+    Parameters
+    ----------
+    filepath : str
+        The path of the i3 file.
+
+    Returns
+    -------
+    list of str
+        The command.
+    """
+    extension = split_file_extension(filepath)[1]
+    if extension == '.i3.bz2':
+        return ['bzip2', '-c', '-9']
+    elif extension == '.i3.gz':
+        return ['gzip', '-c', '-6']
+    elif extension == '.i3.zst':
+        return ['zstd', '-c', '-q']
+    elif extension == '.i3':
+        return ['cat']
+    raise ValueError('Unknown file extension: {}'.format(filepath))
+
+
+def get_decompress_command(filepath):
+    """Get the command that decompresses a bzip2 or gzip i3 file to stdout.
+
+    Files with several compressed streams, e.g. written by pbzip2, are
+    supported.
+
+    Parameters
+    ----------
+    filepath : str
+        The path of the i3 file.
+
+    Returns
+    -------
+    list of str
+        The command, without the path of the file.
+
+    Raises
+    ------
+    ValueError
+        If the file is not bzip2 or gzip compressed.
+    """
+    extension = split_file_extension(filepath)[1]
+    if extension == '.i3.bz2':
+        return ['bzip2', '-dc']
+    elif extension == '.i3.gz':
+        return ['gzip', '-dc']
+    raise ValueError('Can not decompress {}'.format(filepath))
+
+
 muongun_keys = ['MCOversizeStreamDefault',
                 'MCOversizeStream0',
                 'MCOversizeStream1',
@@ -53,4 +234,5 @@ muongun_keys = ['MCOversizeStreamDefault',
                 'MCOversizing',
                 'GenerateCosmicRayMuons',
                 'MCDomThresholds',
-                'MCDistanceCuts']
+                'MCDistanceCuts',
+                'MCOversizeEventIndex']
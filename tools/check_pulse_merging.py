@@ -0,0 +1,142 @@
+'''Compare the merging of oversampled pulses with the sequential merge.
+
+MergeOversampledEvents used to merge the pulses of every oversampled frame
+one by one into the pulse series of the previous frames. This script
+reproduces that merge on simple pulse objects and checks that the
+OversampledPulseBuffer gives the same pulses for random events with many
+close pulses in many frames. It is run in the environment of the step:
+
+    python tools/check_pulse_merging.py --num_events 100 --num_frames 20
+'''
+import os
+import sys
+import copy
+
+import click
+import numpy as np
+
+STEP_FOLDER = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'steps')
+if STEP_FOLDER not in sys.path:
+    sys.path.insert(0, STEP_FOLDER)
+
+from step_3_pass2_get_pulses import OversampledPulseBuffer
+
+
+class Pulse(object):
+
+    def __init__(self, time, charge, width, flags):
+        self.time = time
+        self.charge = charge
+        self.width = width
+        self.flags = flags
+
+
+def merge_sequentially(frames, min_separation):
+    """Merge the frames like the previous MergeOversampledEvents.
+
+    Parameters
+    ----------
+    frames : list of dict
+        The pulses of each frame by DOM, the times are already shifted.
+    min_separation : float
+        The minimum time in ns between two merged pulses.
+
+    Returns
+    -------
+    dict
+        The merged pulses by DOM.
+    """
+    pulse_series = copy.deepcopy(frames[0])
+    for new_pulses in frames[1:]:
+        for key, new_hits in copy.deepcopy(new_pulses).items():
+            if key not in pulse_series:
+                pulse_series[key] = new_hits
+                continue
+            merged_hits = list(pulse_series[key])
+            index = 0
+            for new_hit in new_hits:
+                pulse_is_merged = False
+                combine_pulses = False
+                while not pulse_is_merged:
+                    if (index >= len(merged_hits) or
+                            new_hit.time < merged_hits[index].time):
+                        time_diff = abs(
+                            new_hit.time - merged_hits[index - 1].time)
+                        combine_pulses = time_diff < min_separation
+                        if combine_pulses:
+                            merged_hits[index - 1].charge += new_hit.charge
+                        else:
+                            merged_hits.insert(index, new_hit)
+                        pulse_is_merged = True
+                    if not combine_pulses:
+                        index += 1
+            pulse_series[key] = merged_hits
+    return pulse_series
+
+
+def generate_frames(random_state, num_frames, num_doms, num_pulses,
+                    time_range):
+    frames = []
+    for _ in range(num_frames):
+        frame = {}
+        for key in range(num_doms):
+            n = random_state.poisson(num_pulses)
+            if n == 0:
+                continue
+            times = np.sort(random_state.uniform(*time_range, size=n))
+            frame[key] = [Pulse(t, q, w, f) for t, q, w, f in zip(
+                times,
+                random_state.exponential(1., size=n),
+                random_state.uniform(1., 10., size=n),
+                random_state.randint(0, 4, size=n))]
+        frames.append(frame)
+    return frames
+
+
+@click.command()
+@click.option('--num_events', default=100)
+@click.option('--num_frames', default=20)
+@click.option('--num_doms', default=20)
+@click.option('--num_pulses', default=20.)
+@click.option('--min_separation', default=1.)
+@click.option('--seed', default=1337)
+def main(num_events, num_frames, num_doms, num_pulses, min_separation, seed):
+    random_state = np.random.RandomState(seed)
+    num_compared = 0
+    for _ in range(num_events):
+        frames = generate_frames(random_state, num_frames, num_doms,
+                                 num_pulses, (0., 10. * num_pulses))
+        # the sequential merge compares pulses before the first pulse of a
+        # DOM with its last pulse, so these pulses are removed
+        first_times = {}
+        for frame in frames:
+            for key, pulses in frame.items():
+                first_times.setdefault(key, pulses[0].time)
+        for frame in frames:
+            for key in frame.keys():
+                frame[key] = [p for p in frame[key]
+                              if p.time >= first_times[key]]
+
+        expected = merge_sequentially(frames, min_separation)
+
+        pulse_buffer = OversampledPulseBuffer(min_separation)
+        for frame in frames:
+            # iterating an I3RecoPulseSeriesMap yields the items
+            pulse_buffer.add(list(frame.items()))
+
+        merged = pulse_buffer.merge()
+        for key, pulses in expected.items():
+            times, charges, widths, flags = merged[key]
+            assert len(times) == len(pulses), key
+            assert np.allclose(times, [p.time for p in pulses]), key
+            assert np.allclose(charges, [p.charge for p in pulses]), key
+            assert np.allclose(widths, [p.width for p in pulses]), key
+            assert np.all(flags == [p.flags for p in pulses]), key
+            num_compared += len(pulses)
+    click.echo('Merged pulses agree: {} pulses compared'.format(
+        num_compared))
+
+
+if __name__ == '__main__':
+    main()
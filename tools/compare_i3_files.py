@@ -0,0 +1,99 @@
+'''Compare the frames of two i3 files.
+
+The frames are compared one by one: the stop, the keys of the frame and the
+serialized value of every key. Keys which were mixed in from previous
+frames are skipped. This is used to check that a chain run with --fused
+writes the same frames as the same chain run step by step. For the cascade
+chain both are written into different data folders and the outputs of
+step 3 of the same run are compared:
+
+    simulation_scripts_write -s 0-3 -d /data/staged configs/cascade.yaml
+    simulation_scripts_write -s 0-3 --fused -d /data/fused \
+        configs/cascade.yaml
+    python tools/compare_i3_files.py /data/staged/.../Level0.3_*.i3.bz2 \
+        /data/fused/.../Level0.3_*.i3.bz2
+
+It is run in an environment with icecube.dataio.
+'''
+import fnmatch
+
+import click
+
+from icecube import dataio
+
+
+def get_frame_items(frame, ignore_keys):
+    """Get the serialized values of the keys of a frame.
+
+    Parameters
+    ----------
+    frame : I3Frame
+        The frame.
+    ignore_keys : list of str
+        Patterns of keys which are skipped.
+
+    Returns
+    -------
+    dict
+        The xml of every key which belongs to the frame itself.
+    """
+    items = {}
+    for key in frame.keys():
+        if frame.get_stop(key) != frame.Stop:
+            continue
+        if any(fnmatch.fnmatch(key, pattern) for pattern in ignore_keys):
+            continue
+        items[key] = frame.as_xml(key)
+    return items
+
+
+@click.command()
+@click.argument('file_a', type=click.Path(exists=True))
+@click.argument('file_b', type=click.Path(exists=True))
+@click.option('--ignore_key', '-i', multiple=True,
+              help='Key to skip, wildcards are allowed. Can be repeated.')
+@click.option('--max_differences', default=10,
+              help='Stop after this number of differences.')
+def main(file_a, file_b, ignore_key, max_differences):
+    i3file_a = dataio.I3File(file_a)
+    i3file_b = dataio.I3File(file_b)
+    n_frames = 0
+    differences = []
+    while i3file_a.more() and i3file_b.more():
+        frame_a = i3file_a.pop_frame()
+        frame_b = i3file_b.pop_frame()
+        n_frames += 1
+        if frame_a.Stop != frame_b.Stop:
+            differences.append('Frame {}: stop {} != {}'.format(
+                n_frames, frame_a.Stop, frame_b.Stop))
+        else:
+            items_a = get_frame_items(frame_a, ignore_key)
+            items_b = get_frame_items(frame_b, ignore_key)
+            for key in sorted(set(items_a) ^ set(items_b)):
+                differences.append('Frame {} ({}): {} only in {}'.format(
+                    n_frames, frame_a.Stop, key,
+                    file_a if key in items_a else file_b))
+            for key in sorted(set(items_a) & set(items_b)):
+                if items_a[key] != items_b[key]:
+                    differences.append('Frame {} ({}): {} differs'.format(
+                        n_frames, frame_a.Stop, key))
+        if len(differences) >= max_differences:
+            break
+    else:
+        if i3file_a.more() or i3file_b.more():
+            differences.append('Different number of frames: {} has more '
+                               'than {} frames'.format(
+                                    file_a if i3file_a.more() else file_b,
+                                    n_frames))
+    i3file_a.close()
+    i3file_b.close()
+
+    for difference in differences:
+        click.echo(difference)
+    if len(differences) > 0:
+        raise click.ClickException('Files differ')
+    click.echo('Files agree: {} frames compared'.format(n_frames))
+
+
+if __name__ == '__main__':
+    main()
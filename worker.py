@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import socket
+import importlib
+import traceback
+
+import click
+import yaml
+
+from steps.utils import get_run_folder
+
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+QUEUE_STATES = ['pending', 'running', 'done', 'failed']
+
+
+class RunQueue(object):
+
+    """File-based queue of run numbers.
+
+    Every run is a file that is moved between the directories 'pending',
+    'running', 'done' and 'failed' of the queue directory. A run is
+    claimed by renaming it from 'pending' to 'running'. As renames are
+    atomic, several workers can share a queue.
+
+    Parameters
+    ----------
+    queue_dir : str
+        The queue directory.
+    """
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        for state in QUEUE_STATES:
+            state_dir = os.path.join(queue_dir, state)
+            if not os.path.isdir(state_dir):
+                os.makedirs(state_dir)
+
+    def _path(self, state, run_number):
+        return os.path.join(self.queue_dir, state,
+                            '{:06d}'.format(run_number))
+
+    def put(self, run_number):
+        with open(self._path('pending', run_number), 'w'):
+            pass
+
+    def claim(self):
+        """Claim the next pending run.
+
+        Returns
+        -------
+        int or None
+            The run number or None if no runs are pending.
+        """
+        for name in sorted(os.listdir(os.path.join(self.queue_dir,
+                                                   'pending'))):
+            run_number = int(name)
+            try:
+                os.rename(self._path('pending', run_number),
+                          self._path('running', run_number))
+            except OSError:
+                # claimed by another worker
+                continue
+            with open(self._path('running', run_number), 'w') as f:
+                f.write('{} {}\n'.format(socket.gethostname(), os.getpid()))
+            return run_number
+        return None
+
+    def finish(self, run_number, exit_code, message=''):
+        """Mark a claimed run as done or failed.
+
+        Parameters
+        ----------
+        run_number : int
+            The run number.
+        exit_code : int
+            The exit code of the run. The run is done if it is 0 and
+            failed otherwise.
+        message : str, optional
+            Written to the file of the run, e.g. the traceback.
+        """
+        state = 'done' if exit_code == 0 else 'failed'
+        with open(self._path('running', run_number), 'a') as f:
+            f.write(message)
+            f.write('\nexit code: {}\n'.format(exit_code))
+        os.rename(self._path('running', run_number),
+                  self._path(state, run_number))
+
+    def get_exit_codes(self):
+        """Get the exit codes of the finished runs.
+
+        Returns
+        -------
+        dict
+            The exit code of every done or failed run.
+        """
+        exit_codes = {}
+        for state in ['done', 'failed']:
+            for name in os.listdir(os.path.join(self.queue_dir, state)):
+                with open(os.path.join(self.queue_dir, state, name)) as f:
+                    last_line = f.read().strip().split('\n')[-1]
+                exit_codes[int(name)] = int(last_line.split(':')[-1])
+        return exit_codes
+
+
+def import_step(step):
+    """Import the module of a step.
+
+    Parameters
+    ----------
+    step : str
+        Name of the step, e.g. 'step_3_pass2_get_pulses', or path to the
+        step script.
+
+    Returns
+    -------
+    module
+        The step module.
+    """
+    step_name = os.path.splitext(os.path.basename(step))[0]
+    steps_folder = os.path.join(SCRIPT_FOLDER, 'steps')
+    if steps_folder not in sys.path:
+        sys.path.insert(0, steps_folder)
+    return importlib.import_module(step_name)
+
+
+def get_final_out(config, run_number):
+    config = dict(config)
+    config['run_number'] = run_number
+    config['run_folder'] = get_run_folder(run_number)
+    return config['outfile_pattern'].format(**config).replace(' ', '0')
+
+
+def get_exit_code(exception):
+    """Get the exit code of a run that raised an exception.
+
+    Like the interpreter, a SystemExit without code or with code 0 is a
+    success, e.g. a step that calls sys.exit(0) after writing its output.
+
+    Parameters
+    ----------
+    exception : Exception or SystemExit
+        The raised exception.
+
+    Returns
+    -------
+    int
+        The exit code.
+    """
+    if isinstance(exception, SystemExit):
+        if exception.code is None:
+            return 0
+        if isinstance(exception.code, int):
+            return exception.code
+    return 1
+
+
+@click.group()
+def main():
+    """Process many runs of a step in one persistent process.
+    """
+    pass
+
+
+@main.command()
+@click.argument('queue_dir', type=click.Path(resolve_path=True))
+@click.argument('run_start', type=int)
+@click.argument('run_stop', type=int)
+def fill(queue_dir, run_start, run_stop):
+    """Add the runs [RUN_START, RUN_STOP) to the queue.
+    """
+    queue = RunQueue(queue_dir)
+    for run_number in range(run_start, run_stop):
+        queue.put(run_number)
+    click.echo('Added {} runs to {}'.format(run_stop - run_start, queue_dir))
+
+
+@main.command()
+@click.argument('step')
+@click.argument('cfg', type=click.Path(exists=True, resolve_path=True))
+@click.argument('queue_dir', type=click.Path(exists=True,
+                                             resolve_path=True))
+@click.option('--max_runs', default=None, type=int,
+              help='Exit after this many runs, e.g. to limit the growth '
+                   'of memory.')
+def run(step, cfg, queue_dir, max_runs):
+    """Process runs of STEP from the queue in QUEUE_DIR.
+
+    The step module is imported once. A fresh tray is built for every run,
+    while services obtained via utils.get_cached_service are reused.
+    Outputs are written directly to their final location.
+    """
+    with open(cfg, 'r') as stream:
+        if int(yaml.__version__[0]) < 5:
+            # backwards compatibility for yaml versions before version 5
+            config = yaml.load(stream)
+        else:
+            config = yaml.full_load(stream)
+    if 'keep_crashed_files' in config:
+        keep_crashed_files = config['keep_crashed_files']
+    else:
+        keep_crashed_files = 0
+    module = import_step(step)
+    queue = RunQueue(queue_dir)
+
+    n_runs = 0
+    n_failed = 0
+    while max_runs is None or n_runs < max_runs:
+        run_number = queue.claim()
+        if run_number is None:
+            break
+        click.echo('Processing run {}'.format(run_number))
+        start_time = time.time()
+        exit_code = 0
+        message = ''
+        try:
+            module.main.main(args=[cfg, str(run_number), '--no-scratch'],
+                             standalone_mode=False)
+        except (Exception, SystemExit) as e:
+            exit_code = get_exit_code(e)
+            if exit_code != 0:
+                message = traceback.format_exc()
+                click.echo(message)
+        if exit_code != 0:
+            n_failed += 1
+            final_out = get_final_out(config, run_number)
+            if not keep_crashed_files and os.path.isfile(final_out):
+                click.echo('Deleting partially processed file! {}'.format(
+                    final_out))
+                os.remove(final_out)
+        queue.finish(run_number, exit_code, message=message)
+        n_runs += 1
+        click.echo('Run {} took {:.1f}s'.format(
+            run_number, time.time() - start_time))
+    click.echo('Processed {} runs, {} failed'.format(n_runs, n_failed))
+    if n_failed > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()